@@ -0,0 +1,287 @@
+''' Offline benchmarks for tile scoring, score calculations, and compactness.
+
+Stages run against bundled sample data from data/sample-NC* and the
+planscore/tests/data fixtures, then against synthetic plans scaled up to
+many districts and fields. Each stage reports seconds per run, items per
+second, and peak memory traced by tracemalloc.
+
+Runs are compared against the committed baseline in data/benchmark-baseline.json
+to catch performance regressions before deploy. Save a new baseline after
+intended changes, or compare against another one:
+
+    planscore-benchmark --save-baseline data/benchmark-baseline.json
+    planscore-benchmark --baseline other-baseline.json
+'''
+import os, sys, glob, json, time, random, argparse, itertools, contextlib, tracemalloc, collections
+import osgeo.ogr
+from . import data, tiles, score, matrix, compactness, score_plan
+
+TESTS_DATA = os.path.join(os.path.dirname(__file__), 'tests', 'data')
+SAMPLES_DATA = os.path.join(os.path.dirname(__file__), '..', 'data')
+BASELINE_PATH = os.path.join(SAMPLES_DATA, 'benchmark-baseline.json')
+
+# Model tile fixtures paired with district plans that overlap them
+TILE_FIXTURES = [
+    (os.path.join(TESTS_DATA, 'XX'), os.path.join(TESTS_DATA, 'null-plan.geojson')),
+    (os.path.join(TESTS_DATA, 'NC'), os.path.join(TESTS_DATA, 'NC-plan-1-992.geojson')),
+]
+
+DISTRICT_COUNTS = (2, 20, 200)
+FIELD_COUNTS = (1, 120, 12000)
+
+# Throughput below (1 - tolerance) times baseline counts as a regression
+DEFAULT_TOLERANCE = .2
+
+Stage = collections.namedtuple('Stage', ('name', 'items', 'function'))
+Result = collections.namedtuple('Result', ('name', 'items', 'seconds', 'throughput', 'peak_memory', 'error'))
+
+def measure(stage, repeat):
+    ''' Return a Result with the best time of several runs and peak memory of one.
+    '''
+    try:
+        tracemalloc.start()
+        stage.function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    except Exception as error:
+        return Result(stage.name, stage.items, None, None, None, repr(error))
+    finally:
+        tracemalloc.stop()
+    
+    times = []
+    
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        stage.function()
+        times.append(time.perf_counter() - start_time)
+    
+    seconds = min(times)
+    throughput = stage.items / seconds if seconds else None
+    
+    return Result(stage.name, stage.items, round(seconds, 6),
+        throughput and round(throughput, 3), peak_memory, None)
+
+def read_geometries(path):
+    ''' Return list of OGR geometries from a plan file.
+    '''
+    ds = osgeo.ogr.Open(path)
+    return [feature.GetGeometryRef().Clone() for feature in ds.GetLayer(0)
+        if feature.GetGeometryRef() is not None]
+
+def strip_geometries(tile_geom, count):
+    ''' Return count vertical strips of a tile geometry, as synthetic districts.
+    '''
+    xmin, xmax, ymin, ymax = tile_geom.GetEnvelope()
+    width = (xmax - xmin) / count
+    
+    return [osgeo.ogr.CreateGeometryFromWkt('POLYGON (({x1} {y1}, {x1} {y2}, {x2} {y2}, {x2} {y1}, {x1} {y1}))'.format(
+        x1=xmin + width * index, x2=xmin + width * (index + 1), y1=ymin, y2=ymax))
+        for index in range(count)]
+
+def synthetic_upload(district_count, field_count, seed=0, key_prefix='data/NC/benchmark'):
+    ''' Return an Upload with random simulated votes in district_count × field_count totals.
+
+        Fields are "O:DEM000"-style votes for as many simulations as fit,
+        padded out with extra population-like fields. Optional key_prefix
+        is the model directory, for scoring local model tiles.
+    '''
+    rand = random.Random(seed)
+    sims = min(1000, field_count // 6)
+    incumbents = [rand.choice([incumbency.value for incumbency in data.Incumbency])
+        for _ in range(district_count)]
+    districts = []
+    
+    for _ in range(district_count):
+        totals = {}
+        
+        for (party, incumbency, sim) in itertools.product(('DEM', 'REP'), data.Incumbency, range(sims)):
+            totals[score.FIELD_TMPL.format(party=party, incumbent=incumbency.value, sim=sim)] \
+                = round(rand.uniform(1000, 100000), 2)
+        
+        for index in range(field_count - len(totals)):
+            totals[f'Extra {index}'] = round(rand.uniform(0, 100000), 2)
+        
+        districts.append(dict(totals=totals, compactness={}))
+    
+    model = data.Model(data.State.NC, data.House.ushouse, district_count, True, '2020', key_prefix)
+    
+    return data.Upload('benchmark', 'uploads/benchmark/upload/plan.geojson',
+        model=model, districts=districts, incumbents=incumbents)
+
+def calculate_scores(upload):
+    ''' Run the same chain of score.calculate_* functions as ObserveTiles.
+    '''
+    return score.calculate_district_biases(score.calculate_biases(
+        score.calculate_open_biases(score.calculate_bias(upload))))
+
+def run_tile_key(storage, upload, tile_key, geometries):
+    ''' Score one tile with tiles.score_tile_key() as RunTile does in a cold container.
+    
+        The tile cache is cleared first so loading and parsing are timed too,
+        and progress messages from tile loaders are kept out of the report.
+    '''
+    tiles._tile_cache.clear()
+    
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return tiles.score_tile_key(storage, upload, tile_key, geometries)
+
+def tile_stages(district_counts):
+    ''' Generate Stages for tiles.score_tile_key() over model tile fixtures.
+    '''
+    for (model_dir, plan_path) in TILE_FIXTURES:
+        tile_paths = sorted(glob.glob(os.path.join(model_dir, '**', '*.geojson'), recursive=True))
+        geometries = dict(enumerate(read_geometries(plan_path)))
+        storage = data.Storage(score_plan.LocalS3(), None, model_dir)
+        
+        for tile_path in tile_paths:
+            tile_zxy = tiles.get_tile_zxy(model_dir, tile_path)
+            tile_geom = tiles.tile_geometry(tile_zxy)
+            
+            with open(tile_path) as file:
+                precinct_count = len(json.load(file)['features'])
+            
+            name = 'score_tile_key {}/{}'.format(os.path.basename(model_dir), tile_zxy)
+            upload = synthetic_upload(len(geometries), 0, key_prefix=model_dir)
+            yield Stage(name, len(geometries) * precinct_count, lambda storage=storage,
+                upload=upload, tile_path=tile_path, geometries=geometries:
+                run_tile_key(storage, upload, tile_path, geometries))
+            
+            # Scaled-up plans with many small districts over the same tile
+            for count in district_counts:
+                strips = dict(enumerate(strip_geometries(tile_geom, count)))
+                upload = synthetic_upload(count, 0, key_prefix=model_dir)
+                yield Stage(f'{name} {count} districts', count * precinct_count,
+                    lambda storage=storage, upload=upload, tile_path=tile_path, strips=strips:
+                    run_tile_key(storage, upload, tile_path, strips))
+
+def score_stages(district_counts, field_counts):
+    ''' Generate Stages for score.calculate_* over sample and synthetic uploads.
+    '''
+    for index_path in sorted(glob.glob(os.path.join(SAMPLES_DATA, 'sample-NC*', 'index.json'))):
+        with open(index_path) as file:
+            upload = data.Upload.from_json(file.read())
+        
+        if not upload.districts:
+            continue
+        
+        name = 'calculate {}'.format(os.path.basename(os.path.dirname(index_path)))
+        yield Stage(name, len(upload.districts), lambda upload=upload: calculate_scores(upload))
+    
+    for (district_count, field_count) in itertools.product(district_counts, field_counts):
+        upload = synthetic_upload(district_count, field_count)
+        yield Stage(f'calculate {district_count} districts {field_count} fields',
+            district_count * field_count, lambda upload=upload: calculate_scores(upload))
+
+def matrix_stages(district_counts):
+    ''' Generate Stages for matrix.model_votes() with synthetic presidential votes.
+    '''
+    for count in district_counts:
+        rand = random.Random(count)
+        districts = [(rand.uniform(1e4, 2e5), rand.uniform(1e4, 2e5), rand.choice('ODR'))
+            for _ in range(count)]
+        
+        yield Stage(f'model_votes {count} districts', count,
+            lambda districts=districts: matrix.model_votes(data.State.NC, matrix.YEAR, districts))
+
+def compactness_stages(district_counts):
+    ''' Generate Stages for compactness.get_scores() over sample and synthetic districts.
+    '''
+    plan_paths = [os.path.join(TESTS_DATA, 'NC-plan-1-992.geojson')] \
+        + sorted(glob.glob(os.path.join(SAMPLES_DATA, 'sample-NC*', 'geometry.json')))
+    
+    for plan_path in plan_paths:
+        if not os.path.exists(plan_path):
+            continue
+        
+        # Sample plans are all named geometry.json, so use their directory names
+        geometries = read_geometries(plan_path)
+        plan_name = os.path.basename(os.path.dirname(plan_path)) \
+            if plan_path.endswith('geometry.json') else os.path.basename(plan_path)
+        name = f'get_scores {plan_name}'
+        yield Stage(name, len(geometries), lambda geometries=geometries:
+            [compactness.get_scores(geometry) for geometry in geometries])
+    
+    for count in district_counts:
+        strips = strip_geometries(tiles.tile_geometry('7/63/63'), count)
+        yield Stage(f'get_scores {count} districts', count, lambda strips=strips:
+            [compactness.get_scores(geometry) for geometry in strips])
+
+def iter_stages(district_counts, field_counts):
+    ''' Generate all benchmark Stages.
+    '''
+    yield from tile_stages(district_counts)
+    yield from score_stages(district_counts, field_counts)
+    yield from matrix_stages(district_counts)
+    yield from compactness_stages(district_counts)
+
+def compare_results(results, baseline, tolerance):
+    ''' Return list of (name, baseline throughput, throughput) for regressed Results.
+
+        baseline is a dictionary of Result dictionaries keyed by name, and
+        stages missing from either side are not compared.
+    '''
+    regressions = []
+    
+    for result in results:
+        previous = baseline.get(result.name)
+        
+        if previous is None or result.throughput is None or previous.get('throughput') is None:
+            continue
+        
+        if result.throughput < previous['throughput'] * (1 - tolerance):
+            regressions.append((result.name, previous['throughput'], result.throughput))
+    
+    return regressions
+
+def format_result(result, previous=None):
+    ''' Return a one-line report for a Result, with change from optional previous.
+    '''
+    if result.error:
+        return f'{result.name:60s} skipped: {result.error}'
+    
+    line = '{:60s} {:10.4f}s {:14,.1f}/s {:10,.0f}KB'.format(result.name,
+        result.seconds, result.throughput or 0, result.peak_memory / 1024)
+    
+    if previous and previous.get('throughput') and result.throughput:
+        line += ' {:+6.1%}'.format(result.throughput / previous['throughput'] - 1)
+    
+    return line
+
+parser = argparse.ArgumentParser(description='Benchmark PlanScore scoring stages offline')
+parser.add_argument('--repeat', type=int, default=3,
+    help='Number of timed runs for each stage, best is kept. Default 3.')
+parser.add_argument('--districts', type=int, nargs='+', default=DISTRICT_COUNTS,
+    help='District counts for synthetic plans. Default {}.'.format(' '.join(map(str, DISTRICT_COUNTS))))
+parser.add_argument('--fields', type=int, nargs='+', default=FIELD_COUNTS,
+    help='Field counts for synthetic plans. Default {}.'.format(' '.join(map(str, FIELD_COUNTS))))
+parser.add_argument('--filter', help='Only run stages with names containing this text')
+parser.add_argument('--baseline', default=BASELINE_PATH,
+    help='Path to baseline JSON to compare against. Default {}.'.format(os.path.relpath(BASELINE_PATH)))
+parser.add_argument('--save-baseline', help='Path to write results as a new baseline JSON')
+parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+    help='Allowed fractional throughput drop from baseline. Default {}.'.format(DEFAULT_TOLERANCE))
+
+def main():
+    args = parser.parse_args()
+    baseline, results = {}, []
+    
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    
+    for stage in iter_stages(args.districts, args.fields):
+        if args.filter and args.filter not in stage.name:
+            continue
+        
+        results.append(measure(stage, args.repeat))
+        print(format_result(results[-1], baseline.get(stage.name)))
+    
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump({result.name: result._asdict() for result in results}, file, indent=2)
+    
+    regressions = compare_results(results, baseline, args.tolerance)
+    
+    for (name, previous, current) in regressions:
+        print('Regression:', name, 'from {:,.1f}/s to {:,.1f}/s'.format(previous, current), file=sys.stderr)
+    
+    return 1 if regressions else 0
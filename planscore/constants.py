@@ -41,4 +41,21 @@ ROUND_FLOAT = 4
 
 # For now, limit the number of tiles to run in parallel
 
-MAX_TILES_RUN = 9999
\ No newline at end of file
+MAX_TILES_RUN = 9999
+
+# Number of tiles to score in each RunTile invocation, 1 for one tile each
+
+TILE_BATCH_SIZE = int(os.environ.get('TILE_BATCH_SIZE', 1))
+
+# Number of concurrent RunTile invocations and attempts per invocation
+
+FAN_OUT_CONCURRENCY = int(os.environ.get('FAN_OUT_CONCURRENCY', 8))
+FAN_OUT_ATTEMPTS = int(os.environ.get('FAN_OUT_ATTEMPTS', 5))
+
+# Lambda memory in megabytes, provided by the AWS Lambda runtime
+
+LAMBDA_MEMORY_SIZE = int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 1024))
+
+# Portion of Lambda memory to use for warm-container caches in RunTile
+
+CACHE_MEMORY_FRACTION = float(os.environ.get('CACHE_MEMORY_FRACTION', .25))
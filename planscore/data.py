@@ -7,9 +7,14 @@ UPLOAD_PLAINTEXT_KEY = 'uploads/{id}/index.txt'
 UPLOAD_GEOMETRY_KEY = 'uploads/{id}/geometry.json'
 UPLOAD_DISTRICTS_KEY = 'uploads/{id}/districts/{index}.json'
 UPLOAD_GEOMETRIES_KEY = 'uploads/{id}/geometries/{index}.wkt'
+UPLOAD_GEOMETRY_BUNDLE_KEY = 'uploads/{id}/geometries.bin'
 UPLOAD_TILE_INDEX_KEY = 'uploads/{id}/tiles.json'
+UPLOAD_TILE_DISTRICTS_KEY = 'uploads/{id}/tile-districts.json'
+UPLOAD_TILE_DISPATCH_KEY = 'uploads/{id}/dispatched.json'
 UPLOAD_TILES_KEY = 'uploads/{id}/tiles/{zxy}.json'
 UPLOAD_TIMING_KEY = 'uploads/{id}/timing.csv'
+UPLOAD_PROFILE_KEY = 'uploads/{id}/profile.json'
+MODEL_TIMINGS_KEY = '{prefix}/timings.json'
 UPLOAD_LOGENTRY_KEY = 'logs/ds={ds}/{guid}.txt'
 
 class State (enum.Enum):
@@ -1,6 +1,9 @@
 import os
 import csv
+import json
+import hashlib
 import gzip
+import functools
 import itertools
 import collections
 import argparse
@@ -70,12 +73,109 @@ Model = collections.namedtuple('Model', (
 def dropna(a):
     return a[~numpy.isnan(a)]
 
+MATRIX_DIR = os.path.join(os.path.dirname(__file__), 'model')
+
+# Matrix CSV files and their precompiled NumPy sidecars from compile_main()
+C_MATRIX_NAME, E_MATRIX_NAME = 'C_matrix_full', 'E_matrix_full'
+
+Matrix = collections.namedtuple('Matrix', ('rows', 'values'))
+
+def read_matrix_csv(path):
+    ''' Return Matrix with row names and values array parsed from CSV file.
+    '''
+    with gzip.open(path, 'rt') as file:
+        rows, values = [], []
+        for row in csv.DictReader(file):
+            rows.append(row[''])
+            values.append([float(value) for (col, value) in row.items() if col.startswith('V')])
+    
+    return Matrix(rows, numpy.array(values))
+
+def sidecar_paths(matrix_dir, name):
+    ''' Return paths to .npy row names and values and source JSON for a named matrix.
+    '''
+    return (
+        os.path.join(matrix_dir, f'{name}.rows.npy'),
+        os.path.join(matrix_dir, f'{name}.npy'),
+        os.path.join(matrix_dir, f'{name}.source.json'),
+    )
+
+def describe_source(path):
+    ''' Return dictionary with size and SHA-1 digest of a matrix CSV file.
+    '''
+    digest = hashlib.sha1()
+    
+    with open(path, 'rb') as file:
+        for chunk in iter(functools.partial(file.read, 1 << 20), b''):
+            digest.update(chunk)
+    
+    return dict(size=os.path.getsize(path), sha1=digest.hexdigest())
+
+def sidecars_fresh(csv_path, source_path):
+    ''' Return True if sidecars were written from the current matrix CSV file.
+    
+        Without a CSV file the sidecars are all there is, so they are used.
+    '''
+    if not os.path.exists(csv_path):
+        return True
+    
+    try:
+        with open(source_path) as file:
+            source = json.load(file)
+    except (FileNotFoundError, ValueError):
+        return False
+    
+    # Compare sizes first to skip hashing a CSV file that has obviously changed
+    if source.get('size') != os.path.getsize(csv_path):
+        return False
+    
+    return source == describe_source(csv_path)
+
+def read_matrix(matrix_dir, name):
+    ''' Return Matrix from memory-mapped .npy sidecar if fresh, CSV otherwise.
+    '''
+    csv_path = os.path.join(matrix_dir, f'{name}.csv.gz')
+    rows_path, values_path, source_path = sidecar_paths(matrix_dir, name)
+    
+    if os.path.exists(values_path) and os.path.exists(rows_path) \
+    and sidecars_fresh(csv_path, source_path):
+        rows = numpy.load(rows_path).tolist()
+        return Matrix(rows, numpy.load(values_path, mmap_mode='r'))
+    
+    matrix = read_matrix_csv(csv_path)
+    matrix.values.flags.writeable = False
+    return matrix
+
+@functools.lru_cache(maxsize=None)
+def load_matrices(matrix_dir):
+    ''' Return C and E Matrix tuples, loaded once per process and matrix_dir.
+    '''
+    return read_matrix(matrix_dir, C_MATRIX_NAME), read_matrix(matrix_dir, E_MATRIX_NAME)
+
+@functools.lru_cache(maxsize=None)
+def load_row_index(matrix_dir):
+    ''' Return dictionary of C matrix row numbers by name, built once per matrix_dir.
+    '''
+    c_matrix, _ = load_matrices(matrix_dir)
+    return {row: index for (index, row) in enumerate(c_matrix.rows)}
+
+def write_sidecars(matrix_dir):
+    ''' Write .npy sidecars next to matrix CSV files for faster loading.
+    '''
+    for name in (C_MATRIX_NAME, E_MATRIX_NAME):
+        csv_path = os.path.join(matrix_dir, f'{name}.csv.gz')
+        matrix = read_matrix_csv(csv_path)
+        rows_path, values_path, source_path = sidecar_paths(matrix_dir, name)
+        numpy.save(rows_path, numpy.array(matrix.rows, dtype=str))
+        numpy.save(values_path, matrix.values)
+        
+        with open(source_path, 'w') as file:
+            json.dump(describe_source(csv_path), file)
+
 def load_model(state, year):
     assert year is None, f'Year should be None, not {year}'
 
-    matrix_dir = os.path.join(os.path.dirname(__file__), 'model')
-    c_path = os.path.join(matrix_dir, 'C_matrix_full.csv.gz')
-    e_path = os.path.join(matrix_dir, 'E_matrix_full.csv.gz')
+    c_matrix, e_matrix = load_matrices(MATRIX_DIR)
     
     c_keys = (
         'b_Intercept', 'b_dpres_mn', 'b_incumb',
@@ -87,42 +187,27 @@ def load_model(state, year):
         #f'r_cycle[{year},incumb]',
     )
     
-    with gzip.open(c_path, 'rt') as c_file:
-        c_rows = {
-            c_row['']: [
-                float(c_value)
-                for (c_col, c_value) in c_row.items()
-                if c_col.startswith('V')
-            ]
-            for c_row in csv.DictReader(c_file)
-            if c_row[''] in c_keys
-        }
-    
-    with gzip.open(e_path, 'rt') as e_file:
-        e_rows = [
-            [
-                float(e_value)
-                for (e_col, e_value) in e_row.items()
-                if e_col.startswith('V')
-            ]
-            for e_row in csv.DictReader(e_file)
-        ]
-    
-    c_values = [c_rows[c_key] for c_key in c_keys]
-    args = c_values + [numpy.array(c_values), numpy.array(e_rows)]
+    c_rows = load_row_index(MATRIX_DIR)
+    c_values = c_matrix.values[[c_rows[c_key] for c_key in c_keys]]
+    args = list(c_values) + [c_values, e_matrix.values]
     
     return Model(*args)
 
+def model_inputs(districts):
+    ''' Return Dx6 array of model inputs for apply_model() districts.
+    '''
+    return numpy.array([
+        [1, numpy.nan if numpy.isnan(vote) else (vote + VOTE_ADJUST), incumbency] * 2
+        for (vote, incumbency)
+        in districts
+    ]).reshape((len(districts), 6))
+
 def apply_model(districts, model):
     ''' districts is an array of two-element tuples:
         - Democratic vote portion from 0. to 1.
         - -1 for Republican, 0 for open seat, and 1 for Democratic incumbents
     '''
-    AD = numpy.array([
-        [1, numpy.nan if numpy.isnan(vote) else (vote + VOTE_ADJUST), incumbency] * 2
-        for (vote, incumbency)
-        in districts
-    ])
+    AD = model_inputs(districts)
     
     ## TODO: remove print output unless running planscore-score-locally
     #
@@ -142,26 +227,30 @@ def apply_model(districts, model):
     #numpy.savetxt('ADCE.csv', (ADC + E), fmt='%.9f', delimiter=',')
     return ADC + E
 
-def model_votes(state, year, districts):
-    ''' Convert presidential votes to range of possible modeled chamber votes.
-        
-        state is from data.State enum, year is an integer.
-        districts is an array of three-element tuples:
-        - Input Democratic vote count
-        - Input Republican vote count
-        - Incumbency: "O" for open, "R", or "D"
-        
-        Return is a DxSx2 matrix for D districts, S simulations, and Dem/Rep parties.
+def apply_model_batch(plans, model):
+    ''' Apply model to a list of plans with a single matrix multiplication.
+    
+        plans is a list of apply_model() districts arrays, one for each plan.
+        Return is a list of DxS arrays matching apply_model() for each plan.
     '''
-    # Get DxS array from apply_model() with modeled vote fractions
-    fractions = apply_model(
-        [
-            (dem / ((dem + rep) or numpy.nan), INCUMBENCY[inc])
-            for (dem, rep, inc) in districts
-        ],
-        load_model(STATE[state], year),
-    )
+    AD = numpy.concatenate([model_inputs(districts) for districts in plans])
+    E = numpy.concatenate([model.e_matrix[:len(districts),:] for districts in plans])
+    ADCE = AD.dot(model.c_matrix) + E
     
+    offsets = numpy.cumsum([len(districts) for districts in plans])
+    return numpy.split(ADCE, offsets[:-1])
+
+def model_fractions(districts):
+    ''' Convert model_votes() districts to apply_model() districts.
+    '''
+    return [
+        (dem / ((dem + rep) or numpy.nan), INCUMBENCY[inc])
+        for (dem, rep, inc) in districts
+    ]
+
+def fractions_votes(fractions, districts):
+    ''' Convert DxS array of modeled vote fractions to DxSx2 array of votes.
+    '''
     # Make DxS array with total vote counts for each district and simulation
     total_votes = sum([dem + rep for (dem, rep, _) in districts])
     one_district_votes = total_votes / len(districts)
@@ -180,6 +269,39 @@ def model_votes(state, year, districts):
     
     return votes
 
+def model_votes(state, year, districts):
+    ''' Convert presidential votes to range of possible modeled chamber votes.
+        
+        state is from data.State enum, year is an integer.
+        districts is an array of three-element tuples:
+        - Input Democratic vote count
+        - Input Republican vote count
+        - Incumbency: "O" for open, "R", or "D"
+        
+        Return is a DxSx2 matrix for D districts, S simulations, and Dem/Rep parties.
+    '''
+    # Get DxS array from apply_model() with modeled vote fractions
+    fractions = apply_model(model_fractions(districts), load_model(STATE[state], year))
+    
+    return fractions_votes(fractions, districts)
+
+def model_votes_batch(state, year, plans):
+    ''' Convert presidential votes to modeled chamber votes for many plans.
+    
+        plans is a list of model_votes() districts arrays for the same state.
+        Return is a list of DxSx2 matrices matching model_votes() for each plan.
+    '''
+    # Get DxS arrays from apply_model_batch() with modeled vote fractions
+    all_fractions = apply_model_batch(
+        [model_fractions(districts) for districts in plans],
+        load_model(STATE[state], year),
+    )
+    
+    return [
+        fractions_votes(fractions, districts)
+        for (fractions, districts) in zip(all_fractions, plans)
+    ]
+
 def prepare_district_data(upload):
     ''' Simple presidential vote input for model_votes()
     '''
@@ -218,3 +340,13 @@ def main():
         out.writerow(['District'] + list(head))
         for (index, row) in enumerate(votes_matrix.tolist()):
             out.writerow([index + 1] + row)
+
+compile_parser = argparse.ArgumentParser(description='Write .npy sidecars for model matrix CSV files')
+compile_parser.add_argument('matrix_dir', nargs='?', default=MATRIX_DIR,
+    help=f'Directory with matrix CSV files. Default {MATRIX_DIR}.')
+
+def compile_main():
+    ''' Precompile matrix CSV files to memory-mappable .npy sidecars
+    '''
+    args = compile_parser.parse_args()
+    write_sidecars(args.matrix_dir)
@@ -1,12 +1,33 @@
 import os, time, json, posixpath, io, gzip, collections, copy, csv, uuid
-import boto3, botocore.exceptions
-from . import data, constants, tiles, score, compactness
+import boto3, botocore.exceptions, numpy
+from . import data, constants, tiles, score, compactness, prepare_state
 import osgeo.ogr
 
 FUNCTION_NAME = os.environ.get('FUNC_NAME_OBSERVE_TILES') or 'PlanScore-ObserveTiles'
 
 Tile = collections.namedtuple('Tile', ('totals', 'timing'))
 
+# Seconds to wait between sweeps for finished tiles
+TILE_SWEEP_INTERVAL = 1
+
+# Weight of each new upload's timing in model tile timing history
+TIMING_HISTORY_WEIGHT = .25
+
+# Tiles still missing after this many times their expected seconds are
+# dispatched again, see Stragglers
+STRAGGLER_FACTOR = 3
+STRAGGLER_MIN_SECONDS, STRAGGLER_UNKNOWN_SECONDS = 30, 120
+MAX_TILE_DISPATCHES = 2
+
+# Phases of tile scoring recorded by tiles.lambda_handler() with util.Profile
+TILE_PHASES = ('geometries', 'fetch', 'decompress', 'parse', 'setup', 'intersect', 'aggregate')
+TILE_COUNTS = ('precincts', 'vertices', 'cache_hits')
+TIMING_FIELDNAMES = ('tile_key', 'features', 'start_time', 'elapsed_time') \
+    + tuple(f'{phase}_time' for phase in TILE_PHASES) + TILE_COUNTS
+
+# Number of slowest tiles to list in upload profile
+PROFILE_SLOWEST_COUNT = 10
+
 def get_upload_index(storage, key):
     '''
     '''
@@ -37,7 +58,12 @@ def put_upload_index(storage, upload):
 
 def get_expected_tile(enqueued_key, upload):
     ''' Return an expect tile key for an enqueued one.
+    
+        A batch of enqueued keys is expected at the first key's output.
     '''
+    if type(enqueued_key) is list:
+        enqueued_key = enqueued_key[0]
+    
     return data.UPLOAD_TILES_KEY.format(id=upload.id,
         zxy=tiles.get_tile_zxy(upload.model.key_prefix, enqueued_key))
 
@@ -52,6 +78,13 @@ def get_district_index(geometry_key, upload):
 def load_upload_geometries(storage, upload):
     ''' Get ordered list of OGR geometries for an upload.
     '''
+    bundle = tiles.load_geometry_bundle(storage, upload)
+    
+    if bundle is not None:
+        geometries = tiles.read_geometry_bundle(bundle)
+        return [geom for (key, geom) in sorted(geometries.items(),
+            key=lambda item: get_district_index(item[0], upload))]
+    
     geometries = {}
     
     geoms_prefix = posixpath.dirname(data.UPLOAD_GEOMETRIES_KEY).format(id=upload.id)
@@ -79,48 +112,96 @@ def populate_compactness(geometries):
     
     return districts
 
-def iterate_tile_totals(expected_tiles, storage, upload, context):
+def list_finished_tiles(storage, prefix):
+    ''' Return set of all tile result keys currently under a prefix.
+    '''
+    marker, keys = '', set()
+    
+    while True:
+        response = storage.s3.list_objects(Bucket=storage.bucket,
+            Prefix=prefix, Marker=marker)
+        
+        contents = response.get('Contents', [])
+        keys.update(object['Key'] for object in contents)
+        
+        if not response.get('IsTruncated') or not contents:
+            break
+        
+        marker = contents[-1]['Key']
+    
+    return keys
+
+def load_tiles(storage, tile_key):
+    ''' Get list of finished Tiles from one result, which may hold a batch.
     '''
+    object = storage.s3.get_object(Bucket=storage.bucket, Key=tile_key)
+
+    if object.get('ContentEncoding') == 'gzip':
+        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+
+    content = json.load(object['Body'])
+    
+    if 'tiles' in content:
+        return [Tile(tile.get('totals'), tile.get('timing', {})) for tile in content['tiles']]
+    
+    return [Tile(content.get('totals'), content.get('timing', {}))]
+
+def iterate_tile_totals(expected_tiles, storage, upload, context, district_totals=None, stragglers=None):
+    ''' Generate Tiles in the order they finish.
+    
+        Each sweep lists every tile result under the upload prefix at once,
+        so one slow tile does not hold up reading tiles that finished after it.
+        
+        Optional district_totals is a DistrictTotals that each tile is added
+        to on arrival. Only progress is published along the way, because
+        partial totals are large to write and misleading to show.
+        Optional stragglers is a Stragglers checked after every sweep.
     '''
     next_update = time.time()
-
-    # Look for each expected tile in turn
-    for (index, expected_tile) in enumerate(expected_tiles):
-        progress = data.Progress(index, len(expected_tiles))
-        upload = upload.clone(progress=progress,
+    remaining_tiles = list(expected_tiles)
+    prefix = posixpath.commonprefix(expected_tiles)
+    
+    while remaining_tiles:
+        progress = data.Progress(len(expected_tiles) - len(remaining_tiles), len(expected_tiles))
+        progress_upload = upload.clone(progress=progress,
             message='Scoring this newly-uploaded plan. {} complete.'
                 ' Reload this page to see the result.'.format(progress.to_percentage()))
 
         # Update S3, if it's time
         if time.time() > next_update:
             print('iterate_tile_totals: {}/{} tiles complete'.format(*progress.to_list()))
-            put_upload_index(storage, upload)
+            put_upload_index(storage, progress_upload)
             next_update = time.time() + 1
 
-        # Wait for one expected tile
-        while True:
-            try:
-                object = storage.s3.get_object(Bucket=storage.bucket, Key=expected_tile)
-            except botocore.exceptions.ClientError:
-                # Did not find the expected tile, wait a little before checking
-                time.sleep(3)
-            else:
-                if object.get('ContentEncoding') == 'gzip':
-                    object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+        # Sweep for all finished tiles
+        finished_keys = list_finished_tiles(storage, prefix)
+        finished_tiles = [key for key in remaining_tiles if key in finished_keys]
         
-                content = json.load(object['Body'])
-                yield Tile(content.get('totals'), content.get('timing', {}))
+        for expected_tile in finished_tiles:
+            for tile in load_tiles(storage, expected_tile):
+                if district_totals is not None:
+                    district_totals.add_tile(tile, upload)
             
-                # Found the expected tile, break out of this loop
-                break
+                yield tile
+        
+        remaining_tiles = [key for key in remaining_tiles if key not in finished_keys]
+        
+        if stragglers is not None:
+            stragglers.redispatch(remaining_tiles)
+        
+        if finished_tiles:
+            continue
 
-            remain_msec = context.get_remaining_time_in_millis()
+        remain_msec = context.get_remaining_time_in_millis()
 
-            if remain_msec < 5000:
-                # Out of time, just stop
-                overdue_upload = upload.clone(status=False, message="Giving up on this plan after it took too long, sorry.")
-                put_upload_index(storage, overdue_upload)
-                return
+        if remain_msec < 5000:
+            # Out of time, just stop
+            overdue_upload = progress_upload.clone(status=False, message="Giving up on this plan after it took too long, sorry.")
+            put_upload_index(storage, overdue_upload)
+            return
+        
+        # Found no new tiles, wait a little before checking again
+        time.sleep(TILE_SWEEP_INTERVAL)
 
     print('iterate_tile_totals: all tiles complete')
 
@@ -130,7 +211,7 @@ def put_tile_timings(storage, upload, tiles):
     key = data.UPLOAD_TIMING_KEY.format(id=upload.id)
     
     buffer = io.StringIO()
-    out = csv.DictWriter(buffer, ('features', 'start_time', 'elapsed_time'))
+    out = csv.DictWriter(buffer, TIMING_FIELDNAMES)
     out.writeheader()
     
     for tile in tiles:
@@ -139,47 +220,291 @@ def put_tile_timings(storage, upload, tiles):
     storage.s3.put_object(Bucket=storage.bucket, Key=key,
         Body=buffer.getvalue(), ContentType='text/csv', ACL='public-read')
 
-def accumulate_district_totals(tile_totals, upload):
-    ''' Return new district array for an upload, preserving existing values.
+def upload_profile(upload, upload_tiles):
+    ''' Return a dictionary summarizing where scoring time went for an upload.
+    
+        Phase seconds are added up over all tiles, and the critical path is
+        the tile that finished last, which held up the whole upload.
+    '''
+    timings = [tile.timing for tile in upload_tiles if tile.timing.get('elapsed_time') is not None]
+    
+    if not timings:
+        return dict(tiles=0)
+    
+    def tile_summary(timing):
+        summary = {key: timing.get(key) for key in ('tile_key', 'elapsed_time') + TILE_COUNTS}
+        summary.update(zxy=tiles.get_tile_zxy(upload.model.key_prefix, timing['tile_key'])
+            if timing.get('tile_key') else None)
+        summary.update(phases={phase: timing.get(f'{phase}_time', 0) for phase in TILE_PHASES})
+        return summary
+    
+    first_start = min(timing['start_time'] for timing in timings)
+    critical = max(timings, key=lambda timing: timing['start_time'] + timing['elapsed_time'])
+    slowest = sorted(timings, key=lambda timing: timing['elapsed_time'], reverse=True)
+    total_seconds = sum(timing['elapsed_time'] for timing in timings)
+    
+    phases = {phase: round(sum(timing.get(f'{phase}_time', 0) for timing in timings), 3)
+        for phase in TILE_PHASES}
+    
+    # Whatever the phases don't cover, such as writing results
+    phases['other'] = round(total_seconds - sum(phases.values()), 3)
+    
+    return dict(
+        tiles=len(timings),
+        total_seconds=round(total_seconds, 3),
+        wall_seconds=round(critical['start_time'] + critical['elapsed_time'] - first_start, 3),
+        phases=phases,
+        phase_shares={phase: round(seconds / total_seconds, 4) if total_seconds else 0
+            for (phase, seconds) in phases.items()},
+        counts={name: sum(timing.get(name) or 0 for timing in timings) for name in TILE_COUNTS},
+        critical_path=dict(tile_summary(critical),
+            start_offset=round(critical['start_time'] - first_start, 3)),
+        slowest_tiles=[tile_summary(timing) for timing in slowest[:PROFILE_SLOWEST_COUNT]],
+    )
+
+def put_upload_profile(storage, upload, upload_tiles):
+    ''' Write a JSON report on where scoring time went
+    '''
+    key = data.UPLOAD_PROFILE_KEY.format(id=upload.id)
+    body = json.dumps(upload_profile(upload, upload_tiles), indent=2)
+    
+    storage.s3.put_object(Bucket=storage.bucket, Key=key,
+        Body=body.encode('utf8'), ContentType='text/json', ACL='public-read')
+
+def load_tile_districts(storage, upload):
+    ''' Get dictionary of district geometry keys by model tile key, or None.
+    
+        Older uploads have no saved tile districts, so every district is scored.
+    '''
+    key = data.UPLOAD_TILE_DISTRICTS_KEY.format(id=upload.id)
+    
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    
+    return json.load(object['Body'])
+
+def load_dispatch_times(storage, upload):
+    ''' Get dictionary of RunTile invocation times by first tile key, or None.
+    
+        Times are saved by postread_calculate.fan_out_tile_lambdas() once
+        every tile has been invoked, so they are missing until then.
+    '''
+    key = data.UPLOAD_TILE_DISPATCH_KEY.format(id=upload.id)
+    
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+    
+    return json.load(object['Body'])
+
+def load_model_timings(storage, model):
+    ''' Get dictionary of expected tile seconds by zxy from earlier uploads, or empty.
+    '''
+    key = data.MODEL_TIMINGS_KEY.format(prefix=model.key_prefix.rstrip('/'))
+    
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            # No uploads have finished for this model yet
+            return {}
+        raise
+    
+    return json.load(object['Body'])
+
+def put_model_timings(storage, upload, upload_tiles):
+    ''' Fold this upload's tile timings into the model's timing history.
+    
+        Each tile's expected seconds is a moving average of elapsed times
+        from the same rows written to timing.csv by put_tile_timings().
+        
+        This read-modify-write of one shared object is not locked, so when
+        uploads for the same model finish together the last writer wins and
+        the others' samples are lost. That's acceptable here: timings only
+        order tiles and set straggler deadlines, and later uploads keep
+        pulling the averages toward real times. Every sample is also kept
+        in each upload's own timing.csv.
     '''
-    districts = []
+    timings = load_model_timings(storage, upload.model)
     
-    # copy districts from the upload
-    for upload_district in upload.districts:
-        # use a defaultdict to accept new values
-        totals = collections.defaultdict(float)
+    for tile in upload_tiles:
+        tile_key, elapsed = tile.timing.get('tile_key'), tile.timing.get('elapsed_time')
+        
+        if tile_key is None or elapsed is None:
+            continue
+        
+        zxy = tiles.get_tile_zxy(upload.model.key_prefix, tile_key)
         
-        if upload_district is None:
-            # initialize a new district
-            new_district = dict(totals=totals)
+        if zxy in timings:
+            timings[zxy] += TIMING_HISTORY_WEIGHT * (elapsed - timings[zxy])
         else:
-            # use a copy of existing district to preserve values
-            new_district = copy.deepcopy(upload_district)
-            new_district['totals'] = totals
+            timings[zxy] = elapsed
+        
+        timings[zxy] = round(timings[zxy], 3)
+    
+    storage.s3.put_object(Bucket=storage.bucket,
+        Key=data.MODEL_TIMINGS_KEY.format(prefix=upload.model.key_prefix.rstrip('/')),
+        Body=json.dumps(timings, sort_keys=True).encode('utf8'),
+        ContentType='text/json', ACL='public-read')
+
+class Stragglers:
+    ''' Dispatches RunTile again for tiles taking much longer than expected.
+    
+        Both dispatches write the same result key, so whichever lands first
+        is the one that iterate_tile_totals() reads. Second dispatches get
+        the same districts as the first from optional tile_districts, and
+        don't leave results behind once the upload is finished.
+        
+        Each tile's clock starts when it was invoked, or when the first
+        result of all arrived if that was later, so time spent waiting for
+        fan-out or in Lambda's queue of async events is not counted.
+    '''
+    def __init__(self, storage, upload, enqueued_tiles, model_timings, lam=None, tile_districts=None):
+        self.storage, self.upload, self.lam = storage, upload, lam
+        self.tile_districts = tile_districts
+        self.dispatch_times, self.first_result_time = None, None
+        self.enqueued, self.deadlines = {}, {}
+        self.dispatches = collections.Counter()
+        
+        for enqueued_key in enqueued_tiles:
+            expected_tile = get_expected_tile(enqueued_key, upload)
+            tile_keys = enqueued_key if type(enqueued_key) is list else [enqueued_key]
+            zxys = [tiles.get_tile_zxy(upload.model.key_prefix, key) for key in tile_keys]
+            
+            if all(zxy in model_timings for zxy in zxys):
+                expected = sum(model_timings[zxy] for zxy in zxys)
+                deadline = max(STRAGGLER_MIN_SECONDS, STRAGGLER_FACTOR * expected)
+            else:
+                deadline = STRAGGLER_UNKNOWN_SECONDS
+            
+            self.enqueued[expected_tile] = enqueued_key
+            self.deadlines[expected_tile] = deadline
+            self.dispatches[expected_tile] = 1
+    
+    def redispatch(self, remaining_tiles):
+        ''' Invoke RunTile again for overdue tiles, return list of their expected keys.
+        '''
+        now, overdue = time.time(), []
+        
+        if self.first_result_time is None and len(remaining_tiles) < len(self.deadlines):
+            self.first_result_time = now
+        
+        if self.dispatch_times is None:
+            self.dispatch_times = load_dispatch_times(self.storage, self.upload)
+        
+        if self.first_result_time is None or self.dispatch_times is None:
+            # Tiles are still being invoked or waiting in Lambda's queue
+            return overdue
+        
+        for expected_tile in remaining_tiles:
+            dispatches = self.dispatches[expected_tile]
+            
+            if dispatches >= MAX_TILE_DISPATCHES or expected_tile not in self.deadlines:
+                continue
             
-            # copy existing totals, if any exist
-            if 'totals' in upload_district:
-                new_district['totals'].update(upload_district['totals'])
+            # Tiles that fan-out gave up on start with the first result
+            enqueued_key = self.enqueued[expected_tile]
+            first_key = enqueued_key[0] if type(enqueued_key) is list else enqueued_key
+            start_time = max(self.dispatch_times.get(first_key, 0), self.first_result_time)
+            elapsed = now - start_time
+            
+            if elapsed < self.deadlines[expected_tile] * dispatches:
+                continue
+            
+            if self.lam is None:
+                self.lam = boto3.client('lambda')
+            
+            print('Stragglers.redispatch:', expected_tile, 'after', round(elapsed), 'seconds')
+            self.lam.invoke(FunctionName=tiles.FUNCTION_NAME, InvocationType='Event',
+                Payload=tiles.tile_payload(self.storage, self.upload, self.enqueued[expected_tile],
+                    self.tile_districts, redispatched=True))
+            
+            self.dispatches[expected_tile] += 1
+            overdue.append(expected_tile)
+        
+        return overdue
 
-        districts.append(new_district)
+class DistrictTotals:
+    ''' Running sums of tile totals in a district × field NumPy array.
     
-    # update districts with tile totals
-    for tile_total in tile_totals:
-        if type(tile_total.totals) is str:
+        Tiles are folded in one at a time as they arrive, so memory stays
+        bounded by the number of districts and fields instead of tiles.
+    '''
+    def __init__(self, district_count):
+        all_names = score.FIELD_NAMES + (prepare_state.HOUSEHOLD_SUM_FIELD, )
+        self.columns = {name: column for (column, name) in enumerate(all_names)}
+        self.sums = numpy.zeros((district_count, len(self.columns)))
+        self.seen = numpy.zeros(self.sums.shape, dtype=bool)
+    
+    def add_column(self, name):
+        ''' Make room for a field name that was not known ahead of time.
+        '''
+        self.columns[name] = len(self.columns)
+        self.sums = numpy.hstack((self.sums, numpy.zeros((len(self.sums), 1))))
+        self.seen = numpy.hstack((self.seen, numpy.zeros((len(self.seen), 1), dtype=bool)))
+    
+    def add_tile(self, tile, upload):
+        ''' Add one Tile's totals to running district sums.
+        '''
+        if type(tile.totals) is str:
             # Not unheard-of, this is where errors get stashed for now
-            print('weird tile:', repr(tile_total.totals))
-            continue
+            print('weird tile:', repr(tile.totals))
+            return
+        
+        for (geometry_key, input_values) in tile.totals.items():
+            row = get_district_index(geometry_key, upload)
             
-        for (geometry_key, input_values) in tile_total.totals.items():
-            geometry_index = get_district_index(geometry_key, upload)
-            district = districts[geometry_index]['totals']
-            for (key, value) in input_values.items():
-                district[key] = round(district[key] + value, constants.ROUND_COUNT)
+            for name in input_values:
+                if name not in self.columns:
+                    self.add_column(name)
+            
+            columns = [self.columns[name] for name in input_values]
+            self.sums[row, columns] += list(input_values.values())
+            self.seen[row, columns] = True
     
-    for district in districts:
-        district['totals'] = adjust_household_income(district['totals'])
+    def districts(self, upload):
+        ''' Return new district array for an upload, preserving existing values.
+        '''
+        names = sorted(self.columns, key=self.columns.get)
+        districts = []
+        
+        for (row, upload_district) in enumerate(upload.districts):
+            if upload_district is None:
+                # initialize a new district
+                new_district, totals = {}, {}
+            else:
+                # use a copy of existing district to preserve values
+                new_district = {key: copy.deepcopy(value)
+                    for (key, value) in upload_district.items() if key != 'totals'}
+                totals = dict(upload_district.get('totals', {}))
+            
+            sums = self.sums[row].tolist()
+            
+            for column in numpy.flatnonzero(self.seen[row]).tolist():
+                name = names[column]
+                totals[name] = round(totals.get(name, 0) + sums[column], constants.ROUND_COUNT)
+            
+            new_district['totals'] = adjust_household_income(totals)
+            districts.append(new_district)
+        
+        return districts
+
+def accumulate_district_totals(tile_totals, upload):
+    ''' Return new district array for an upload, preserving existing values.
+    '''
+    district_totals = DistrictTotals(len(upload.districts))
     
-    return districts
+    for tile_total in tile_totals:
+        district_totals.add_tile(tile_total, upload)
+    
+    return district_totals.districts(upload)
 
 def adjust_household_income(input_totals):
     '''
@@ -217,17 +542,24 @@ def lambda_handler(event, context):
     expected_tiles = [get_expected_tile(tile_key, upload1)
         for tile_key in enqueued_tiles]
     
+    model_timings = load_model_timings(storage, upload1.model)
+    tile_districts = load_tile_districts(storage, upload1)
+    stragglers = Stragglers(storage, upload1, enqueued_tiles, model_timings, tile_districts=tile_districts)
+    
     geometries = load_upload_geometries(storage, upload1)
     upload2 = upload1.clone(districts=populate_compactness(geometries))
-    tiles = list(iterate_tile_totals(expected_tiles, storage, upload2, context))
+    district_totals = DistrictTotals(len(upload2.districts))
+    
+    # Keep only timing from each tile, totals are added up as they arrive
+    tiles = [Tile(None, tile.timing) for tile in iterate_tile_totals(
+        expected_tiles, storage, upload2, context, district_totals, stragglers)]
 
     put_upload_index(storage, upload2.clone(
         message='Scoring this newly-uploaded plan.'
             ' Adding up votes. Reload this page to see the result.'
             ))
 
-    districts = accumulate_district_totals(tiles, upload2)
-    upload3 = upload2.clone(districts=districts)
+    upload3 = upload2.clone(districts=district_totals.districts(upload2))
     upload4 = score.calculate_bias(upload3)
     upload5 = score.calculate_open_biases(upload4)
     upload6 = score.calculate_biases(upload5)
@@ -241,4 +573,6 @@ def lambda_handler(event, context):
 
     put_upload_index(storage, complete_upload)
     put_tile_timings(storage, upload2, tiles)
+    put_model_timings(storage, upload2, tiles)
+    put_upload_profile(storage, upload2, tiles)
     clean_up_tiles(storage, expected_tiles)
@@ -3,8 +3,8 @@
 Fans out asynchronous parallel calls to planscore.district function, then
 starts and observer process with planscore.score function.
 '''
-import os, io, json, urllib.parse, gzip, functools, time, math, threading
-import boto3, osgeo.ogr
+import os, io, json, urllib.parse, gzip, functools, itertools, time, math, threading, collections
+import boto3, botocore.exceptions, osgeo.ogr, numpy
 from . import util, data, score, website, prepare_state, constants, tiles, observe
 
 FUNCTION_NAME = os.environ.get('FUNC_NAME_POSTREAD_CALCULATE') or 'PlanScore-PostreadCalculate'
@@ -68,45 +68,132 @@ def commence_geometry_upload_scoring(s3, bucket, upload, ds_path):
     storage = data.Storage(s3, bucket, upload.model.key_prefix)
     observe.put_upload_index(storage, upload)
     upload2 = upload.clone(geometry_key=data.UPLOAD_GEOMETRY_KEY.format(id=upload.id))
-    geometry_keys = put_district_geometries(s3, bucket, upload2, ds_path)
+    geometries = read_district_geometries(ds_path)
+    geometry_keys = put_district_geometries(s3, bucket, upload2, geometries)
     
     # New tile-based method comes first to preserve user experience
-    tile_keys = load_model_tiles(storage, upload2.model)
-    start_tile_observer_lambda(storage, upload2, tile_keys)
-    fan_out_tile_lambdas(storage, upload2, tile_keys)
+    model_tile_keys = load_model_tiles(storage, upload2.model)
+    tile_districts = index_tile_districts(upload2.model, model_tile_keys,
+        geometry_keys, geometries)
+    
+    # Only tiles touching at least one district need to be scored
+    tile_keys = [key for key in model_tile_keys if tile_districts[key]]
+    
+    if constants.TILE_BATCH_SIZE > 1:
+        # Send groups of similarly-sized tiles to each RunTile invocation
+        tile_keys = batch_tile_keys(tile_keys, constants.TILE_BATCH_SIZE)
+    
+    start_tile_observer_lambda(storage, upload2, tile_keys, tile_districts)
+    fan_out_tile_lambdas(storage, upload2, tile_keys, tile_districts)
 
 def commence_blockassign_upload_scoring(s3, bucket, upload, file_path):
     raise NotImplementedError('Block assignment files are not supported at this time')
 
-def put_district_geometries(s3, bucket, upload, path):
-    '''
+def read_district_geometries(path):
+    ''' Return list of ordered district OGR geometries in EPSG:4326.
     '''
-    print('put_district_geometries:', (bucket, path))
     ds = osgeo.ogr.Open(path)
-    keys = []
+    geometries = []
 
     if not ds:
         raise RuntimeError('Could not open file to fan out district invocations')
 
     _, features = ordered_districts(ds.GetLayer(0))
     
-    for (index, feature) in enumerate(features):
+    for feature in features:
         geometry = feature.GetGeometryRef() or EMPTY_GEOMETRY
 
         if geometry.GetSpatialReference():
             geometry.TransformTo(prepare_state.EPSG4326)
         
-        key = data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index)
-        
-        s3.put_object(Bucket=bucket, Key=key, ACL='bucket-owner-full-control',
-            Body=geometry.ExportToWkt(), ContentType='text/plain')
-        
-        keys.append(key)
+        # Clone so geometry outlives its feature and datasource
+        geometries.append(geometry.Clone())
+    
+    return geometries
+
+def put_district_geometries(s3, bucket, upload, geometries):
+    ''' Upload a single bundle of district geometries, return their keys.
+    
+        geometries is a list from read_district_geometries(). Keys name
+        each district within the bundle from tiles.geometry_bundle().
+    '''
+    print('put_district_geometries:', (bucket, len(geometries)))
+    keys = [data.UPLOAD_GEOMETRIES_KEY.format(id=upload.id, index=index)
+        for index in range(len(geometries))]
+    
+    s3.put_object(Bucket=bucket, ACL='bucket-owner-full-control',
+        Key=data.UPLOAD_GEOMETRY_BUNDLE_KEY.format(id=upload.id),
+        Body=tiles.geometry_bundle(keys, geometries),
+        ContentType='application/octet-stream')
     
     return keys
 
-def load_model_tiles(storage, model):
+def index_tile_districts(model, tile_keys, geometry_keys, geometries):
+    ''' Return dictionary of overlapping district geometry keys for each tile key.
+    
+        Envelopes of all districts and tiles are compared at once in arrays,
+        then only candidate pairs are checked for real intersection.
     '''
+    tile_geoms = [tiles.tile_geometry(tiles.get_tile_zxy(model.key_prefix, tile_key))
+        for tile_key in tile_keys]
+    
+    if not tile_geoms or not geometries:
+        return {tile_key: [] for tile_key in tile_keys}
+
+    # Envelopes are (xmin, xmax, ymin, ymax) arrays of shape Dx4 and Tx4
+    district_envs = numpy.array([geom.GetEnvelope() for geom in geometries])
+    tile_envs = numpy.array([geom.GetEnvelope() for geom in tile_geoms])
+    
+    # Boolean TxD array of overlapping envelopes
+    candidates = (
+        (tile_envs[:,0:1] <= district_envs[:,1])
+        & (tile_envs[:,1:2] >= district_envs[:,0])
+        & (tile_envs[:,2:3] <= district_envs[:,3])
+        & (tile_envs[:,3:4] >= district_envs[:,2])
+    )
+    
+    tile_districts = {}
+    
+    for (tile_index, tile_key) in enumerate(tile_keys):
+        tile_geom = tile_geoms[tile_index]
+        tile_districts[tile_key] = [
+            geometry_keys[district_index]
+            for district_index in numpy.flatnonzero(candidates[tile_index])
+            if not geometries[district_index].IsEmpty()
+            and geometries[district_index].Intersects(tile_geom)
+        ]
+    
+    print('index_tile_districts:', len([k for (k, v) in tile_districts.items() if v]),
+        'of', len(tile_keys), 'tiles overlap', len(geometry_keys), 'districts')
+
+    return tile_districts
+
+def load_tile_costs(storage, model):
+    ''' Get dictionary of scoring costs by tile zxy from prepare_state, or empty.
+    '''
+    # Model key prefixes like "data/XX/006-tilesdir" hold the prepare_state directory
+    directory = model.key_prefix.rstrip('/')[len('data/'):]
+    key = prepare_state.COSTS_KEY_FORMAT.format(directory=directory)
+    
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            # Older models have no cost manifest
+            return {}
+        raise
+
+    if object.get('ContentEncoding') == 'gzip':
+        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+    
+    return json.load(object['Body'])
+
+def load_model_tiles(storage, model):
+    ''' Return list of model tile keys, slowest first.
+    
+        Expected seconds come from timings of earlier uploads where available,
+        then from the prepare_state cost manifest, with tile object sizes used
+        for tiles neither one lists.
     '''
     prefix = '{}/tiles/'.format(model.key_prefix.rstrip('/'))
     marker, contents = '', []
@@ -124,54 +211,147 @@ def load_model_tiles(storage, model):
         
         marker = contents[-1]['Key']
     
-    # Sort largest items first
-    contents.sort(key=lambda obj: obj['Size'], reverse=True)
+    tile_costs = load_tile_costs(storage, model)
+    tile_timings = observe.load_model_timings(storage, model)
+    
+    def expected_seconds(tile_zxy):
+        if tile_zxy in tile_timings:
+            return tile_timings[tile_zxy]
+        return tile_costs.get(tile_zxy, 0) * TILE_COST_SECONDS
+    
+    # Sort slowest items first, then largest
+    contents.sort(reverse=True, key=lambda obj: (expected_seconds(
+        tiles.get_tile_zxy(model.key_prefix, obj['Key'])), obj['Size']))
     return [object['Key'] for object in contents][:constants.MAX_TILES_RUN]
 
-def fan_out_tile_lambdas(storage, upload, tile_keys):
+def batch_tile_keys(tile_keys, batch_size):
+    ''' Return lists of up to batch_size tile keys.
+    
+        Tile keys from load_model_tiles() are sorted by cost, so neighbors
+        in each batch have similar costs and batches take similar times.
     '''
+    return [tile_keys[start:start + batch_size]
+        for start in range(0, len(tile_keys), batch_size)]
+
+# Approximate seconds to score a tile per unit of prepare_state.tile_cost()
+TILE_COST_SECONDS = prepare_state.MAX_TILE_SECONDS / prepare_state.MAX_TILE_COST
+
+# Lambda error codes that mean slow down, see fan_out_tile_lambdas()
+THROTTLE_ERROR_CODES = {'TooManyRequestsException', 'ThrottlingException',
+    'EC2ThrottledException', 'ENILimitReachedException'}
+MIN_FAN_OUT_DELAY, MAX_FAN_OUT_DELAY = .05, 5 # seconds
+
+FanOutReport = collections.namedtuple('FanOutReport', ('invoked', 'retried', 'failed', 'elapsed'))
+
+class FanOutDelay:
+    ''' Shared delay between invocations, grown when throttled and shrunk after success.
     '''
-    def invoke_lambda(tile_keys, upload, storage):
-        '''
-        '''
-        lam = boto3.client('lambda')
+    def __init__(self):
+        self.seconds, self._lock = 0, threading.Lock()
+    
+    def throttled(self):
+        with self._lock:
+            self.seconds = min(MAX_FAN_OUT_DELAY, max(MIN_FAN_OUT_DELAY, self.seconds * 2))
+    
+    def succeeded(self):
+        with self._lock:
+            self.seconds = self.seconds / 2 if self.seconds > MIN_FAN_OUT_DELAY else 0
+
+def fan_out_tile_lambdas(storage, upload, tile_keys, tile_districts=None,
+        lam=None, concurrency=None, attempts=None):
+    ''' Invoke a RunTile Lambda for each tile key or list of tile keys.
+    
+        Optional tile_districts from index_tile_districts() limits each tile
+        to just the district geometry keys that overlap it. Invocations run
+        in a bounded pool of threads; failures are retried, and throttling
+        slows down every thread. Returns a FanOutReport.
         
+        When all invocations are done, the time each tile key or batch was
+        invoked is saved for Stragglers in ObserveTiles, keyed by first tile.
+    '''
+    lam = lam or boto3.client('lambda')
+    concurrency = concurrency or constants.FAN_OUT_CONCURRENCY
+    attempts = attempts or constants.FAN_OUT_ATTEMPTS
+    pending_keys, delay = collections.deque(tile_keys), FanOutDelay()
+    counts, counts_lock = collections.Counter(), threading.Lock()
+    dispatch_times = {}
+    
+    def invoke_lambda():
         while True:
             try:
-                tile_key = tile_keys.pop(0)
+                tile_key = pending_keys.popleft()
             except IndexError:
                 break
-
-            payload = dict(upload=upload.to_dict(), storage=storage.to_event(),
-                tile_key=tile_key)
             
-            lam.invoke(FunctionName=tiles.FUNCTION_NAME, InvocationType='Event',
-                Payload=json.dumps(payload).encode('utf8'))
+            payload = tiles.tile_payload(storage, upload, tile_key, tile_districts)
+            
+            for attempt in range(attempts):
+                if delay.seconds:
+                    time.sleep(delay.seconds)
+                
+                try:
+                    lam.invoke(FunctionName=tiles.FUNCTION_NAME,
+                        InvocationType='Event', Payload=payload)
+                except botocore.exceptions.ClientError as error:
+                    if error.response['Error']['Code'] in THROTTLE_ERROR_CODES:
+                        delay.throttled()
+                    error_code = error.response['Error']['Code']
+                except botocore.exceptions.BotoCoreError as error:
+                    error_code = type(error).__name__
+                else:
+                    delay.succeeded()
+                    with counts_lock:
+                        counts['invoked'] += 1
+                        first_key = tile_key[0] if type(tile_key) is list else tile_key
+                        dispatch_times[first_key] = round(time.time(), 3)
+                    break
+                
+                with counts_lock:
+                    counts['retried' if attempt + 1 < attempts else 'failed'] += 1
+            else:
+                print('fan_out_tile_lambdas: gave up on', tile_key, 'after', error_code)
     
     threads, start_time = [], time.time()
     
-    print('fan_out_tile_lambdas: starting threads for',
-        len(tile_keys), 'tile_keys from', upload.model.key_prefix)
+    print('fan_out_tile_lambdas: starting', concurrency, 'threads for',
+        len(pending_keys), 'tile_keys from', upload.model.key_prefix)
 
-    for i in range(8):
-        threads.append(threading.Thread(target=invoke_lambda,
-            args=(tile_keys, upload, storage)))
-        
+    for i in range(concurrency):
+        threads.append(threading.Thread(target=invoke_lambda))
         threads[-1].start()
 
     for thread in threads:
         thread.join()
+    
+    storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
+        Key=data.UPLOAD_TILE_DISPATCH_KEY.format(id=upload.id),
+        Body=json.dumps(dispatch_times).encode('utf8'))
+    
+    elapsed = time.time() - start_time
+    report = FanOutReport(counts['invoked'], counts['retried'], counts['failed'], elapsed)
 
-    print('fan_out_tile_lambdas: completed threads after',
-        int(time.time() - start_time), 'seconds.')
+    print('fan_out_tile_lambdas: completed {invoked} invocations with {retried} retries'
+        ' and {failed} failures after {elapsed:.1f} seconds,'.format(**report._asdict()),
+        '{:.0f} per second.'.format(report.invoked / max(elapsed, .001)))
+    
+    return report
 
-def start_tile_observer_lambda(storage, upload, tile_keys):
-    '''
+def start_tile_observer_lambda(storage, upload, tile_keys, tile_districts=None):
+    ''' Save tile keys to observe and invoke ObserveTiles.
+    
+        Optional tile_districts from index_tile_districts() is saved for the
+        tiles being scored, so tiles dispatched again get the same districts.
     '''
     storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
         Key=data.UPLOAD_TILE_INDEX_KEY.format(id=upload.id),
         Body=json.dumps(tile_keys).encode('utf8'))
     
+    if tile_districts is not None:
+        scored_keys = itertools.chain(*[key if type(key) is list else [key] for key in tile_keys])
+        storage.s3.put_object(Bucket=storage.bucket, ACL='bucket-owner-full-control',
+            Key=data.UPLOAD_TILE_DISTRICTS_KEY.format(id=upload.id),
+            Body=json.dumps({key: tile_districts[key] for key in scored_keys}).encode('utf8'))
+    
     lam = boto3.client('lambda')
 
     payload = dict(upload=upload.to_dict(), storage=storage.to_event())
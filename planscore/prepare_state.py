@@ -1,20 +1,48 @@
-import argparse, math, itertools, io, gzip, os, json, tempfile, operator
+import argparse, math, itertools, io, gzip, os, json, tempfile, struct, collections
+import concurrent.futures, hashlib, mmap, array, collections.abc
 from osgeo import ogr, osr
-import boto3, ModestMaps.Geo, ModestMaps.Core
-from . import constants
+import boto3, botocore.exceptions, ModestMaps.Geo, ModestMaps.Core, numpy
+from . import constants, score
 
 ogr.UseExceptions()
 
 TILE_ZOOM = 12
-MAX_FEATURE_COUNT = 4000 # max ~10sec processing time per tile
+MAX_FEATURE_COUNT = 4000 # features per slice file
+MAX_TILE_SECONDS = 10 # target processing time per tile
+MAX_TILE_COST = 400000 # ~4,000 typical features in MAX_TILE_SECONDS, see tile_cost()
+FEATURE_COST, VALUE_COST = 25, .002 # vertex-equivalent costs per feature and property value
 MIN_TILE_ZOOM, MAX_TILE_ZOOM = 7, 14
 INDEX_FIELD = 'PlanScore:Index'
 FRACTION_FIELD = 'PlanScore:Fraction'
+HOUSEHOLD_INCOME_FIELD = 'Household Income 2016'
+HOUSEHOLDS_FIELD = 'Households 2016'
+HOUSEHOLD_SUM_FIELD = 'Sum Household Income 2016'
 TILE_KEY_FORMAT = 'data/{directory}/tiles/{zxy}.geojson'
+TOTALS_KEY_FORMAT = 'data/{directory}/totals/{zxy}.json'
+BINARY_TILE_KEY_FORMAT = 'data/{directory}/tiles/{zxy}.bin'
+BINARY_TILE_MAGIC = b'PSTILE01'
 SLICE_KEY_FORMAT = 'data/{directory}/slices/{geoid}.json'
+COSTS_KEY_FORMAT = 'data/{directory}/costs.json'
+HASHES_KEY_FORMAT = 'data/{directory}/hashes.json'
+
+# Change this when tile outputs change for the same input features,
+# so incremental runs don't keep stale tiles from older code.
+TILE_INPUT_VERSION = 1
 
 EPSG4326 = osr.SpatialReference(); EPSG4326.ImportFromEPSG(4326)
 
+# Decoded binary tile, see binary_tile() for the layout
+BinaryTile = collections.namedtuple('BinaryTile', ('columns', 'fractions', 'values', 'geometries'))
+
+# Result of prepare_tile(), with deferred child tiles or outputs to write
+PreparedTile = collections.namedtuple('PreparedTile', ('tile', 'zxy', 'children', 'writes', 'cost', 'log_feature', 'input_hash'))
+
+# Number of threads writing tile outputs, and most writes allowed in flight
+WRITE_THREADS, MAX_PENDING_WRITES = 8, 64
+
+# Per-process state for pool workers, see init_worker()
+_worker = {}
+
 def get_projection():
     ''' Return a spherical mercator MMaps Projection instance.
     '''
@@ -110,32 +138,167 @@ def excerpt_feature(original_feature, bbox_geom):
     
     return new_feature
 
-def load_geojson(filename):
-    ''' Load GeoJSON into property-free OGR datasource and property-only list.
+class PropertyStore (collections.abc.Sequence):
+    ''' Read-only sequence of property dicts in a memory-mapped file.
+    
+        Each dict is a line of JSON found by offsets, an array of len() + 1
+        byte positions. Pickles as just path and offsets for worker processes.
     '''
-    with open(filename, 'rb') as file1:
-        features = json.load(file1)['features']
+    def __init__(self, path, offsets):
+        self.path, self.offsets = path, offsets
+        self._open()
+    
+    def _open(self):
+        if self.offsets[-1] == 0:
+            self._buffer = b''
+            return
+        
+        with open(self.path, 'rb') as file:
+            self._buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def __getstate__(self):
+        return (self.path, self.offsets)
+    
+    def __setstate__(self, state):
+        self.path, self.offsets = state
+        self._open()
+    
+    def __len__(self):
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        
+        if index < 0:
+            index += len(self)
+        
+        if not 0 <= index < len(self):
+            raise IndexError('PropertyStore index out of range')
+        
+        return json.loads(self._buffer[self.offsets[index]:self.offsets[index + 1]])
+
+def iter_geojson_features(file, chunk_size=2**20):
+    ''' Generate feature dicts one at a time from a GeoJSON FeatureCollection file.
+    
+        Only one feature at a time is decoded, so the whole file is never in
+        memory. Other top-level members of the collection are skipped.
+    '''
+    decoder, buffer, position, eof = json.JSONDecoder(), '', 0, False
+    
+    def read_more():
+        nonlocal buffer, position, eof
+        # Read at least as much as is buffered, to parse big features in linear time
+        chunk = file.read(max(chunk_size, len(buffer) - position))
+        buffer, position, eof = buffer[position:] + chunk, 0, not chunk
+    
+    def next_char():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if eof:
+                raise ValueError('Unexpected end of GeoJSON')
+            read_more()
     
-    # Make a list with just original properties
-    properties_only = [feature['properties'] for feature in features]
+    def expect(chars):
+        nonlocal position
+        char = next_char()
+        if char not in chars:
+            raise ValueError('Unexpected {} in GeoJSON'.format(repr(char)))
+        position += 1
+        return char
     
-    # Create a temporary GeoJSON file with no original properties
-    handle, tmp_path = tempfile.mkstemp(prefix='load_geojson-', suffix='.geojson')
+    def decode_value():
+        nonlocal position
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # A number at the very end of the buffer might be incomplete
+                if end < len(buffer) or eof:
+                    position = end
+                    return value
+            read_more()
+    
+    expect('{')
+    
+    if next_char() == '}':
+        return
+    
+    while True:
+        key = decode_value()
+        expect(':')
+        
+        if key != 'features':
+            decode_value()
+        elif expect('[') and next_char() != ']':
+            while True:
+                yield decode_value()
+                if expect(',]') == ']':
+                    break
+        else:
+            expect(']')
+        
+        if expect(',}') == '}':
+            return
+
+def load_geojson(filename):
+    ''' Load GeoJSON into property-free OGR datasource and property-only sequence.
+    
+        Features are read one at a time. Geometries go to a spatially-indexed
+        temporary GeoPackage and properties to a PropertyStore, so peak memory
+        does not grow with the size of the state.
+    '''
+    handle, gpkg_path = tempfile.mkstemp(prefix='load_geojson-', suffix='.gpkg')
     os.close(handle)
+    os.remove(gpkg_path)
     
-    # Use a floating-point 1.0 for fraction field to avoid integer field type
-    geometry_geojson = {'type': 'FeatureCollection',
-        'features': [{'type': 'Feature', 'geometry': feature['geometry'],
-            'id': index, 'properties': {INDEX_FIELD: index, FRACTION_FIELD: 1.0}}
-            for (index, feature) in enumerate(features)]}
+    handle, properties_path = tempfile.mkstemp(prefix='load_geojson-', suffix='.jsonl')
+    os.close(handle)
     
-    with open(tmp_path, 'w') as file2:
-        json.dump(geometry_geojson, file2)
+    # Use a floating-point fraction field to avoid integer field type
+    datasource = ogr.GetDriverByName('GPKG').CreateDataSource(gpkg_path)
+    layer = datasource.CreateLayer('precincts', EPSG4326, ogr.wkbUnknown)
+    layer.CreateField(ogr.FieldDefn(INDEX_FIELD, ogr.OFTInteger))
+    layer.CreateField(ogr.FieldDefn(FRACTION_FIELD, ogr.OFTReal))
+    offsets = array.array('Q', [0])
     
-    # Return geometry-only OGR datasource and properties-only list
-    datasource = ogr.Open(tmp_path)
+    layer.StartTransaction()
     
-    return datasource, properties_only
+    with open(filename, 'r', encoding='utf8') as file1, open(properties_path, 'wb') as file2:
+        for (index, feature) in enumerate(iter_geojson_features(file1)):
+            # Write just original properties
+            file2.write(json.dumps(feature['properties'], separators=(',', ':')).encode('utf8'))
+            file2.write(b'\n')
+            offsets.append(file2.tell())
+            
+            # Write geometry with no original properties
+            ogr_feature = ogr.Feature(layer.GetLayerDefn())
+            ogr_feature.SetField(INDEX_FIELD, index)
+            ogr_feature.SetField(FRACTION_FIELD, 1.0)
+            
+            if feature['geometry'] is not None:
+                ogr_feature.SetGeometry(ogr.CreateGeometryFromJson(json.dumps(feature['geometry'])))
+            
+            layer.CreateFeature(ogr_feature)
+            
+            # Commit in batches, because one transaction per feature is slow
+            if index % 10000 == 9999:
+                layer.CommitTransaction()
+                layer.StartTransaction()
+    
+    layer.CommitTransaction()
+    datasource = None
+    
+    # Return geometry-only OGR datasource and properties-only sequence
+    return ogr.Open(gpkg_path), PropertyStore(properties_path, offsets)
 
 def feature_geojson(ogr_feature, properties):
     ''' Return GeoJSON feature string for an OGR feature and properties dict.
@@ -151,27 +314,424 @@ def feature_geojson(ogr_feature, properties):
     return ''.join(('{"type": "Feature", "properties": ', properties_json,
         ', "geometry": ', geometry_json, '}'))
 
+def feature_weight(ogr_feature):
+    ''' Return fraction of an excerpted feature's values that fall within its tile.
+    
+        Matches tiles.precinct_weight() for a tile wholly inside a district.
+    '''
+    geometry = ogr_feature.GetGeometryRef()
+    
+    if geometry is None or geometry.IsEmpty():
+        return 0
+    
+    if geometry.GetGeometryType() in (ogr.wkbPoint, ogr.wkbPoint25D,
+        ogr.wkbMultiPoint, ogr.wkbMultiPoint25D):
+        # Points have no area
+        return 1
+    
+    return ogr_feature.GetField(FRACTION_FIELD) or 0
+
+def geometry_vertex_count(geometry):
+    ''' Return total number of vertices in an OGR geometry.
+    '''
+    if geometry is None:
+        return 0
+    
+    if geometry.GetGeometryCount() == 0:
+        return geometry.GetPointCount()
+    
+    return sum(geometry_vertex_count(geometry.GetGeometryRef(index))
+        for index in range(geometry.GetGeometryCount()))
+
+def clipped_vertex_count(feature, bbox_geom, vertex_counts):
+    ''' Return number of vertices in a feature geometry trimmed to the bbox.
+    
+        vertex_counts is a dictionary of known whole-feature vertex counts,
+        used as-is for features entirely inside the bbox.
+    '''
+    index, geometry = feature.GetField(INDEX_FIELD), feature.GetGeometryRef()
+    
+    # Count vertices once for features that appear in many tiles
+    if index not in vertex_counts:
+        vertex_counts[index] = geometry_vertex_count(geometry)
+    
+    if geometry is None:
+        return 0
+    
+    (xmin1, xmax1, ymin1, ymax1) = geometry.GetEnvelope()
+    (xmin2, xmax2, ymin2, ymax2) = bbox_geom.GetEnvelope()
+    
+    if xmin1 >= xmin2 and xmax1 <= xmax2 and ymin1 >= ymin2 and ymax1 <= ymax2:
+        return vertex_counts[index]
+    
+    try:
+        return geometry_vertex_count(geometry.Intersection(bbox_geom))
+    except RuntimeError:
+        # Invalid geometries are buffered later in excerpt_feature()
+        return vertex_counts[index]
+
+def tile_cost(vertex_counts, column_count):
+    ''' Return estimated cost to score a tile, in vertex-equivalents.
+    
+        Precinct intersections in tiles.score_tile() grow with vertex counts,
+        and precinct values grow with the number of scoring columns. Values
+        are summed in bulk by numpy, so each costs a small fraction of one
+        vertex: 4,000 precincts with 12,000 columns add 96,000 to the cost.
+    '''
+    return sum(vertex_counts) + len(vertex_counts) * (FEATURE_COST + VALUE_COST * column_count)
+
+def scoring_field_names(properties_list):
+    ''' Return ordered list of scoring field names found in a list of property dicts.
+    
+        Household income is summed separately, weighted by households.
+    '''
+    names = set()
+    
+    for properties in properties_list:
+        names.update(properties.keys())
+        
+        if HOUSEHOLD_INCOME_FIELD in properties and HOUSEHOLDS_FIELD in properties:
+            names.add(HOUSEHOLD_SUM_FIELD)
+    
+    all_names = score.FIELD_NAMES + (HOUSEHOLD_SUM_FIELD, )
+    return [name for name in all_names if name in names]
+
+def scoring_values(properties_list, column_index):
+    ''' Return a feature × field array of values for a list of property dicts.
+    
+        column_index maps field names from scoring_field_names() to array columns.
+    '''
+    values = numpy.zeros((len(properties_list), len(column_index)))
+    
+    for (row, properties) in enumerate(properties_list):
+        names = [name for name in properties if name in column_index]
+        columns = [column_index[name] for name in names]
+        values[row, columns] = [properties[name] or 0 for name in names]
+        
+        if HOUSEHOLD_INCOME_FIELD in properties and HOUSEHOLDS_FIELD in properties:
+            # Household income can't be summed up like populations,
+            # and needs to be weighted by number of households.
+            income = properties[HOUSEHOLD_INCOME_FIELD] or 0
+            households = properties[HOUSEHOLDS_FIELD] or 0
+            values[row, column_index[HOUSEHOLD_SUM_FIELD]] = income * households
+            values[row, column_index[HOUSEHOLD_INCOME_FIELD]] = 0
+    
+    return values
+
+def tile_totals(weighted_properties):
+    ''' Return dictionary of weighted property totals for all features in a tile.
+    
+        weighted_properties is a list of (weight, properties dict) tuples.
+    '''
+    weights = numpy.array([weight for (weight, _) in weighted_properties])
+    properties_list = [properties for (_, properties) in weighted_properties]
+    
+    field_names = scoring_field_names(properties_list)
+    column_index = {name: column for (column, name) in enumerate(field_names)}
+    sums = weights.dot(scoring_values(properties_list, column_index))
+    
+    return {name: round(value, constants.ROUND_COUNT)
+        for (name, value) in zip(field_names, sums.tolist())}
+
+def _pad8(length):
+    return b'\0' * (-length % 8)
+
+def binary_tile(ogr_features, properties_list):
+    ''' Return bytes of a compact binary tile for excerpted features and properties.
+    
+        Layout, with every section aligned to 8 bytes:
+        - BINARY_TILE_MAGIC
+        - uint32 header length and JSON header with columns and feature count
+        - float64 fraction per feature, NaN where fraction is unset
+        - float64 feature × column scoring values from scoring_values()
+        - uint64 feature count + 1 offsets into WKB geometry blob
+        - WKB geometry blob
+    '''
+    columns = scoring_field_names(properties_list)
+    column_index = {name: column for (column, name) in enumerate(columns)}
+    values = scoring_values(properties_list, column_index)
+    
+    fractions = numpy.array([ogr_feature.GetField(FRACTION_FIELD)
+        if ogr_feature.IsFieldSet(FRACTION_FIELD) else numpy.nan
+        for ogr_feature in ogr_features], dtype='<f8')
+    
+    geometries = [bytes(ogr_feature.GetGeometryRef().ExportToWkb(ogr.wkbNDR))
+        for ogr_feature in ogr_features]
+    offsets = numpy.cumsum([0] + [len(wkb) for wkb in geometries], dtype='<u8')
+    
+    header = json.dumps(dict(columns=columns, count=len(fractions))).encode('utf8')
+    header_prefix = BINARY_TILE_MAGIC + struct.pack('<I', len(header)) + header
+    
+    return b''.join([
+        header_prefix, _pad8(len(header_prefix)),
+        fractions.tobytes(), values.astype('<f8').tobytes(),
+        offsets.tobytes(), b''.join(geometries),
+        ])
+
+def read_binary_tile(body):
+    ''' Return a BinaryTile for bytes from binary_tile().
+    
+        Arrays and geometries are views into body and are not copied.
+    '''
+    body = memoryview(body)
+    start = len(BINARY_TILE_MAGIC)
+    
+    if bytes(body[:start]) != BINARY_TILE_MAGIC:
+        raise ValueError('Not a binary tile')
+    
+    (header_length, ) = struct.unpack('<I', body[start:start + 4])
+    header = json.loads(bytes(body[start + 4:start + 4 + header_length]))
+    count, columns = header['count'], header['columns']
+    
+    offset = start + 4 + header_length
+    offset += -offset % 8
+    
+    fractions = numpy.frombuffer(body, dtype='<f8', count=count, offset=offset)
+    offset += fractions.nbytes
+    
+    values = numpy.frombuffer(body, dtype='<f8', count=count * len(columns),
+        offset=offset).reshape((count, len(columns)))
+    offset += values.nbytes
+    
+    offsets = numpy.frombuffer(body, dtype='<u8', count=count + 1, offset=offset)
+    offset += offsets.nbytes
+    
+    geometries = [body[offset + int(begin):offset + int(end)]
+        for (begin, end) in zip(offsets[:-1], offsets[1:])]
+    
+    return BinaryTile(columns, fractions, values, geometries)
+
 def iter_slices(property_dicts, length):
-    sorted_dicts = sorted(property_dicts, key=operator.itemgetter('GEOID'))
-    args = [iter(sorted_dicts)] * length
+    ''' Generate lists of property dicts sorted by GEOID, length at a time.
+    
+        Only GEOIDs are sorted in memory, so property_dicts can be a PropertyStore.
+    '''
+    geoids = [properties['GEOID'] for properties in property_dicts]
+    order = sorted(range(len(geoids)), key=geoids.__getitem__)
+    
+    for start in range(0, len(order), length):
+        yield [property_dicts[index] for index in order[start:start + length]]
+
+def feature_hash(ogr_feature, properties):
+    ''' Return hex digest of an OGR feature geometry and its properties dict.
+    '''
+    geometry = ogr_feature.GetGeometryRef()
+    digest = hashlib.sha1(bytes(geometry.ExportToWkb()) if geometry else b'')
+    digest.update(json.dumps(properties, sort_keys=True).encode('utf8'))
+    
+    return digest.hexdigest()
+
+def content_hash(value):
+    ''' Return hex digest of a text or bytes value for write_buffer().
+    '''
+    return hashlib.sha1(value.encode('utf8') if isinstance(value, str) else value).hexdigest()
+
+def read_buffer(s3, key):
+    ''' Read bytes written by write_buffer() from S3 or a local file, or None.
+    '''
+    if s3:
+        try:
+            object = s3.get_object(Bucket=constants.S3_BUCKET, Key=key)
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+        
+        body = object['Body'].read()
+        return gzip.decompress(body) if object.get('ContentEncoding') == 'gzip' else body
+    
+    if not os.path.exists(key):
+        return None
     
-    for slice in itertools.zip_longest(*args):
-        yield [d for d in slice if d]
+    with open(key, 'rb') as file:
+        return file.read()
 
-def write_buffer(s3, key, buffer, prefix):
+def delete_buffer(s3, key, prefix):
+    ''' Delete something written by write_buffer() from S3 or a local file.
+    '''
     if s3:
-        body = gzip.compress(buffer.getvalue().encode('utf8'))
+        print(prefix, 'Delete', f's3://{constants.S3_BUCKET}/{key}')
+        s3.delete_object(Bucket=constants.S3_BUCKET, Key=key)
+    elif os.path.exists(key):
+        print(prefix, 'Delete', key)
+        os.remove(key)
+
+def write_buffer(s3, key, buffer, prefix, content_type='text/json'):
+    ''' Write a text or bytes buffer to S3 or a local file.
+    '''
+    value = buffer.getvalue()
+    
+    if s3:
+        body = gzip.compress(value.encode('utf8') if isinstance(value, str) else value)
         line = f's3://{constants.S3_BUCKET}/{key}', '-', '{:.1f}KB'.format(len(body) / 1024)
         print(prefix, 'Write', *line)
 
         s3.put_object(Bucket=constants.S3_BUCKET, Key=key, Body=body,
-            ContentEncoding='gzip', ContentType='text/json', ACL='public-read')
+            ContentEncoding='gzip', ContentType=content_type, ACL='public-read')
     else:
         os.makedirs(os.path.dirname(key), exist_ok=True)
         print(prefix, 'Write', key)
 
-        with open(key, 'w') as file:
-            file.write(buffer.getvalue())
+        with open(key, 'w' if isinstance(value, str) else 'wb') as file:
+            file.write(value)
+
+def prepare_tile(layer, properties, directory, tile, column_count, binary,
+        vertex_counts, stack_str, feature_hashes=None, previous_inputs=None):
+    ''' Return a PreparedTile with child tiles to try instead, or outputs to write.
+    
+        Outputs are (key, value, content type) tuples for write_buffer().
+        vertex_counts and feature_hashes are dictionaries of known values for
+        each precinct. If previous_inputs has this tile with the same input
+        hash, output values are None and the tile is not generated again.
+    '''
+    feature_hashes = {} if feature_hashes is None else feature_hashes
+    previous_inputs = previous_inputs or {}
+    tile_zxy = '{zoom:.0f}/{column:.0f}/{row:.0f}'.format(**tile.__dict__)
+
+    bbox_geom = ogr.CreateGeometryFromWkt(coord_wkt(tile))
+    layer.SetSpatialFilter(bbox_geom)
+    bbox_features = list(layer)
+    
+    if len(bbox_features) == 0:
+        # Nothing here, forget about it.
+        print(stack_str, 'Skip', tile_zxy)
+        return PreparedTile(tile, tile_zxy, [], [], None, None, None)
+
+    # Vertices outside the tile are trimmed away, so don't count them
+    cost = tile_cost([clipped_vertex_count(feature, bbox_geom, vertex_counts)
+        for feature in bbox_features], column_count)
+
+    if tile.zoom < MAX_TILE_ZOOM and cost > MAX_TILE_COST:
+        # Too costly to score, zoom in and try again later.
+        tile_ul = tile.zoomBy(1)
+        tile_ur, tile_ll = tile_ul.right(), tile_ul.down()
+        tile_lr = tile_ll.right()
+        print(stack_str, 'Defer', tile_zxy)
+        return PreparedTile(tile, tile_zxy, [tile_ul, tile_ur, tile_ll, tile_lr], [], None, None, None)
+    
+    log_feature = ''.join([
+        '{"type": "Feature", "properties": ',
+        json.dumps({
+            'zxy': tile_zxy,
+            'zoom': tile.zoom,
+            'x': tile.column,
+            'y': tile.row,
+            'features': len(bbox_features),
+            'cost': cost,
+        }),
+        ', "geometry": ',
+        bbox_geom.ExportToJson(options=['COORDINATE_PRECISION=7']),
+        '}',
+    ])
+    
+    tile_key = (BINARY_TILE_KEY_FORMAT if binary else TILE_KEY_FORMAT).format(directory=directory, zxy=tile_zxy)
+    totals_key = TOTALS_KEY_FORMAT.format(directory=directory, zxy=tile_zxy)
+    tile_type = 'application/octet-stream' if binary else 'text/json'
+    
+    # Hash everything that goes into this tile's outputs
+    input_digest = hashlib.sha1(json.dumps([TILE_INPUT_VERSION, tile_zxy, binary]).encode('utf8'))
+    
+    for feature in bbox_features:
+        if feature.GetField(INDEX_FIELD) not in feature_hashes:
+            feature_hashes[feature.GetField(INDEX_FIELD)] \
+                = feature_hash(feature, properties[feature.GetField(INDEX_FIELD)])
+        input_digest.update(feature_hashes[feature.GetField(INDEX_FIELD)].encode('ascii'))
+    
+    input_hash = input_digest.hexdigest()
+    
+    if previous_inputs.get(tile_zxy) == input_hash:
+        # Same inputs as last time, so outputs would be unchanged too
+        print(stack_str, 'Same', tile_zxy)
+        writes = [(tile_key, None, tile_type), (totals_key, None, 'text/json')]
+        return PreparedTile(tile, tile_zxy, [], writes, cost, log_feature, input_hash)
+    
+    ogr_features, features_properties = [], []
+
+    for feature in bbox_features:
+        ogr_features.append(excerpt_feature(feature, bbox_geom))
+        features_properties.append(properties[feature.GetField(INDEX_FIELD)])
+    
+    if not ogr_features:
+        return PreparedTile(tile, tile_zxy, [], [], None, None, None)
+    
+    writes = []
+    
+    if binary:
+        writes.append((tile_key, binary_tile(ogr_features, features_properties), tile_type))
+    else:
+        buffer = io.StringIO()
+        print('{"type": "FeatureCollection", "features": [', file=buffer)
+        print(',\n'.join(map(feature_geojson, ogr_features, features_properties)), file=buffer)
+        print(']}', file=buffer)
+        
+        writes.append((tile_key, buffer.getvalue(), tile_type))
+    
+    # Precomputed totals for use when a tile falls inside a single district
+    weighted_properties = list(zip(map(feature_weight, ogr_features), features_properties))
+    totals = dict(features=len(ogr_features), totals=tile_totals(weighted_properties))
+
+    writes.append((totals_key, json.dumps(totals), 'text/json'))
+    
+    return PreparedTile(tile, tile_zxy, [], writes, cost, log_feature, input_hash)
+
+def init_worker(ds_path, properties, directory, column_count, binary, previous_inputs):
+    ''' Open a separate datasource for each pool worker process.
+    '''
+    _worker['ds'] = ogr.Open(ds_path)
+    _worker['args'] = (properties, directory)
+    _worker['kwargs'] = dict(column_count=column_count, binary=binary, vertex_counts={},
+        feature_hashes={}, previous_inputs=previous_inputs)
+
+def run_tile(tile):
+    ''' Return a PreparedTile for one tile using the worker datasource.
+    '''
+    return prepare_tile(_worker['ds'].GetLayer(0), *_worker['args'], tile,
+        stack_str='      ', **_worker['kwargs'])
+
+def iter_prepared_tiles(ds, properties, directory, column_count, binary, processes, previous_inputs=None):
+    ''' Generate PreparedTiles and pending tile counts for a datasource quadtree.
+    
+        With more than one process, tiles are prepared in a process pool with
+        a datasource opened by each worker, and generated in completion order.
+        Optional previous_inputs has tile input hashes from an earlier run.
+    '''
+    tile_stack = list(iter_extent_coords(ds.GetLayer(0).GetExtent(), MIN_TILE_ZOOM))
+
+    if processes == 1:
+        vertex_counts, feature_hashes = {}, {}
+        
+        while tile_stack:
+            tile = tile_stack.pop(0)
+            stack_str = '{:6d}'.format(len(tile_stack))
+            prepared = prepare_tile(ds.GetLayer(0), properties, directory, tile,
+                column_count, binary, vertex_counts, stack_str, feature_hashes, previous_inputs)
+            tile_stack.extend(prepared.children)
+            yield prepared, stack_str
+        
+        return
+    
+    initargs = (ds.name, properties, directory, column_count, binary, previous_inputs)
+
+    with concurrent.futures.ProcessPoolExecutor(processes,
+        initializer=init_worker, initargs=initargs) as executor:
+        futures = {executor.submit(run_tile, tile) for tile in tile_stack}
+        
+        while futures:
+            done, futures = concurrent.futures.wait(futures,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            
+            for future in done:
+                prepared = future.result()
+                futures |= {executor.submit(run_tile, child) for child in prepared.children}
+                yield prepared, '{:6d}'.format(len(futures))
+
+def write_tile_log(filename, tile_log):
+    ''' Write GeoJSON tile summary, ordered by tile regardless of completion order.
+    '''
+    with open(filename, 'w') as file:
+        print('{"type": "FeatureCollection", "features": [', file=file)
+        print(',\n'.join(feature for (_, feature) in sorted(tile_log.items())), file=file)
+        print(']}', file=file)
 
 parser = argparse.ArgumentParser(description='YESS')
 
@@ -182,6 +742,12 @@ parser.add_argument('--geojson',
     help='Path to GeoJSON file for tile summary')
 parser.add_argument('--s3', action='store_true',
     help='Upload to S3 instead of local directory')
+parser.add_argument('--binary', action='store_true',
+    help='Write compact binary tiles instead of GeoJSON')
+parser.add_argument('--processes', type=int, default=1,
+    help='Number of worker processes preparing tiles. Default 1.')
+parser.add_argument('--incremental', action='store_true',
+    help='Write only changed tiles and slices, and delete orphaned ones')
 
 def main():
     args = parser.parse_args()
@@ -190,82 +756,85 @@ def main():
     print('Loading', args.filename, '...')
     ds, properties = load_geojson(args.filename)
     print('Loaded', len(properties), 'features and made', ds.name)
-    layer = ds.GetLayer(0)
     
-    for slice in iter_slices(properties, MAX_FEATURE_COUNT):
-        write_buffer(
-            args.s3 and s3,
-            SLICE_KEY_FORMAT.format(directory=args.directory, geoid=slice[0]['GEOID']),
-            io.StringIO(json.dumps(slice)),
-            '      ',
-            )
+    hashes_key = HASHES_KEY_FORMAT.format(directory=args.directory)
+    previous_hashes = dict(tiles={}, outputs={})
     
-    tile_stack = list(iter_extent_coords(layer.GetExtent(), MIN_TILE_ZOOM))
-    tile_log = []
+    if args.incremental:
+        # Content hashes from the last run tell us what can be left alone
+        previous_buffer = read_buffer(args.s3 and s3, hashes_key)
+        if previous_buffer is not None:
+            previous_hashes = json.loads(previous_buffer)
     
-    while tile_stack:
-        tile = tile_stack.pop(0)
-        tile_zxy = '{zoom:.0f}/{column:.0f}/{row:.0f}'.format(**tile.__dict__)
-        stack_str = '{:6d}'.format(len(tile_stack))
-
-        bbox_geom = ogr.CreateGeometryFromWkt(coord_wkt(tile))
-        layer.SetSpatialFilter(bbox_geom)
-        bbox_features = list(layer)
+    hashes, tile_log, tile_costs = dict(tiles={}, outputs={}), {}, {}
+    column_count = len(scoring_field_names(properties))
+    pending_writes = collections.deque()
+    
+    def write_output(writer, key, value, prefix, content_type='text/json'):
+        ''' Write a value in the background unless it matches the previous run.
+        '''
+        if value is None:
+            # Tile was not generated again because its inputs are unchanged
+            hashes['outputs'][key] = previous_hashes['outputs'].get(key)
+            return
         
-        if len(bbox_features) == 0:
-            # Nothing here, forget about it.
-            print(stack_str, 'Skip', tile_zxy)
-            continue
-
-        if tile.zoom < MAX_TILE_ZOOM and len(bbox_features) > MAX_FEATURE_COUNT:
-            # Too many features, zoom in and try again later.
-            tile_ul = tile.zoomBy(1)
-            tile_ur, tile_ll = tile_ul.right(), tile_ul.down()
-            tile_lr = tile_ll.right()
-            tile_stack.extend((tile_ul, tile_ur, tile_ll, tile_lr))
-            print(stack_str, 'Defer', tile_zxy)
-            continue
+        hashes['outputs'][key] = content_hash(value)
         
-        features_json = []
-    
-        for feature in bbox_features:
-            ogr_feature = excerpt_feature(feature, bbox_geom)
-            feature_properties = properties[feature.GetField(INDEX_FIELD)]
-            features_json.append(feature_geojson(ogr_feature, feature_properties))
+        if hashes['outputs'][key] == previous_hashes['outputs'].get(key):
+            return
+        
+        buffer = io.StringIO(value) if isinstance(value, str) else io.BytesIO(value)
+        pending_writes.append(writer.submit(write_buffer,
+            args.s3 and s3, key, buffer, prefix, content_type))
         
-        if not features_json:
-            continue
+        # Keep a bounded number of writes in flight, raising any errors
+        while len(pending_writes) > MAX_PENDING_WRITES:
+            pending_writes.popleft().result()
     
-        buffer = io.StringIO()
-        print('{"type": "FeatureCollection", "features": [', file=buffer)
-        print(',\n'.join(features_json), file=buffer)
-        print(']}', file=buffer)
+    prepared_tiles = iter_prepared_tiles(ds, properties, args.directory,
+        column_count, args.binary, args.processes, previous_hashes['tiles'])
+    
+    with concurrent.futures.ThreadPoolExecutor(WRITE_THREADS) as writer:
+        for slice in iter_slices(properties, MAX_FEATURE_COUNT):
+            write_output(writer,
+                SLICE_KEY_FORMAT.format(directory=args.directory, geoid=slice[0]['GEOID']),
+                json.dumps(slice),
+                '      ',
+                )
+        
+        for (prepared, stack_str) in prepared_tiles:
+            if prepared.cost is None:
+                continue
+            
+            for (key, value, content_type) in prepared.writes:
+                write_output(writer, key, value, stack_str, content_type)
+            
+            hashes['tiles'][prepared.zxy] = prepared.input_hash
+            tile_costs[prepared.zxy] = prepared.cost
+            
+            if args.geojson:
+                tile = prepared.tile
+                tile_log[(tile.zoom, tile.column, tile.row)] = prepared.log_feature
+                write_tile_log(args.geojson, tile_log)
         
-        write_buffer(
-            args.s3 and s3,
-            TILE_KEY_FORMAT.format(directory=args.directory, zxy=tile_zxy),
-            buffer,
-            stack_str,
+        # Scoring cost for each tile, for use in postread_calculate.load_model_tiles()
+        write_output(writer,
+            COSTS_KEY_FORMAT.format(directory=args.directory),
+            json.dumps(tile_costs, sort_keys=True),
+            '      ',
             )
         
-        if args.geojson:
-            tile_log.append(''.join([
-                '{"type": "Feature", "properties": ',
-                json.dumps({
-                    'zxy': tile_zxy,
-                    'zoom': tile.zoom,
-                    'x': tile.column,
-                    'y': tile.row,
-                    'features': len(bbox_features),
-                }),
-                ', "geometry": ',
-                bbox_geom.ExportToJson(options=['COORDINATE_PRECISION=7']),
-                '}',
-            ]))
-
-            with open(args.geojson, 'a') as file:
-                file.seek(0, 0)
-                file.truncate()
-                print('{"type": "FeatureCollection", "features": [', file=file)
-                print(',\n'.join(tile_log), file=file)
-                print(']}', file=file)
+        for future in pending_writes:
+            future.result()
+    
+    if args.incremental:
+        # Remove tiles and slices that this run no longer makes
+        for key in sorted(set(previous_hashes['outputs']) - set(hashes['outputs'])):
+            delete_buffer(args.s3 and s3, key, '      ')
+    
+    write_buffer(
+        args.s3 and s3,
+        hashes_key,
+        io.StringIO(json.dumps(hashes, sort_keys=True)),
+        '      ',
+        )
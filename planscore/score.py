@@ -3,12 +3,12 @@
 When all districts are added up and present on S3, performs complete scoring
 of district plan and uploads summary JSON file.
 '''
-import io, os, gzip, posixpath, json, statistics, copy, time, itertools
+import io, os, gzip, posixpath, json, statistics, copy, time, itertools, collections
 import math
 import argparse
 import urllib.request
 import pprint
-import boto3, botocore.exceptions
+import boto3, botocore.exceptions, numpy
 from . import data, constants, matrix
 
 FIELD_NAMES = (
@@ -165,6 +165,74 @@ def calculate_PB(red_districts, blue_districts):
     
     return blue_seatshare - blue_voteshare
 
+def _valid_votes(red_votes, blue_votes):
+    ''' Return red and blue vote arrays with NaN replaced by zero, and a validity mask.
+    '''
+    valid = ~(numpy.isnan(red_votes) | numpy.isnan(blue_votes))
+    return numpy.where(valid, red_votes, 0), numpy.where(valid, blue_votes, 0), valid
+
+def calculate_EG_array(red_votes, blue_votes, vote_swing=0):
+    ''' Convert two districts × sims arrays of vote counts into per-sim EG scores.
+    
+        Matches calculate_EG() for each sim, with NaN districts left out
+        as in matrix.dropna(). Sims with no votes get a NaN score.
+    '''
+    red_votes, blue_votes, _ = _valid_votes(red_votes, blue_votes)
+    district_votes = red_votes + blue_votes
+    
+    # Same as swing_vote(), where empty districts contribute nothing anyway
+    red_votes = red_votes - vote_swing * district_votes
+    blue_votes = blue_votes + vote_swing * district_votes
+    
+    red_wins, blue_wins = red_votes > blue_votes, blue_votes > red_votes
+    win_threshold = district_votes / 2
+    
+    wasted_red = numpy.where(red_wins, red_votes - win_threshold, 0) \
+        + numpy.where(blue_wins, red_votes, 0)
+    wasted_blue = numpy.where(blue_wins, blue_votes - win_threshold, 0) \
+        + numpy.where(red_wins, blue_votes, 0)
+    
+    election_votes = district_votes.sum(axis=0)
+    gaps = (wasted_red.sum(axis=0) - wasted_blue.sum(axis=0)) \
+        / numpy.where(election_votes == 0, numpy.nan, election_votes)
+    
+    return gaps
+
+def calculate_MMD_array(red_votes, blue_votes):
+    ''' Convert two districts × sims arrays of vote counts into per-sim MMD scores.
+    
+        Matches calculate_MMD() for each sim, with NaN districts left out.
+    '''
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        shares = blue_votes / (red_votes + blue_votes)
+    
+    return numpy.nanmedian(shares, axis=0) - numpy.nanmean(shares, axis=0)
+
+def calculate_PB_array(red_votes, blue_votes):
+    ''' Convert two districts × sims arrays of vote counts into per-sim PB scores.
+    
+        Matches calculate_PB() for each sim, with NaN districts left out.
+    '''
+    red_votes, blue_votes, valid = _valid_votes(red_votes, blue_votes)
+    district_votes = red_votes + blue_votes
+    red_total, blue_total = red_votes.sum(axis=0), blue_votes.sum(axis=0)
+    blue_margin = (blue_total - red_total) / (blue_total + red_total)
+    
+    # Same as swing_vote() to 50/50, which drops empty districts for any swing
+    vote_swing = -blue_margin / 2
+    reds_5050 = red_votes - vote_swing * district_votes
+    blues_5050 = blue_votes + vote_swing * district_votes
+    counted = valid & ((district_votes > 0) | (vote_swing == 0))
+    
+    blue_seats = (counted & (reds_5050 < blues_5050)).sum(axis=0)
+    blue_seatshare = blue_seats / counted.sum(axis=0)
+    blue_voteshare = blues_5050.sum(axis=0) / (blues_5050.sum(axis=0) + reds_5050.sum(axis=0))
+    
+    assert numpy.all(numpy.round(blue_voteshare, 7) == .5), \
+        'Vote-share Partisan Bias should always be 50%'
+    
+    return blue_seatshare - blue_voteshare
+
 def calculate_bias(upload):
     ''' Calculate partisan metrics for districts with plain vote counts.
         
@@ -209,55 +277,52 @@ def calculate_bias(upload):
     
     return upload.clone(summary=summary_dict)
 
-def calculate_open_biases(upload):
-    ''' Calculate partisan metrics for districts with multiple simulations.
-
-        Look for "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
+def simulation_votes(districts, field_names):
+    ''' Return a districts × sims × party array of simulated votes.
+    
+        field_names is a list of (DEM field, REP field) lists for each district,
+        one pair per sim. Parties are ordered DEM, REP like matrix.model_votes().
+        Missing fields count as zero votes.
     '''
-    if f'DEM000' not in upload.districts[0]['totals']:
-        # Skip everything if we don't see a "DEM000"-style vote property
-        return upload.clone()
+    votes = numpy.zeros((len(districts), len(field_names[0]) if field_names else 0, 2))
     
-    MMDs, PBs = list(), list()
-    EGs = {swing: list() for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)}
-    summary_dict, copied_districts = dict(), copy.deepcopy(upload.districts)
-    first_totals = copied_districts[0]['totals']
+    for (i, (district, district_fields)) in enumerate(zip(districts, field_names)):
+        totals = district['totals']
+        votes[i] = [(totals.get(dem_field, 0), totals.get(rep_field, 0))
+            for (dem_field, rep_field) in district_fields]
     
-    # Prepare place for simulation vote totals in each district
-    all_red_districts = [list() for d in copied_districts]
-    all_blue_districts = [list() for d in copied_districts]
+    return votes
 
-    # Iterate over all simulations, tracking EG and vote totals
-    for sim in range(1000):
-        if f'REP{sim:03d}' not in first_totals or f'DEM{sim:03d}' not in first_totals:
-            continue
-        
-        sim_red_districts, sim_blue_districts = list(), list()
-
-        for (i, district) in enumerate(copied_districts):
-            red_votes = district['totals'].pop(f'REP{sim:03d}', 0)
-            blue_votes = district['totals'].pop(f'DEM{sim:03d}', 0)
-            sim_red_districts.append(red_votes)
-            sim_blue_districts.append(blue_votes)
-            all_red_districts[i].append(red_votes)
-            all_blue_districts[i].append(blue_votes)
-    
-        MMDs.append(calculate_MMD(sim_red_districts, sim_blue_districts))
-        PBs.append(calculate_PB(sim_red_districts, sim_blue_districts))
-        
-        for swing in EGs:
-            EGs[swing].append(calculate_EG(sim_red_districts, sim_blue_districts, swing/100))
+def summarize_simulation_votes(districts, votes, dropped_fields):
+    ''' Return districts and summary for a districts × sims × party vote array.
+    
+        Vote simulation fields in dropped_fields are left out of district totals.
+    '''
+    red_votes, blue_votes = votes[:,:,1], votes[:,:,0]
+    
+    # Calculate partisanship metrics for all simulations at once
+    MMDs = calculate_MMD_array(red_votes, blue_votes).tolist()
+    PBs = calculate_PB_array(red_votes, blue_votes).tolist()
+    EGs = {
+        swing: calculate_EG_array(red_votes, blue_votes, swing/100).tolist()
+        for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)
+    }
     
     # Finalize per-district vote totals and confidence intervals
-    for (i, district) in enumerate(copied_districts):
-        red_votes, blue_votes = all_red_districts[i], all_blue_districts[i]
-        district['totals'].update({
-            'Democratic Votes': round(statistics.mean(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes': round(statistics.mean(red_votes), constants.ROUND_COUNT),
-            'Democratic Votes SD': round(statistics.stdev(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes SD': round(statistics.stdev(red_votes), constants.ROUND_COUNT)
+    new_districts = []
+    
+    for (i, district) in enumerate(districts):
+        totals = {key: value for (key, value) in district['totals'].items()
+            if key not in dropped_fields}
+        totals.update({
+            'Democratic Votes': round(statistics.mean(blue_votes[i].tolist()), constants.ROUND_COUNT),
+            'Republican Votes': round(statistics.mean(red_votes[i].tolist()), constants.ROUND_COUNT),
+            'Democratic Votes SD': round(statistics.stdev(blue_votes[i].tolist()), constants.ROUND_COUNT),
+            'Republican Votes SD': round(statistics.stdev(red_votes[i].tolist()), constants.ROUND_COUNT)
             })
+        new_districts.append(dict(district, totals=totals))
 
+    summary_dict = dict()
     summary_dict['Mean-Median'] = statistics.mean(MMDs)
     summary_dict['Mean-Median SD'] = statistics.stdev(MMDs)
     summary_dict['Partisan Bias'] = statistics.mean(PBs)
@@ -272,7 +337,26 @@ def calculate_open_biases(upload):
         summary_dict[f'Efficiency Gap +{swing} Rep SD'] = statistics.stdev(EGs[-swing])
     
     rounded_summary_dict = {k: round(v, constants.ROUND_FLOAT) for (k, v) in summary_dict.items()}
-    return upload.clone(districts=copied_districts, summary=rounded_summary_dict)
+    return new_districts, rounded_summary_dict
+
+def calculate_open_biases(upload):
+    ''' Calculate partisan metrics for districts with multiple simulations.
+
+        Look for "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
+    '''
+    if f'DEM000' not in upload.districts[0]['totals']:
+        # Skip everything if we don't see a "DEM000"-style vote property
+        return upload.clone()
+    
+    first_totals = upload.districts[0]['totals']
+    sim_fields = [(f'DEM{sim:03d}', f'REP{sim:03d}') for sim in range(1000)
+        if f'REP{sim:03d}' in first_totals and f'DEM{sim:03d}' in first_totals]
+    
+    votes = simulation_votes(upload.districts, [sim_fields] * len(upload.districts))
+    dropped_fields = set(itertools.chain(*sim_fields))
+    districts, summary = summarize_simulation_votes(upload.districts, votes, dropped_fields)
+
+    return upload.clone(districts=districts, summary=summary)
 
 def calculate_biases(upload):
     ''' Calculate partisan metrics for districts with simulations and incumbency.
@@ -284,72 +368,27 @@ def calculate_biases(upload):
         # Skip everything if we don't see an "O:DEM000"-style vote property
         return upload.clone()
     
-    MMDs, PBs = list(), list()
-    EGs = {swing: list() for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)}
-    summary_dict, copied_districts = dict(), copy.deepcopy(upload.districts)
-    first_totals = copied_districts[0]['totals']
+    first_totals = upload.districts[0]['totals']
     
-    # Prepare place for simulation vote totals in each district
-    all_red_districts = [list() for d in copied_districts]
-    all_blue_districts = [list() for d in copied_districts]
-
-    # Iterate over all simulations, tracking EG and vote totals
-    for sim in range(1000):
-        if FIELD_TMPL.format(party='DEM', sim=sim, incumbent=data.Incumbency.Open.value) \
-                not in first_totals:
-            # Skip if we don't seem to have sims up to this iteration
-            continue
-        
-        sim_red_districts, sim_blue_districts = list(), list()
-
-        for (i, district) in enumerate(copied_districts):
-            incumbent = upload.incumbents[i]
-            oDEMnnn = FIELD_TMPL.format(party='DEM', sim=sim, incumbent=incumbent)
-            oREPnnn = FIELD_TMPL.format(party='REP', sim=sim, incumbent=incumbent)
-        
-            red_votes = district['totals'].pop(oREPnnn, 0)
-            blue_votes = district['totals'].pop(oDEMnnn, 0)
-            sim_red_districts.append(red_votes)
-            sim_blue_districts.append(blue_votes)
-            all_red_districts[i].append(red_votes)
-            all_blue_districts[i].append(blue_votes)
-            
-            # Clear out vote total fields for all conditions in the current sim
-            for (party, incumbent) in itertools.product(('DEM', 'REP'), list(data.Incumbency)):
-                kwargs = dict(incumbent=incumbent.value, party=party, sim=sim)
-                district['totals'].pop(FIELD_TMPL.format(**kwargs), None)
-    
-        MMDs.append(calculate_MMD(sim_red_districts, sim_blue_districts))
-        PBs.append(calculate_PB(sim_red_districts, sim_blue_districts))
-        
-        for swing in EGs:
-            EGs[swing].append(calculate_EG(sim_red_districts, sim_blue_districts, swing/100))
+    # Skip sims we don't seem to have
+    sims = [sim for sim in range(1000) if FIELD_TMPL.format(party='DEM', sim=sim,
+        incumbent=data.Incumbency.Open.value) in first_totals]
     
-    # Finalize per-district vote totals and confidence intervals
-    for (i, district) in enumerate(copied_districts):
-        red_votes, blue_votes = all_red_districts[i], all_blue_districts[i]
-        district['totals'].update({
-            'Democratic Votes': round(statistics.mean(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes': round(statistics.mean(red_votes), constants.ROUND_COUNT),
-            'Democratic Votes SD': round(statistics.stdev(blue_votes), constants.ROUND_COUNT),
-            'Republican Votes SD': round(statistics.stdev(red_votes), constants.ROUND_COUNT)
-            })
-
-    summary_dict['Mean-Median'] = statistics.mean(MMDs)
-    summary_dict['Mean-Median SD'] = statistics.stdev(MMDs)
-    summary_dict['Partisan Bias'] = statistics.mean(PBs)
-    summary_dict['Partisan Bias SD'] = statistics.stdev(PBs)
-    summary_dict['Efficiency Gap'] = statistics.mean(EGs[0])
-    summary_dict['Efficiency Gap SD'] = statistics.stdev(EGs[0])
+    # Format field names once for each incumbency condition instead of each district
+    incumbency_fields = {
+        incumbent.value: [(FIELD_TMPL.format(party='DEM', sim=sim, incumbent=incumbent.value),
+            FIELD_TMPL.format(party='REP', sim=sim, incumbent=incumbent.value)) for sim in sims]
+        for incumbent in data.Incumbency
+    }
     
-    for swing in (1, 2, 3, 4, 5):
-        summary_dict[f'Efficiency Gap +{swing} Dem'] = statistics.mean(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep'] = statistics.mean(EGs[-swing])
-        summary_dict[f'Efficiency Gap +{swing} Dem SD'] = statistics.stdev(EGs[swing])
-        summary_dict[f'Efficiency Gap +{swing} Rep SD'] = statistics.stdev(EGs[-swing])
+    votes = simulation_votes(upload.districts,
+        [incumbency_fields[incumbent] for incumbent in upload.incumbents])
     
-    rounded_summary_dict = {k: round(v, constants.ROUND_FLOAT) for (k, v) in summary_dict.items()}
-    return upload.clone(districts=copied_districts, summary=rounded_summary_dict)
+    # Clear out vote total fields for all conditions in the included sims
+    dropped_fields = set(itertools.chain(*itertools.chain(*incumbency_fields.values())))
+    districts, summary = summarize_simulation_votes(upload.districts, votes, dropped_fields)
+
+    return upload.clone(districts=districts, summary=summary)
 
 def calculate_district_biases(upload):
     ''' Calculate partisan metrics using district matrix with presidential vote only.
@@ -379,6 +418,39 @@ def calculate_district_biases(upload):
         matrix.prepare_district_data(upload),
     )
     
+    return summarize_district_votes(upload, output_votes)
+
+def calculate_district_biases_batch(uploads):
+    ''' Calculate partisan metrics for many plans using district matrix.
+    
+        Plans for the same state are modeled together with one application
+        of the model matrix. Return is a list of uploads like those from
+        calculate_district_biases(), in the same order as the input.
+    '''
+    output_uploads = [upload.clone() for upload in uploads]
+    state_indexes = collections.defaultdict(list)
+    
+    for (index, upload) in enumerate(uploads):
+        if 'US President 2016 - DEM' in upload.districts[0]['totals'] \
+        and 'US President 2016 - REP' in upload.districts[0]['totals']:
+            state_indexes[upload.model.state].append(index)
+    
+    for (state, indexes) in state_indexes.items():
+        # Get large number of simulated outputs for all plans in this state
+        all_output_votes = matrix.model_votes_batch(
+            state,
+            matrix.YEAR,
+            [matrix.prepare_district_data(uploads[index]) for index in indexes],
+        )
+        
+        for (index, output_votes) in zip(indexes, all_output_votes):
+            output_uploads[index] = summarize_district_votes(uploads[index], output_votes)
+    
+    return output_uploads
+
+def summarize_district_votes(upload, output_votes):
+    ''' Return upload with partisan metrics for a DxSx2 array of modeled votes.
+    '''
     # Record per-district vote totals and confidence intervals
     copied_districts = copy.deepcopy(upload.districts)
     
@@ -402,22 +474,16 @@ def calculate_district_biases(upload):
                 'Republican Votes SD': None,
                 })
     
-    # For each sim, a list of red votes and a list of blue votes in districts
-    red_votes_blue_votes = [
-        (
-            matrix.dropna(output_votes[:,sim,1]).tolist(),
-            matrix.dropna(output_votes[:,sim,0]).tolist(),
-        )
-        for sim in range(output_votes.shape[1])
-    ]
+    # Districts × sims arrays of red and blue votes
+    red_votes, blue_votes = output_votes[:,:,1], output_votes[:,:,0]
     
-    # Calculate partisanship metrics for all simulations
-    MMDs = [calculate_MMD(r, b) for (r, b) in red_votes_blue_votes]
-    PBs = [calculate_PB(r, b) for (r, b) in red_votes_blue_votes]
+    # Calculate partisanship metrics for all simulations at once
+    MMDs = calculate_MMD_array(red_votes, blue_votes).tolist()
+    PBs = calculate_PB_array(red_votes, blue_votes).tolist()
     
     # EG alone also gets a sensitivity test for vote swing scenarios
     EGs = {
-        swing: [calculate_EG(r, b, swing/100) for (r, b) in red_votes_blue_votes]
+        swing: calculate_EG_array(red_votes, blue_votes, swing/100).tolist()
         for swing in (0, 1, -1, 2, -2, 3, -3, 4, -4, 5, -5)
     }
 
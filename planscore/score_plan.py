@@ -0,0 +1,140 @@
+''' Score a plan file against a local model directory without AWS Lambda.
+
+Local model directory is one written by planscore-prepare-state without --s3,
+such as "data/XX/000" with "tiles" and "totals" inside. Tiles are scored in a
+process pool and added up with the same functions used by RunTile and
+ObserveTiles, followed by the usual score.calculate_* chain.
+'''
+import os, io, sys, json, time, argparse, posixpath, contextlib, concurrent.futures
+import botocore.exceptions, osgeo.ogr
+from . import data, tiles, observe, score, postread_calculate, preread_followup, util
+
+# Per-process state for pool workers, see init_worker()
+_worker = {}
+
+class LocalS3:
+    ''' Stand-in for a boto3 S3 client that reads object keys as local paths.
+    '''
+    def get_object(self, Bucket, Key):
+        if not os.path.exists(Key):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+        with open(Key, 'rb') as file:
+            return {'Body': io.BytesIO(file.read())}
+
+def list_local_tiles(model_dir):
+    ''' Return list of tile paths in a local model directory, most costly first.
+    '''
+    tile_paths = []
+
+    for (dirpath, _, filenames) in os.walk(posixpath.join(model_dir, 'tiles')):
+        for filename in filenames:
+            if filename.endswith('.geojson') or filename.endswith('.bin'):
+                tile_paths.append(posixpath.join(dirpath, filename))
+
+    costs_path = posixpath.join(model_dir, 'costs.json')
+    tile_costs = {}
+    
+    if os.path.exists(costs_path):
+        with open(costs_path) as file:
+            tile_costs = json.load(file)
+
+    # Sort most costly items first, as in postread_calculate.load_model_tiles()
+    tile_paths.sort(key=lambda path: (-tile_costs.get(tiles.get_tile_zxy(model_dir, path), 0),
+        -os.path.getsize(path), path))
+    return tile_paths
+
+def init_worker(upload, geometry_wkbs):
+    ''' Set up district geometries once for each pool worker process.
+    '''
+    # Keep progress messages from tile loaders out of JSON output
+    sys.stdout = sys.stderr
+
+    _worker['upload'] = upload
+    _worker['storage'] = data.Storage(LocalS3(), None, upload.model.key_prefix)
+    _worker['geometries'] = {key: osgeo.ogr.CreateGeometryFromWkb(wkb)
+        for (key, wkb) in geometry_wkbs.items()}
+
+def run_tile(tile_key, geometry_keys):
+    ''' Return a Tile for one tile path scored against some district keys.
+    '''
+    start_time, profile = time.time(), util.Profile()
+    geometries = {key: _worker['geometries'][key] for key in geometry_keys}
+
+    totals, feature_count = tiles.score_tile_key(_worker['storage'],
+        _worker['upload'], tile_key, geometries, profile)
+
+    timing = dict(
+        start_time=round(start_time, 3),
+        elapsed_time=round(time.time() - start_time, 3),
+        features=feature_count,
+        tile_key=tile_key,
+        **profile.to_dict()
+    )
+
+    return observe.Tile(totals, timing)
+
+def score_plan(plan_path, model_dir, processes=None):
+    ''' Return a scored Upload for a plan file and a local model directory.
+    '''
+    guessed_model = preread_followup.guess_geometry_model(plan_path)
+    model = data.Model(guessed_model.state, guessed_model.house, guessed_model.seats,
+        guessed_model.incumbency, guessed_model.version, model_dir.rstrip('/'))
+
+    upload_id, _ = os.path.splitext(os.path.basename(plan_path))
+    geometries = postread_calculate.read_district_geometries(plan_path)
+    geometry_keys = [data.UPLOAD_GEOMETRIES_KEY.format(id=upload_id, index=index)
+        for index in range(len(geometries))]
+
+    upload1 = data.Upload(upload_id, plan_path, model=model,
+        districts=observe.populate_compactness(geometries))
+
+    model_tile_keys = list_local_tiles(model.key_prefix)
+    tile_districts = postread_calculate.index_tile_districts(model,
+        model_tile_keys, geometry_keys, geometries)
+    tile_keys = [key for key in model_tile_keys if tile_districts[key]]
+
+    geometry_wkbs = {key: bytes(geometry.ExportToWkb())
+        for (key, geometry) in zip(geometry_keys, geometries)}
+    district_totals = observe.DistrictTotals(len(geometries))
+
+    with concurrent.futures.ProcessPoolExecutor(processes,
+        initializer=init_worker, initargs=(upload1, geometry_wkbs)) as executor:
+        futures = [executor.submit(run_tile, tile_key, tile_districts[tile_key])
+            for tile_key in tile_keys]
+
+        # Add up tiles in the order they finish
+        for future in concurrent.futures.as_completed(futures):
+            district_totals.add_tile(future.result(), upload1)
+
+    upload2 = upload1.clone(districts=district_totals.districts(upload1))
+    upload3 = score.calculate_bias(upload2)
+    upload4 = score.calculate_open_biases(upload3)
+    upload5 = score.calculate_biases(upload4)
+    upload6 = score.calculate_district_biases(upload5)
+
+    return upload6.clone(
+        status=True,
+        message='Finished scoring this plan.',
+        progress=data.Progress(len(tile_keys), len(tile_keys)),
+    )
+
+parser = argparse.ArgumentParser(description='Score a plan using local model tiles')
+parser.add_argument('filename', help='Name of geographic file with district plan')
+parser.add_argument('directory', help='Local model directory from planscore-prepare-state')
+parser.add_argument('--processes', type=int, default=None,
+    help='Number of worker processes. Default number of CPUs.')
+parser.add_argument('--output', help='Path to JSON file for scored upload. Default stdout.')
+
+def main():
+    args = parser.parse_args()
+
+    # Keep progress messages out of JSON output
+    with contextlib.redirect_stdout(sys.stderr):
+        upload = score_plan(args.filename, args.directory, args.processes)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(upload.to_json())
+    else:
+        print(upload.to_json())
@@ -0,0 +1,238 @@
+''' Generate a synthetic statewide precinct layer and district plan for load testing.
+
+Precincts are a jittered grid of polygons with wiggly shared edges centered
+on Null Island, so plans are guessed as the "XX" model. Edges are generated
+once per grid edge, so neighboring precincts and districts line up exactly.
+Output feeds straight into planscore-prepare-state and planscore-score-plan:
+
+    planscore-synthetic-state out --precincts 25000 --districts 53 --sims 1000
+    planscore-prepare-state --binary out/precincts.geojson XX/999
+    planscore-score-plan out/plan.geojson data/XX/999
+'''
+import os, math, json, random, hashlib, argparse, itertools, functools
+import numpy
+from . import data, score
+
+DEFAULT_PRECINCTS, DEFAULT_DISTRICTS, DEFAULT_SIMS = 25000, 53, 100
+DEFAULT_VERTICES, DEFAULT_WIDTH, DEFAULT_HEIGHT = 8, 8., 6.
+
+# Portion of a grid cell that nodes move and edges wiggle
+NODE_JITTER, EDGE_WIGGLE = .25, .1
+
+COORDINATE_PRECISION = 7
+
+def noise(seed, *values):
+    ''' Return a repeatable pseudorandom number from 0 to 1 for some values.
+    '''
+    digest = hashlib.blake2b(repr((seed, ) + values).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') / 2**64
+
+class Grid:
+    ''' Jittered grid of nodes with wiggly edges between them.
+        
+        Nodes are numbered (i, j) from the southwest corner, with i along x
+        and j along y. Nodes on the outside edge stay on the outside edge.
+    '''
+    def __init__(self, columns, rows, width, height, vertices, seed):
+        self.columns, self.rows = columns, rows
+        self.xmin, self.ymin = -width / 2, -height / 2
+        self.dx, self.dy = width / columns, height / rows
+        self.vertices, self.seed = vertices, seed
+    
+    def node(self, i, j):
+        ''' Return (x, y) for a grid node.
+        '''
+        x, y = self.xmin + i * self.dx, self.ymin + j * self.dy
+        
+        if 0 < i < self.columns:
+            x += (noise(self.seed, 'x', i, j) - .5) * 2 * NODE_JITTER * self.dx
+        
+        if 0 < j < self.rows:
+            y += (noise(self.seed, 'y', i, j) - .5) * 2 * NODE_JITTER * self.dy
+        
+        return (x, y)
+    
+    def edge(self, i, j, vertical):
+        ''' Return list of (x, y) points from node (i, j) to its east or north neighbor.
+        '''
+        (x1, y1) = self.node(i, j)
+        (x2, y2) = self.node(i, j + 1) if vertical else self.node(i + 1, j)
+        
+        # Outside edges are straight, so the state is a plain rectangle
+        outside = (i in (0, self.columns)) if vertical else (j in (0, self.rows))
+        cell = self.dx if vertical else self.dy
+        amplitude = 0 if outside else (noise(self.seed, 'e', i, j, vertical) - .5) * 2 * EDGE_WIGGLE * cell
+        length = math.hypot(x2 - x1, y2 - y1)
+        (px, py) = ((y1 - y2) / length, (x2 - x1) / length) if length else (0, 0)
+        points = []
+        
+        for index in range(self.vertices + 2):
+            t = index / (self.vertices + 1)
+            offset = amplitude * math.sin(math.pi * t)
+            points.append((x1 + t * (x2 - x1) + offset * px, y1 + t * (y2 - y1) + offset * py))
+        
+        return points
+    
+    def ring(self, i0, j0, i1, j1):
+        ''' Return closed counter-clockwise ring around cells from (i0, j0) to (i1, j1).
+        '''
+        edges = [self.edge(i, j0, False) for i in range(i0, i1)] \
+            + [self.edge(i1, j, True) for j in range(j0, j1)] \
+            + [self.edge(i, j1, False)[::-1] for i in reversed(range(i0, i1))] \
+            + [self.edge(i0, j, True)[::-1] for j in reversed(range(j0, j1))]
+        
+        points = [point for edge in edges for point in edge[:-1]]
+        points.append(points[0])
+        
+        return [[round(x, COORDINATE_PRECISION), round(y, COORDINATE_PRECISION)] for (x, y) in points]
+
+def grid_shape(count, width, height):
+    ''' Return (columns, rows) for a grid of about count cells with square-ish cells.
+    '''
+    columns = max(1, round(math.sqrt(count * width / height)))
+    rows = max(1, math.ceil(count / columns))
+    
+    return columns, rows
+
+def split_range(length, parts):
+    ''' Return list of (start, end) tuples splitting range(length) into even parts.
+    '''
+    bounds = [round(length * part / parts) for part in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def district_blocks(columns, rows, district_count, width, height):
+    ''' Return list of (i0, j0, i1, j1) grid cell blocks, one for each district.
+        
+        Districts are laid out in horizontal bands of side-by-side blocks.
+    '''
+    band_count = min(rows, district_count, max(1, round(math.sqrt(district_count * height / width))))
+    band_sizes = [end - start for (start, end) in split_range(district_count, band_count)]
+    
+    if max(band_sizes) > columns:
+        raise ValueError(f'Too many districts for a {columns}×{rows} grid of precincts')
+    
+    blocks = []
+    
+    for ((j0, j1), band_size) in zip(split_range(rows, band_count), band_sizes):
+        for (i0, i1) in split_range(columns, band_size):
+            blocks.append((i0, j0, i1, j1))
+    
+    return blocks
+
+@functools.lru_cache(maxsize=16)
+def sim_field_names(incumbent, party, sims):
+    ''' Return list of simulated vote field names, formatted once for all precincts.
+    '''
+    return [score.FIELD_TMPL.format(party=party, incumbent=incumbent, sim=sim) for sim in range(sims)]
+
+def precinct_properties(index, x, y, sims, seed):
+    ''' Return dictionary of population and simulated votes for one precinct.
+        
+        Democratic share varies smoothly over space, so districts differ.
+    '''
+    rand = random.Random(f'{seed}:{index}')
+    population = round(rand.lognormvariate(7, .8))
+    turnout = population * rand.uniform(.3, .6)
+    share = min(.95, max(.05, .5 + .25 * math.sin(x * 1.3) * math.cos(y * .9) + rand.gauss(0, .05)))
+    
+    properties = {
+        'GEOID': f'{index:08d}',
+        'Population 2010': population,
+        'US President 2016 - DEM': round(turnout * share, 2),
+        'US President 2016 - REP': round(turnout * (1 - share), 2),
+        }
+    
+    sims_rand = numpy.random.default_rng([seed, index])
+    
+    for incumbency in data.Incumbency:
+        # Incumbents get a small bump for their party
+        bump = {'D': .03, 'R': -.03}.get(incumbency.value, 0)
+        sim_shares = numpy.clip(share + bump + sims_rand.normal(0, .03, sims), .01, .99)
+        
+        properties.update(zip(sim_field_names(incumbency.value, 'DEM', sims),
+            numpy.round(turnout * sim_shares, 2).tolist()))
+        properties.update(zip(sim_field_names(incumbency.value, 'REP', sims),
+            numpy.round(turnout * (1 - sim_shares), 2).tolist()))
+    
+    return properties
+
+def write_precincts(path, grid, sims, seed):
+    ''' Write precinct GeoJSON one feature at a time, return number of precincts.
+    '''
+    count = 0
+    
+    with open(path, 'w') as file:
+        file.write('{"type": "FeatureCollection", "features": [\n')
+        
+        for (j, i) in itertools.product(range(grid.rows), range(grid.columns)):
+            (x, y) = grid.node(i, j)
+            feature = dict(type='Feature',
+                properties=precinct_properties(count, x, y, sims, seed),
+                geometry=dict(type='Polygon', coordinates=[grid.ring(i, j, i + 1, j + 1)]))
+            
+            file.write(',\n' if count else '')
+            file.write(json.dumps(feature, separators=(',', ':')))
+            count += 1
+        
+        file.write('\n]}\n')
+    
+    return count
+
+def write_plan(path, grid, blocks):
+    ''' Write district plan GeoJSON with one polygon for each block of precincts.
+    '''
+    features = [dict(type='Feature', properties={'District': index + 1},
+        geometry=dict(type='Polygon', coordinates=[grid.ring(*block)]))
+        for (index, block) in enumerate(blocks)]
+    
+    with open(path, 'w') as file:
+        json.dump(dict(type='FeatureCollection', features=features), file)
+
+def write_state(directory, precincts=DEFAULT_PRECINCTS, districts=DEFAULT_DISTRICTS,
+        sims=DEFAULT_SIMS, vertices=DEFAULT_VERTICES, width=DEFAULT_WIDTH,
+        height=DEFAULT_HEIGHT, seed=0):
+    ''' Write precincts.geojson and plan.geojson to a directory, return their paths.
+        
+        precincts is approximate, rounded to fill a grid. sims is the number
+        of simulations for each incumbency condition, with 6 fields each.
+        vertices is the number of extra vertices along each precinct edge.
+    '''
+    columns, rows = grid_shape(precincts, width, height)
+    grid = Grid(columns, rows, width, height, vertices, seed)
+    blocks = district_blocks(columns, rows, districts, width, height)
+    
+    os.makedirs(directory, exist_ok=True)
+    precincts_path = os.path.join(directory, 'precincts.geojson')
+    plan_path = os.path.join(directory, 'plan.geojson')
+    
+    write_precincts(precincts_path, grid, sims, seed)
+    write_plan(plan_path, grid, blocks)
+    
+    return precincts_path, plan_path
+
+parser = argparse.ArgumentParser(description='Generate a synthetic state for load testing')
+parser.add_argument('directory', help='Output directory for precincts.geojson and plan.geojson')
+parser.add_argument('--precincts', type=int, default=DEFAULT_PRECINCTS,
+    help='Approximate number of precincts. Default {}.'.format(DEFAULT_PRECINCTS))
+parser.add_argument('--districts', type=int, default=DEFAULT_DISTRICTS,
+    help='Number of districts in plan. Default {}.'.format(DEFAULT_DISTRICTS))
+parser.add_argument('--sims', type=int, default=DEFAULT_SIMS,
+    help='Number of simulations, 6 fields each. Default {}.'.format(DEFAULT_SIMS))
+parser.add_argument('--vertices', type=int, default=DEFAULT_VERTICES,
+    help='Extra vertices along each precinct edge. Default {}.'.format(DEFAULT_VERTICES))
+parser.add_argument('--width', type=float, default=DEFAULT_WIDTH,
+    help='Width of state in degrees. Default {}.'.format(DEFAULT_WIDTH))
+parser.add_argument('--height', type=float, default=DEFAULT_HEIGHT,
+    help='Height of state in degrees. Default {}.'.format(DEFAULT_HEIGHT))
+parser.add_argument('--seed', type=int, default=0, help='Random seed. Default 0.')
+
+def main():
+    args = parser.parse_args()
+    
+    if not 0 <= args.sims <= 1000:
+        parser.error('--sims must be from 0 to 1000')
+    
+    precincts_path, plan_path = write_state(args.directory, args.precincts,
+        args.districts, args.sims, args.vertices, args.width, args.height, args.seed)
+    
+    print('Wrote', precincts_path, 'and', plan_path)
@@ -0,0 +1,94 @@
+import json, unittest, unittest.mock
+from .. import benchmark, score
+
+class TestBenchmark (unittest.TestCase):
+
+    def test_measure(self):
+        ''' Stages are timed, and stages that fail are reported with errors.
+        '''
+        stage = benchmark.Stage('sum', 1000, lambda: sum(range(1000)))
+        result = benchmark.measure(stage, 2)
+        
+        self.assertEqual(result.name, 'sum')
+        self.assertGreater(result.seconds, 0)
+        self.assertGreater(result.throughput, 0)
+        self.assertIsNotNone(result.peak_memory)
+        self.assertIsNone(result.error)
+        
+        stage = benchmark.Stage('oops', 1, lambda: 1 / 0)
+        result = benchmark.measure(stage, 2)
+        
+        self.assertIsNone(result.seconds)
+        self.assertIn('ZeroDivisionError', result.error)
+        self.assertIn('skipped', benchmark.format_result(result))
+    
+    def test_synthetic_upload(self):
+        ''' Synthetic uploads have the requested numbers of districts and fields.
+        '''
+        upload = benchmark.synthetic_upload(3, 120)
+        
+        self.assertEqual(len(upload.districts), 3)
+        self.assertEqual(len(upload.incumbents), 3)
+        self.assertEqual([len(d['totals']) for d in upload.districts], [120, 120, 120])
+        self.assertIn('O:DEM019', upload.districts[0]['totals'])
+        self.assertNotIn('O:DEM020', upload.districts[0]['totals'])
+        
+        upload = benchmark.synthetic_upload(2, 1)
+        self.assertEqual(upload.districts[0]['totals'], {'Extra 0': upload.districts[0]['totals']['Extra 0']})
+        
+        scored = benchmark.calculate_scores(benchmark.synthetic_upload(4, 60))
+        self.assertIn('Efficiency Gap', scored.summary)
+    
+    @unittest.mock.patch('planscore.score.calculate_district_biases')
+    def test_calculate_scores(self, calculate_district_biases):
+        ''' Score stages run the whole chain of calculations from ObserveTiles.
+        '''
+        calculate_district_biases.side_effect = lambda upload: upload
+        scored = benchmark.calculate_scores(benchmark.synthetic_upload(4, 60))
+        
+        self.assertEqual(len(calculate_district_biases.mock_calls), 1)
+        self.assertIn('Efficiency Gap', scored.summary)
+    
+    def test_baseline(self):
+        ''' Runs compare against the committed baseline by default.
+        '''
+        self.assertEqual(benchmark.parser.parse_args([]).baseline, benchmark.BASELINE_PATH)
+        
+        with open(benchmark.BASELINE_PATH) as file:
+            baseline = json.load(file)
+        
+        for (name, result) in baseline.items():
+            self.assertEqual(result['name'], name)
+            self.assertGreater(result['throughput'], 0)
+    
+    @unittest.mock.patch('planscore.tiles.score_tile_key')
+    def test_run_tile_key(self, score_tile_key):
+        ''' Tile stages score with the same function as RunTile, starting cold.
+        '''
+        score_tile_key.side_effect = lambda *args: print('Loading a tile') or ({}, 0)
+        benchmark.tiles._tile_cache.put('key', 'value', 1)
+        
+        with unittest.mock.patch('sys.stdout') as stdout:
+            result = benchmark.run_tile_key('storage', 'upload', 'tile.geojson', {0: 'geom'})
+        
+        self.assertEqual(result, ({}, 0))
+        self.assertEqual(score_tile_key.mock_calls, [unittest.mock.call(
+            'storage', 'upload', 'tile.geojson', {0: 'geom'})])
+        self.assertNotIn('key', benchmark.tiles._tile_cache)
+        self.assertFalse(stdout.write.mock_calls)
+    
+    def test_compare_results(self):
+        ''' Throughput drops beyond tolerance are reported as regressions.
+        '''
+        results = [
+            benchmark.Result('a', 1, 1., 100., 0, None),
+            benchmark.Result('b', 1, 1., 70., 0, None),
+            benchmark.Result('c', 1, None, None, None, 'Oops'),
+            benchmark.Result('d', 1, 1., 10., 0, None),
+            ]
+        
+        baseline = {'a': {'throughput': 110.}, 'b': {'throughput': 100.}, 'c': {'throughput': 100.}}
+        
+        self.assertEqual(benchmark.compare_results(results, baseline, .2), [('b', 100., 70.)])
+        self.assertEqual(benchmark.compare_results(results, baseline, .5), [])
+        self.assertIn('-30.0%', benchmark.format_result(results[1], baseline['b']))
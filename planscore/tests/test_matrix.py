@@ -1,4 +1,4 @@
-import unittest, unittest.mock
+import unittest, unittest.mock, os, gzip, time, tempfile, shutil
 from .. import matrix, data
 import numpy
 
@@ -43,6 +43,53 @@ class TestMatrix (unittest.TestCase):
         #self.assertAlmostEqual(model.c_matrix[7,0], -0.130211000)
         #self.assertAlmostEqual(model.c_matrix[8,0], 0.0129821061)
     
+    def test_load_matrices(self):
+        ''' Matrices are parsed from CSV once, or from .npy sidecars when present.
+        '''
+        tempdir = tempfile.mkdtemp(prefix='TestMatrix-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        
+        for (name, rows) in [('C_matrix_full', ['b_Intercept', 'b_dpres_mn']), ('E_matrix_full', ['1', '2', '3'])]:
+            with gzip.open(os.path.join(tempdir, f'{name}.csv.gz'), 'wt') as file:
+                file.write('"","V1","V2"\n')
+                for (index, row) in enumerate(rows):
+                    file.write(f'"{row}",{index}.5,{index}.25\n')
+        
+        c_matrix1, e_matrix1 = matrix.load_matrices(tempdir)
+        self.assertEqual(c_matrix1.rows, ['b_Intercept', 'b_dpres_mn'])
+        self.assertEqual(c_matrix1.values.tolist(), [[0.5, 0.25], [1.5, 1.25]])
+        self.assertEqual(e_matrix1.values.shape, (3, 2))
+        self.assertFalse(e_matrix1.values.flags.writeable, 'Shared values should be read-only')
+        self.assertIs(matrix.load_matrices(tempdir)[0], c_matrix1, 'Should be cached')
+        self.assertEqual(matrix.load_row_index(tempdir), {'b_Intercept': 0, 'b_dpres_mn': 1})
+        
+        matrix.write_sidecars(tempdir)
+        self.assertTrue(os.path.exists(os.path.join(tempdir, 'C_matrix_full.npy')))
+        self.assertTrue(os.path.exists(os.path.join(tempdir, 'E_matrix_full.rows.npy')))
+        
+        c_matrix2 = matrix.read_matrix(tempdir, 'C_matrix_full')
+        self.assertIsInstance(c_matrix2.values, numpy.memmap)
+        self.assertEqual(c_matrix2.rows, c_matrix1.rows)
+        self.assertEqual(c_matrix2.values.tolist(), c_matrix1.values.tolist())
+        
+        # Sidecars stay fresh when the CSV file is touched but unchanged
+        csv_path = os.path.join(tempdir, 'C_matrix_full.csv.gz')
+        os.utime(csv_path, (time.time() + 60, time.time() + 60))
+        self.assertIsInstance(matrix.read_matrix(tempdir, 'C_matrix_full').values, numpy.memmap)
+        
+        # Sidecars go stale when the CSV file content changes, even if older
+        with gzip.open(csv_path, 'wt') as file:
+            file.write('"","V1","V2"\n"b_Intercept",9.5,9.25\n')
+        os.utime(csv_path, (0, 0))
+        
+        c_matrix3 = matrix.read_matrix(tempdir, 'C_matrix_full')
+        self.assertNotIsInstance(c_matrix3.values, numpy.memmap)
+        self.assertEqual(c_matrix3.values.tolist(), [[9.5, 9.25]])
+        
+        # Without a CSV file the sidecars are used as-is
+        os.remove(csv_path)
+        self.assertEqual(matrix.read_matrix(tempdir, 'C_matrix_full').rows, c_matrix1.rows)
+    
     def test_apply_model(self):
         model = matrix.load_model('ca', None)
         
@@ -85,6 +132,47 @@ class TestMatrix (unittest.TestCase):
         
         self.assertTrue(numpy.isnan(R).all(), 'Everything should be NaN')
     
+    def test_apply_model_batch(self):
+        ''' Batches of plans are modeled just like one plan at a time.
+        '''
+        random = numpy.random.RandomState(0)
+        model = matrix.Model(None, None, None, None, None, None,
+            random.normal(size=(6, 20)), random.normal(size=(10, 20)))
+        
+        plans = [
+            [(.4, -1), (.5, 0), (.6, 1)],
+            [(.3, 0), (numpy.nan, 0)],
+            [(.7, 1), (.2, -1), (.5, 0), (.5, 1)],
+            ]
+        
+        R = matrix.apply_model_batch(plans, model)
+        self.assertEqual(len(R), len(plans))
+        
+        for (districts, fractions) in zip(plans, R):
+            expected = matrix.apply_model(districts, model)
+            self.assertEqual(fractions.shape, expected.shape)
+            self.assertTrue(numpy.allclose(fractions, expected, equal_nan=True))
+    
+    @unittest.mock.patch('planscore.matrix.load_model')
+    def test_model_votes_batch(self, load_model):
+        random = numpy.random.RandomState(0)
+        load_model.return_value = matrix.Model(None, None, None, None, None, None,
+            random.normal(size=(6, 20)) / 10, random.normal(size=(10, 20)) / 10)
+        
+        plans = [
+            [(4, 6, 'R'), (5, 5, 'O'), (6, 4, 'D')],
+            [(3, 7, 'O'), (0, 0, 'O')],
+            ]
+        
+        R = matrix.model_votes_batch(data.State.NC, None, plans)
+        self.assertEqual(len(load_model.mock_calls), 1, 'Should load model once for all plans')
+        self.assertEqual(load_model.mock_calls[0][1], ('nc', None))
+        
+        for (districts, votes) in zip(plans, R):
+            expected = matrix.model_votes(data.State.NC, None, districts)
+            self.assertEqual(votes.shape, expected.shape)
+            self.assertTrue(numpy.allclose(votes, expected, equal_nan=True))
+    
     @unittest.mock.patch('planscore.matrix.load_model')
     @unittest.mock.patch('planscore.matrix.apply_model')
     def test_model_votes(self, apply_model, load_model):
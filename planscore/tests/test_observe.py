@@ -1,6 +1,6 @@
 import unittest, unittest.mock, os, io, itertools, gzip, json
 import botocore.exceptions
-from .. import observe, data
+from .. import observe, data, tiles
 
 should_gzip = itertools.cycle([True, False])
 
@@ -17,6 +17,17 @@ def mock_s3_get_object(Bucket, Key):
         else:
             return {'Body': io.BytesIO(file.read())}
 
+def mock_s3_list_objects(Bucket, Prefix, Marker=''):
+    '''
+    '''
+    base = os.path.join(os.path.dirname(__file__), 'data')
+    keys = sorted(os.path.relpath(os.path.join(dirpath, filename), base)
+        for (dirpath, _, filenames) in os.walk(os.path.join(base, os.path.dirname(Prefix)))
+        for filename in filenames)
+    
+    return {'Contents': [{'Key': key} for key in keys
+        if key.startswith(Prefix) and key > Marker], 'IsTruncated': False}
+
 class TestObserveTiles (unittest.TestCase):
 
     def test_get_upload_index(self):
@@ -64,7 +75,7 @@ class TestObserveTiles (unittest.TestCase):
         storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
         upload.id = 'fake-id'
         observe.put_tile_timings(storage, upload, [
-            observe.Tile(None, dict(start_time=1.1, elapsed_time=2.2, features=3)),
+            observe.Tile(None, dict(start_time=1.1, elapsed_time=2.2, features=3, tile_key='a')),
             observe.Tile(None, dict(start_time=4.4, elapsed_time=5.5, features=6)),
         ])
         
@@ -72,9 +83,135 @@ class TestObserveTiles (unittest.TestCase):
         
         self.assertEqual(put_call[2], dict(Bucket=storage.bucket,
             Key=data.UPLOAD_TIMING_KEY.format(id=upload.id),
-            Body='features,start_time,elapsed_time\r\n3,1.1,2.2\r\n6,4.4,5.5\r\n',
+            Body='tile_key,features,start_time,elapsed_time,geometries_time,fetch_time,'
+                'decompress_time,parse_time,setup_time,intersect_time,aggregate_time,'
+                'precincts,vertices,cache_hits\r\na,3,1.1,2.2,,,,,,,,,,\r\n,6,4.4,5.5,,,,,,,,,,\r\n',
             ACL='public-read', ContentType='text/csv'))
 
+    def test_upload_profile(self):
+        ''' Tile timings are summarized with phases and a critical path
+        '''
+        upload = unittest.mock.Mock()
+        upload.model.key_prefix = 'data/XX'
+        
+        profile = observe.upload_profile(upload, [
+            observe.Tile(None, dict(tile_key='data/XX/tiles/12/1/1.geojson', start_time=100.,
+                elapsed_time=4., fetch_time=1., intersect_time=2.5, precincts=10, vertices=500)),
+            observe.Tile(None, dict(tile_key='data/XX/tiles/12/1/2.geojson', start_time=101.,
+                elapsed_time=3.5, fetch_time=.5, intersect_time=2., precincts=5, vertices=100)),
+            observe.Tile(None, dict(tile_key='data/XX/tiles/12/1/3.geojson', start_time=102.,
+                elapsed_time=.5, setup_time=.5, cache_hits=1)),
+            observe.Tile(None, dict(features=None)),
+        ])
+        
+        self.assertEqual(profile['tiles'], 3)
+        self.assertEqual(profile['total_seconds'], 8.)
+        self.assertEqual(profile['wall_seconds'], 4.5)
+        self.assertEqual(profile['phases']['fetch'], 1.5)
+        self.assertEqual(profile['phases']['intersect'], 4.5)
+        self.assertEqual(profile['phases']['other'], 1.5)
+        self.assertEqual(profile['phase_shares']['intersect'], .5625)
+        self.assertEqual(profile['counts'], {'precincts': 15, 'vertices': 600, 'cache_hits': 1})
+        self.assertEqual(profile['critical_path']['zxy'], '12/1/2')
+        self.assertEqual(profile['critical_path']['start_offset'], 1.)
+        self.assertEqual(profile['critical_path']['phases']['intersect'], 2.)
+        self.assertEqual([tile['zxy'] for tile in profile['slowest_tiles']], ['12/1/1', '12/1/2', '12/1/3'])
+        
+        self.assertEqual(observe.upload_profile(upload, []), {'tiles': 0})
+    
+    def test_put_model_timings(self):
+        ''' Tile timings are folded into model timing history
+        '''
+        storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        upload.model.key_prefix = 'data/XX'
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'{"12/1/1": 10.0, "12/1/2": 3.0}')}
+        
+        observe.put_model_timings(storage, upload, [
+            observe.Tile(None, dict(elapsed_time=2.0, tile_key='data/XX/tiles/12/1/1.geojson')),
+            observe.Tile(None, dict(elapsed_time=4.0, tile_key='data/XX/tiles/12/1/3.geojson')),
+            observe.Tile(None, dict(elapsed_time=9.0)),
+        ])
+        
+        self.assertEqual(storage.s3.get_object.mock_calls[0][2]['Key'], 'data/XX/timings.json')
+        
+        (put_call, ) = storage.s3.put_object.mock_calls
+        self.assertEqual(put_call[2]['Key'], 'data/XX/timings.json')
+        self.assertEqual(put_call[2]['ACL'], 'public-read')
+        self.assertEqual(json.loads(put_call[2]['Body']), {'12/1/1': 8.0, '12/1/2': 3.0, '12/1/3': 4.0})
+    
+    @unittest.mock.patch('time.time')
+    @unittest.mock.patch('sys.stdout')
+    def test_stragglers(self, stdout, time_time):
+        ''' Tiles taking much longer than expected are dispatched once more
+        '''
+        storage, upload, lam = unittest.mock.Mock(), unittest.mock.Mock(), unittest.mock.Mock()
+        upload.model.key_prefix = 'data/XX'
+        upload.id = 'ID'
+        upload.to_dict.return_value = {}
+        storage.to_event.return_value = {}
+        
+        enqueued_tiles = ['data/XX/tiles/12/1/1.geojson', 'data/XX/tiles/12/1/2.geojson',
+            ['data/XX/tiles/12/1/3.geojson', 'data/XX/tiles/12/1/4.geojson'], 'data/XX/tiles/12/1/5.geojson']
+        expected_tiles = [observe.get_expected_tile(key, upload) for key in enqueued_tiles]
+        model_timings = {'12/1/1': 20.0, '12/1/3': 1.0, '12/1/4': 2.0, '12/1/5': 1.0}
+        tile_districts = {key: [f'uploads/ID/geometries/{index}.wkt'] for (index, key)
+            in enumerate(enqueued_tiles[:2] + enqueued_tiles[2] + enqueued_tiles[3:])}
+        
+        # Fan-out is still going at first, then saves its invocation times
+        dispatch_times = {'data/XX/tiles/12/1/1.geojson': 1000, 'data/XX/tiles/12/1/2.geojson': 1000,
+            'data/XX/tiles/12/1/3.geojson': 1050, 'data/XX/tiles/12/1/5.geojson': 1000}
+        storage.s3.get_object.side_effect = [
+            botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject'),
+            {'Body': io.BytesIO(json.dumps(dispatch_times).encode('utf8'))},
+            ]
+        
+        time_time.return_value = 1000
+        stragglers = observe.Stragglers(storage, upload, enqueued_tiles, model_timings, lam, tile_districts)
+        
+        # Nothing is late before any tile has finished
+        time_time.return_value = 1010
+        self.assertEqual(stragglers.redispatch(expected_tiles), [])
+        
+        # Clocks start at the first result, or at a later invocation
+        time_time.return_value = 1040
+        self.assertEqual(stragglers.redispatch(expected_tiles[:3]), [])
+        self.assertEqual(storage.s3.get_object.mock_calls[-1][2]['Key'], 'uploads/ID/dispatched.json')
+        
+        # Tile 12/1/1 is expected in 60s, batch 12/1/3 in 30s, and 12/1/2 is unknown
+        time_time.return_value = 1075
+        self.assertEqual(stragglers.redispatch(expected_tiles[:3]), [])
+        
+        time_time.return_value = 1081
+        self.assertEqual(stragglers.redispatch(expected_tiles[:3]), [expected_tiles[2]])
+        
+        (invoke_call, ) = lam.invoke.mock_calls
+        payload = json.loads(invoke_call[2]['Payload'])
+        self.assertEqual(payload['tile_keys'], enqueued_tiles[2])
+        self.assertEqual(payload['geometry_keys'], ['uploads/ID/geometries/2.wkt', 'uploads/ID/geometries/3.wkt'])
+        self.assertTrue(payload['redispatched'])
+        
+        time_time.return_value = 1101
+        self.assertEqual(stragglers.redispatch(expected_tiles[:3]), [expected_tiles[0]])
+        
+        time_time.return_value = 9999
+        self.assertEqual(stragglers.redispatch(expected_tiles[:3]), [expected_tiles[1]])
+        self.assertEqual(stragglers.redispatch(expected_tiles[:3]), [])
+        self.assertEqual(len(lam.invoke.mock_calls), 3)
+        self.assertEqual(len(storage.s3.get_object.mock_calls), 2)
+    
+    def test_load_tile_districts(self):
+        ''' Saved tile districts are loaded, or None for older uploads.
+        '''
+        storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        upload.id = 'ID'
+        
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'{"data/XX/a.geojson": ["g"]}')}
+        self.assertEqual(observe.load_tile_districts(storage, upload), {'data/XX/a.geojson': ['g']})
+        self.assertEqual(storage.s3.get_object.mock_calls[0][2]['Key'], 'uploads/ID/tile-districts.json')
+        
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertIsNone(observe.load_tile_districts(storage, upload))
+    
     def test_expected_tile(self):
         ''' Expected tile is returned for an enqueued one.
         '''
@@ -87,6 +224,31 @@ class TestObserveTiles (unittest.TestCase):
         
         self.assertEqual(observe.get_expected_tile(enqueued_key, upload), expected_key)
     
+    def test_expected_tile_batch(self):
+        ''' A batch of tiles is expected at the first tile's output.
+        '''
+        upload = unittest.mock.Mock()
+        upload.model.key_prefix = 'data/XX'
+        upload.id = 'ID'
+        
+        enqueued_keys = ['data/XX/tiles/12/656/1582.geojson', 'data/XX/tiles/12/656/1583.geojson']
+        expected_key = 'uploads/ID/tiles/12/656/1582.json'
+        
+        self.assertEqual(observe.get_expected_tile(enqueued_keys, upload), expected_key)
+    
+    def test_load_tiles_batch(self):
+        ''' A batch result is loaded as a list of Tiles.
+        '''
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(json.dumps({'tiles': [
+            {'tile_key': 'a', 'totals': {'k': {'Voters': 1}}, 'timing': {'features': 1}},
+            {'tile_key': 'b', 'totals': 'Oops', 'timing': {'features': None}},
+            ]}).encode('utf8'))}
+        
+        tiles = observe.load_tiles(storage, 'uploads/ID/tiles/12/2047/2047.json')
+        self.assertEqual(tiles, [observe.Tile({'k': {'Voters': 1}}, {'features': 1}),
+            observe.Tile('Oops', {'features': None})])
+    
     def test_get_district_index(self):
         '''
         '''
@@ -121,6 +283,27 @@ class TestObserveTiles (unittest.TestCase):
         s3.list_objects.assert_called_once_with(Bucket='bucket-name',
             Prefix="uploads/sample-plan/geometries/")
 
+    @unittest.mock.patch('planscore.tiles.read_geometry_bundle')
+    @unittest.mock.patch('planscore.tiles.load_geometry_bundle')
+    def test_load_upload_geometries_bundle(self, load_geometry_bundle, read_geometry_bundle):
+        ''' Geometries from a bundle are ordered by district index.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'ID'
+
+        read_geometry_bundle.return_value = {
+            'uploads/ID/geometries/10.wkt': 'ten',
+            'uploads/ID/geometries/2.wkt': 'two',
+            'uploads/ID/geometries/0.wkt': 'zero',
+            }
+
+        geometries = observe.load_upload_geometries(storage, upload)
+
+        self.assertEqual(geometries, ['zero', 'two', 'ten'])
+        self.assertEqual(read_geometry_bundle.mock_calls[0][1], (load_geometry_bundle.return_value, ))
+        self.assertEqual(len(s3.list_objects.mock_calls), 0)
+
     @unittest.mock.patch('planscore.compactness.get_scores')
     def test_populate_compactness(self, get_scores):
         '''
@@ -142,6 +325,7 @@ class TestObserveTiles (unittest.TestCase):
         
         storage = unittest.mock.Mock()
         storage.s3.get_object.side_effect = mock_s3_get_object
+        storage.s3.list_objects.side_effect = mock_s3_list_objects
 
         expected_tiles = [f'uploads/sample-plan/tiles/{zxy}.json' for zxy
             in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048')]
@@ -168,6 +352,7 @@ class TestObserveTiles (unittest.TestCase):
         
         storage = unittest.mock.Mock()
         storage.s3.get_object.side_effect = mock_s3_get_object
+        storage.s3.list_objects.side_effect = mock_s3_list_objects
 
         expected_tiles = [f'uploads/sample-plan2/tiles/{zxy}.json' for zxy
             in ('9/255/255', '9/255/256', '9/256/255', '9/256/256')]
@@ -184,6 +369,61 @@ class TestObserveTiles (unittest.TestCase):
         self.assertEqual(tile_totals[2].totals['uploads/sample-plan2/geometries/1.wkt']['Voters'], 455.99)
         self.assertEqual(tile_totals[3].totals['uploads/sample-plan2/geometries/1.wkt']['Voters'], 373.76)
     
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch('sys.stdout')
+    def test_iterate_tile_totals_out_of_order(self, stdout, sleep):
+        ''' Tiles are returned as they finish, with one listing per sweep.
+        '''
+        upload = unittest.mock.Mock()
+        context = unittest.mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 9999
+
+        expected_tiles = [f'uploads/sample-plan/tiles/{zxy}.json' for zxy
+            in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048')]
+        
+        # Local stand-in for S3 where tiles finish in reverse order over three sweeps
+        finished_sweeps = [[], expected_tiles[2:], expected_tiles[:2]]
+        finished_keys = []
+        
+        def list_objects(Bucket, Prefix, Marker):
+            finished_keys.extend(finished_sweeps.pop(0))
+            return {'Contents': [{'Key': key} for key in sorted(finished_keys)], 'IsTruncated': False}
+        
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.side_effect = mock_s3_get_object
+        storage.s3.list_objects.side_effect = list_objects
+
+        tile_totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context))
+        
+        self.assertEqual(len(tile_totals), 4)
+        self.assertEqual(tile_totals[0].totals['uploads/sample-plan/geometries/1.wkt']['Voters'], 455.99)
+        self.assertEqual(tile_totals[1].totals['uploads/sample-plan/geometries/1.wkt']['Voters'], 373.76)
+        self.assertEqual(tile_totals[2].totals['uploads/sample-plan/geometries/1.wkt']['Voters'],  87.2)
+        self.assertEqual(tile_totals[3].totals['uploads/sample-plan/geometries/1.wkt']['Voters'],  15.94)
+        
+        self.assertEqual(storage.s3.list_objects.call_count, 3)
+        self.assertEqual(storage.s3.list_objects.mock_calls[0][2]['Prefix'], 'uploads/sample-plan/tiles/12/204')
+        self.assertEqual(sleep.mock_calls, [unittest.mock.call(observe.TILE_SWEEP_INTERVAL)])
+    
+    @unittest.mock.patch('time.sleep')
+    @unittest.mock.patch('sys.stdout')
+    def test_iterate_tile_totals_overdue(self, stdout, sleep):
+        ''' Plan is given up on when tiles do not finish in time.
+        '''
+        upload = unittest.mock.Mock()
+        context = unittest.mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 999
+        
+        storage = unittest.mock.Mock()
+        storage.s3.list_objects.return_value = {'IsTruncated': False}
+
+        expected_tiles = ['uploads/sample-plan/tiles/12/2047/2047.json']
+        tile_totals = list(observe.iterate_tile_totals(expected_tiles, storage, upload, context))
+        
+        self.assertEqual(tile_totals, [])
+        self.assertFalse(storage.s3.get_object.called)
+        self.assertEqual(upload.clone.return_value.clone.call_args[1]['status'], False)
+    
     def test_accumulate_district_totals(self):
         '''
         '''
@@ -234,6 +474,58 @@ class TestObserveTiles (unittest.TestCase):
         self.assertEqual(districts3[0]['totals']['Voters'], 567.09)
         self.assertEqual(districts3[1]['totals']['Voters'], 932.89)
 
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('planscore.observe.put_upload_index')
+    def test_iterate_tile_totals_district_totals(self, put_upload_index, stdout):
+        ''' Tiles are added to running district totals as they arrive.
+        '''
+        upload = unittest.mock.Mock()
+        upload.id = 'sample-plan'
+        upload.districts = [None, None]
+        context = unittest.mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 9999
+        
+        storage = unittest.mock.Mock()
+        storage.s3.get_object.side_effect = mock_s3_get_object
+        storage.s3.list_objects.side_effect = mock_s3_list_objects
+
+        expected_tiles = [f'uploads/sample-plan/tiles/{zxy}.json' for zxy
+            in ('12/2047/2047', '12/2047/2048', '12/2048/2047', '12/2048/2048')]
+        
+        district_totals = observe.DistrictTotals(2)
+        tile_totals = list(observe.iterate_tile_totals(expected_tiles,
+            storage, upload, context, district_totals))
+        
+        self.assertEqual(len(tile_totals), 4)
+        self.assertEqual(district_totals.districts(upload),
+            observe.accumulate_district_totals(tile_totals, upload))
+        
+        # Partial totals are never published with progress
+        self.assertTrue(put_upload_index.mock_calls)
+        for clone_call in upload.clone.mock_calls:
+            self.assertNotIn('districts', clone_call.kwargs)
+    
+    def test_district_totals(self):
+        ''' Unknown fields and erroneous tiles are handled in district totals.
+        '''
+        upload = unittest.mock.Mock()
+        upload.id = 'sample-plan'
+        upload.districts = [None, {'totals': {'Voters': 1}}]
+        
+        district_totals = observe.DistrictTotals(2)
+        district_totals.add_tile(observe.Tile({
+            'uploads/sample-plan/geometries/0.wkt': {'Voters': 2, 'Novel Field': 3},
+            'uploads/sample-plan/geometries/1.wkt': {'Voters': 4},
+            }, {}), upload)
+        
+        with unittest.mock.patch('sys.stdout'):
+            district_totals.add_tile(observe.Tile('Oops', {}), upload)
+        
+        districts = district_totals.districts(upload)
+        self.assertEqual(districts[0], {'totals': {'Voters': 2, 'Novel Field': 3}})
+        self.assertEqual(districts[1], {'totals': {'Voters': 5}})
+        self.assertEqual(upload.districts[1], {'totals': {'Voters': 1}})
+
     def test_adjust_household_income(self):
         '''
         '''
@@ -1,5 +1,6 @@
-import unittest, unittest.mock, io, os, contextlib
-from .. import postread_calculate, data, constants
+import unittest, unittest.mock, io, os, contextlib, json, threading
+import botocore.exceptions
+from .. import postread_calculate, data, constants, tiles, prepare_state
 from osgeo import ogr
 
 class TestPostreadCalculate (unittest.TestCase):
@@ -115,7 +116,8 @@ class TestPostreadCalculate (unittest.TestCase):
         s3 = unittest.mock.Mock()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
-        keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
+        geometries = postread_calculate.read_district_geometries(null_plan_path)
+        keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, geometries)
         self.assertEqual(keys, ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt'])
     
     @unittest.mock.patch('sys.stdout')
@@ -125,12 +127,42 @@ class TestPostreadCalculate (unittest.TestCase):
         s3 = unittest.mock.Mock()
         upload = data.Upload('ID', 'uploads/ID/upload/file.geojson')
         null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan-missing-geometries.geojson')
-        keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, null_plan_path)
+        geometries = postread_calculate.read_district_geometries(null_plan_path)
+        keys = postread_calculate.put_district_geometries(s3, 'bucket-name', upload, geometries)
         self.assertEqual(keys, ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt', 'uploads/ID/geometries/2.wkt'])
         
-        put_kwargs = s3.put_object.mock_calls[2][2]
-        self.assertEqual(put_kwargs['Key'], 'uploads/ID/geometries/2.wkt')
-        self.assertEqual(put_kwargs['Body'], 'GEOMETRYCOLLECTION EMPTY')
+        self.assertEqual(len(s3.put_object.mock_calls), 1, 'Should put one geometry bundle')
+        put_kwargs = s3.put_object.mock_calls[0][2]
+        self.assertEqual(put_kwargs['Key'], 'uploads/ID/geometries.bin')
+        
+        geometries = tiles.read_geometry_bundle(put_kwargs['Body'])
+        self.assertEqual(list(geometries.keys()), keys)
+        self.assertEqual(geometries[keys[2]].ExportToWkt(), 'GEOMETRYCOLLECTION EMPTY')
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_index_tile_districts(self, stdout):
+        ''' Only overlapping districts are listed for each tile.
+        '''
+        model = unittest.mock.Mock()
+        model.key_prefix = 'data/XX'
+        null_plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        geometries = postread_calculate.read_district_geometries(null_plan_path)
+        geometry_keys = ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt']
+        
+        tile_keys = ['data/XX/tiles/12/2047/2047.geojson', 'data/XX/tiles/12/2048/2047.geojson',
+            'data/XX/tiles/12/2047/2048.geojson', 'data/XX/tiles/12/2048/2048.geojson',
+            'data/XX/tiles/12/2060/2060.geojson']
+        
+        tile_districts = postread_calculate.index_tile_districts(model, tile_keys,
+            geometry_keys, geometries)
+        
+        self.assertEqual(tile_districts, {
+            'data/XX/tiles/12/2047/2047.geojson': geometry_keys,
+            'data/XX/tiles/12/2048/2047.geojson': geometry_keys[1:],
+            'data/XX/tiles/12/2047/2048.geojson': geometry_keys,
+            'data/XX/tiles/12/2048/2048.geojson': geometry_keys[1:],
+            'data/XX/tiles/12/2060/2060.geojson': [],
+            })
     
     @unittest.mock.patch('sys.stdout')
     def test_load_model_tiles_oldstyle(self, stdout):
@@ -138,6 +170,8 @@ class TestPostreadCalculate (unittest.TestCase):
         '''
         storage, model = unittest.mock.Mock(), unittest.mock.Mock()
         model.key_prefix = 'data/XX'
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
         storage.s3.list_objects.return_value = {'Contents': [
             ], 'IsTruncated': False}
         
@@ -155,6 +189,8 @@ class TestPostreadCalculate (unittest.TestCase):
         '''
         storage, model = unittest.mock.Mock(), unittest.mock.Mock()
         model.key_prefix = 'data/XX'
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
         storage.s3.list_objects.return_value = {'Contents': [
             {'Key': 'data/XX/tiles/a.geojson', 'Size': 2},
             {'Key': 'data/XX/tiles/b.geojson', 'Size': 4},
@@ -174,6 +210,71 @@ class TestPostreadCalculate (unittest.TestCase):
             'data/XX/tiles/a.geojson', 'data/XX/tiles/e.geojson',
             'data/XX/tiles/d.geojson'][:constants.MAX_TILES_RUN])
     
+    def test_load_tile_costs(self):
+        ''' Cost manifests are read from where prepare_state writes them.
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix = 'data/XX/006-tilesdir/'
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'{"12/1/1": 10}')}
+        
+        self.assertEqual(postread_calculate.load_tile_costs(storage, model), {'12/1/1': 10})
+        self.assertEqual(storage.s3.get_object.mock_calls[0][2]['Key'],
+            prepare_state.COSTS_KEY_FORMAT.format(directory='XX/006-tilesdir'))
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_load_model_tiles_costs(self, stdout):
+        ''' Tiles are sorted by manifest cost, then by size.
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix = 'data/XX'
+        
+        def get_object(Bucket, Key):
+            if Key == 'data/XX/costs.json':
+                return {'Body': io.BytesIO(b'{"12/1/1": 10, "12/1/2": 30, "12/1/3": 20}')}
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        
+        storage.s3.get_object.side_effect = get_object
+        storage.s3.list_objects.return_value = {'Contents': [
+            {'Key': 'data/XX/tiles/12/1/1.geojson', 'Size': 4},
+            {'Key': 'data/XX/tiles/12/1/2.geojson', 'Size': 2},
+            {'Key': 'data/XX/tiles/12/1/3.geojson', 'Size': 3},
+            {'Key': 'data/XX/tiles/12/1/4.geojson', 'Size': 5},
+            ], 'IsTruncated': False}
+        
+        tile_keys = postread_calculate.load_model_tiles(storage, model)
+        
+        self.assertEqual(storage.s3.get_object.mock_calls[0][2]['Key'], 'data/XX/costs.json')
+        self.assertEqual(tile_keys,
+            ['data/XX/tiles/12/1/2.geojson', 'data/XX/tiles/12/1/3.geojson',
+            'data/XX/tiles/12/1/1.geojson', 'data/XX/tiles/12/1/4.geojson'][:constants.MAX_TILES_RUN])
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_load_model_tiles_timings(self, stdout):
+        ''' Tiles are sorted by timing history, then by manifest cost.
+        '''
+        storage, model = unittest.mock.Mock(), unittest.mock.Mock()
+        model.key_prefix = 'data/XX'
+        
+        # Tile 12/1/1 was slow in earlier uploads despite its low cost
+        bodies = {
+            'data/XX/costs.json': b'{"12/1/1": 10, "12/1/2": 400000, "12/1/3": 200000}',
+            'data/XX/timings.json': b'{"12/1/1": 30.0, "12/1/3": 1.5}',
+            }
+        
+        storage.s3.get_object.side_effect = lambda Bucket, Key: {'Body': io.BytesIO(bodies[Key])}
+        storage.s3.list_objects.return_value = {'Contents': [
+            {'Key': 'data/XX/tiles/12/1/1.geojson', 'Size': 4},
+            {'Key': 'data/XX/tiles/12/1/2.geojson', 'Size': 2},
+            {'Key': 'data/XX/tiles/12/1/3.geojson', 'Size': 3},
+            {'Key': 'data/XX/tiles/12/1/4.geojson', 'Size': 5},
+            ], 'IsTruncated': False}
+        
+        tile_keys = postread_calculate.load_model_tiles(storage, model)
+        
+        self.assertEqual(tile_keys,
+            ['data/XX/tiles/12/1/1.geojson', 'data/XX/tiles/12/1/2.geojson',
+            'data/XX/tiles/12/1/3.geojson', 'data/XX/tiles/12/1/4.geojson'][:constants.MAX_TILES_RUN])
+    
     @unittest.mock.patch('sys.stdout')
     @unittest.mock.patch('boto3.client')
     def test_fan_out_tile_lambdas(self, boto3_client, stdout):
@@ -194,6 +295,125 @@ class TestPostreadCalculate (unittest.TestCase):
         self.assertIn(b'data/XX/a.geojson', invocations[0][2]['Payload'])
         self.assertIn(b'data/XX/b.geojson', invocations[1][2]['Payload'])
     
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    def test_fan_out_tile_lambdas_districts(self, boto3_client, stdout):
+        ''' Test that tile Lambda fan-out includes overlapping districts.
+        '''
+        storage = unittest.mock.Mock()
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', model=unittest.mock.Mock())
+        upload.model.key_prefix = 'data/XX'
+
+        storage.to_event.return_value = None
+        upload.model.to_dict.return_value = None
+
+        postread_calculate.fan_out_tile_lambdas(storage, upload,
+            ['data/XX/a.geojson'], {'data/XX/a.geojson': ['uploads/ID/geometries/1.wkt']})
+        
+        (invocation, ) = boto3_client.return_value.invoke.mock_calls
+        payload = json.loads(invocation[2]['Payload'])
+        self.assertEqual(payload['tile_key'], 'data/XX/a.geojson')
+        self.assertEqual(payload['geometry_keys'], ['uploads/ID/geometries/1.wkt'])
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_fan_out_tile_lambdas_fake_client(self, stdout):
+        ''' Test that tile Lambda fan-out retries throttled and failed invocations.
+        '''
+        class FakeLambda:
+            def __init__(self, error_codes):
+                self.error_codes, self.payloads = error_codes, []
+                self.lock = threading.Lock()
+            
+            def invoke(self, FunctionName, InvocationType, Payload):
+                with self.lock:
+                    if self.error_codes:
+                        error = {'Error': {'Code': self.error_codes.pop(0)}}
+                        raise botocore.exceptions.ClientError(error, 'Invoke')
+                    self.payloads.append(json.loads(Payload))
+        
+        storage = unittest.mock.Mock()
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', model=unittest.mock.Mock())
+        upload.model.key_prefix = 'data/XX'
+
+        storage.to_event.return_value = None
+        upload.model.to_dict.return_value = None
+        
+        tile_keys = ['data/XX/{}.geojson'.format(i) for i in range(10000)]
+        lam = FakeLambda(['TooManyRequestsException'] * 3 + ['ServiceException'])
+
+        report = postread_calculate.fan_out_tile_lambdas(storage, upload,
+            list(tile_keys), lam=lam, concurrency=16)
+        
+        self.assertEqual(report.invoked, 10000)
+        self.assertEqual(report.retried, 4)
+        self.assertEqual(report.failed, 0)
+        self.assertEqual(sorted(p['tile_key'] for p in lam.payloads), sorted(tile_keys))
+        
+        # Invocation times are saved for each tile for ObserveTiles
+        (put_call, ) = storage.s3.put_object.mock_calls
+        self.assertEqual(put_call[2]['Key'], 'uploads/ID/dispatched.json')
+        self.assertEqual(sorted(json.loads(put_call[2]['Body'])), sorted(tile_keys))
+        
+        # A tile that never gets through is reported as failed
+        lam = FakeLambda(['TooManyRequestsException'] * 2)
+
+        report = postread_calculate.fan_out_tile_lambdas(storage, upload,
+            tile_keys[:1], lam=lam, concurrency=1, attempts=2)
+        
+        self.assertEqual(report.invoked, 0)
+        self.assertEqual(report.retried, 1)
+        self.assertEqual(report.failed, 1)
+    
+    def test_fan_out_delay(self):
+        ''' Test that fan-out delay grows when throttled and shrinks after success.
+        '''
+        delay = postread_calculate.FanOutDelay()
+        self.assertEqual(delay.seconds, 0)
+        
+        delay.throttled()
+        self.assertEqual(delay.seconds, postread_calculate.MIN_FAN_OUT_DELAY)
+        delay.throttled()
+        self.assertEqual(delay.seconds, postread_calculate.MIN_FAN_OUT_DELAY * 2)
+        
+        for i in range(20):
+            delay.throttled()
+        self.assertEqual(delay.seconds, postread_calculate.MAX_FAN_OUT_DELAY)
+        
+        for i in range(20):
+            delay.succeeded()
+        self.assertEqual(delay.seconds, 0)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    def test_fan_out_tile_lambdas_batches(self, boto3_client, stdout):
+        ''' Test that tile Lambda fan-out sends batches of tiles together.
+        '''
+        storage = unittest.mock.Mock()
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson', model=unittest.mock.Mock())
+        upload.model.key_prefix = 'data/XX'
+
+        storage.to_event.return_value = None
+        upload.model.to_dict.return_value = None
+        
+        tile_keys = ['data/XX/a.geojson', 'data/XX/b.geojson', 'data/XX/c.geojson']
+        tile_batches = postread_calculate.batch_tile_keys(tile_keys, 2)
+        self.assertEqual(tile_batches, [tile_keys[:2], tile_keys[2:]])
+
+        postread_calculate.fan_out_tile_lambdas(storage, upload, tile_batches, {
+            'data/XX/a.geojson': ['uploads/ID/geometries/1.wkt'],
+            'data/XX/b.geojson': ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt'],
+            'data/XX/c.geojson': ['uploads/ID/geometries/2.wkt'],
+            })
+        
+        invocations = boto3_client.return_value.invoke.mock_calls
+        payloads = [json.loads(invocation[2]['Payload']) for invocation in invocations]
+        self.assertEqual(len(payloads), 2)
+        self.assertEqual(payloads[0]['tile_keys'], ['data/XX/a.geojson', 'data/XX/b.geojson'])
+        self.assertEqual(payloads[0]['geometry_keys'], ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt'])
+        self.assertEqual(payloads[1]['tile_keys'], ['data/XX/c.geojson'])
+        self.assertEqual(payloads[1]['geometry_keys'], ['uploads/ID/geometries/2.wkt'])
+        self.assertNotIn('tile_key', payloads[0])
+    
     @unittest.mock.patch('time.time')
     @unittest.mock.patch('boto3.client')
     def test_start_tile_observer_lambda(self, boto3_client, time_time):
@@ -209,6 +429,17 @@ class TestPostreadCalculate (unittest.TestCase):
         self.assertEqual(len(storage.s3.put_object.mock_calls), 1)
         self.assertEqual(len(boto3_client.return_value.invoke.mock_calls), 1)
         self.assertIn(b'"start_time": 1', boto3_client.return_value.invoke.mock_calls[0][2]['Payload'])
+        
+        # District keys are saved only for tiles being scored
+        upload.id = 'ID'
+        tile_districts = {'data/XX/a.geojson': ['g0'], 'data/XX/b.geojson': ['g1'], 'data/XX/c.geojson': []}
+        postread_calculate.start_tile_observer_lambda(storage, upload,
+            ['data/XX/a.geojson', ['data/XX/b.geojson']], tile_districts)
+        
+        put_call = storage.s3.put_object.mock_calls[-1]
+        self.assertEqual(put_call[2]['Key'], 'uploads/ID/tile-districts.json')
+        self.assertEqual(json.loads(put_call[2]['Body']),
+            {'data/XX/a.geojson': ['g0'], 'data/XX/b.geojson': ['g1']})
     
     @unittest.mock.patch('planscore.util.temporary_buffer_file')
     @unittest.mock.patch('planscore.postread_calculate.commence_geometry_upload_scoring')
@@ -316,7 +547,8 @@ class TestPostreadCalculate (unittest.TestCase):
     @unittest.mock.patch('planscore.postread_calculate.start_tile_observer_lambda')
     @unittest.mock.patch('planscore.postread_calculate.fan_out_tile_lambdas')
     @unittest.mock.patch('planscore.postread_calculate.load_model_tiles')
-    def test_commence_geometry_upload_scoring_good_ogr_file(self, load_model_tiles, fan_out_tile_lambdas, start_tile_observer_lambda, put_district_geometries, put_upload_index):
+    @unittest.mock.patch('planscore.postread_calculate.index_tile_districts')
+    def test_commence_geometry_upload_scoring_good_ogr_file(self, index_tile_districts, load_model_tiles, fan_out_tile_lambdas, start_tile_observer_lambda, put_district_geometries, put_upload_index):
         ''' A valid district plan file is scored and the results posted to S3
         '''
         id = 'ID'
@@ -324,6 +556,9 @@ class TestPostreadCalculate (unittest.TestCase):
         upload_key = data.UPLOAD_PREFIX.format(id=id) + 'null-plan.geojson'
         
         put_district_geometries.return_value = [unittest.mock.Mock()] * 2
+        load_model_tiles.return_value = ['data/XX/tiles/a.geojson', 'data/XX/tiles/b.geojson']
+        index_tile_districts.return_value = {'data/XX/tiles/a.geojson': ['uploads/ID/geometries/0.wkt'],
+            'data/XX/tiles/b.geojson': []}
 
         s3, bucket = unittest.mock.Mock(), 'fake-bucket-name'
         s3.get_object.return_value = {'Body': None}
@@ -337,25 +572,33 @@ class TestPostreadCalculate (unittest.TestCase):
         self.assertEqual(put_upload_index.mock_calls[0][1][1].id, upload.id)
 
         self.assertEqual(len(put_district_geometries.mock_calls), 1)
-        self.assertEqual(put_district_geometries.mock_calls[0][1][3], nullplan_path)
+        self.assertEqual(len(put_district_geometries.mock_calls[0][1][3]), 2)
 
         self.assertEqual(len(load_model_tiles.mock_calls), 1)
         
+        self.assertEqual(len(index_tile_districts.mock_calls), 1)
+        self.assertIs(index_tile_districts.mock_calls[0][1][1], load_model_tiles.return_value)
+        self.assertIs(index_tile_districts.mock_calls[0][1][2], put_district_geometries.return_value)
+        self.assertIs(index_tile_districts.mock_calls[0][1][3], put_district_geometries.mock_calls[0][1][3])
+        
         self.assertEqual(len(fan_out_tile_lambdas.mock_calls), 1)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][0].s3, s3)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertEqual(fan_out_tile_lambdas.mock_calls[0][1][2], ['data/XX/tiles/a.geojson'])
+        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][3], index_tile_districts.return_value)
 
         self.assertEqual(len(start_tile_observer_lambda.mock_calls), 1)
         self.assertEqual(start_tile_observer_lambda.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(start_tile_observer_lambda.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertEqual(start_tile_observer_lambda.mock_calls[0][1][2], ['data/XX/tiles/a.geojson'])
+        self.assertIs(start_tile_observer_lambda.mock_calls[0][1][3], index_tile_districts.return_value)
     
     @unittest.mock.patch('planscore.observe.put_upload_index')
     @unittest.mock.patch('planscore.postread_calculate.put_district_geometries')
     @unittest.mock.patch('planscore.postread_calculate.start_tile_observer_lambda')
     @unittest.mock.patch('planscore.postread_calculate.fan_out_tile_lambdas')
     @unittest.mock.patch('planscore.postread_calculate.load_model_tiles')
-    def test_commence_geometry_upload_scoring_zipped_ogr_file(self, load_model_tiles, fan_out_tile_lambdas, start_tile_observer_lambda, put_district_geometries, put_upload_index):
+    @unittest.mock.patch('planscore.postread_calculate.index_tile_districts')
+    def test_commence_geometry_upload_scoring_zipped_ogr_file(self, index_tile_districts, load_model_tiles, fan_out_tile_lambdas, start_tile_observer_lambda, put_district_geometries, put_upload_index):
         ''' A valid district plan zipfile is scored and the results posted to S3
         '''
         id = 'ID'
@@ -363,6 +606,9 @@ class TestPostreadCalculate (unittest.TestCase):
         upload_key = data.UPLOAD_PREFIX.format(id=id) + 'null-plan.shp.zip'
         
         put_district_geometries.return_value = [unittest.mock.Mock()] * 2
+        load_model_tiles.return_value = ['data/XX/tiles/a.geojson', 'data/XX/tiles/b.geojson']
+        index_tile_districts.return_value = {'data/XX/tiles/a.geojson': ['uploads/ID/geometries/0.wkt'],
+            'data/XX/tiles/b.geojson': []}
 
         s3, bucket = unittest.mock.Mock(), 'fake-bucket-name'
         s3.get_object.return_value = {'Body': None}
@@ -377,15 +623,22 @@ class TestPostreadCalculate (unittest.TestCase):
         self.assertEqual(put_upload_index.mock_calls[0][1][1], upload)
         
         self.assertEqual(len(put_district_geometries.mock_calls), 1)
-        self.assertEqual(put_district_geometries.mock_calls[0][1][3], nullplan_datasource)
+        self.assertEqual(len(put_district_geometries.mock_calls[0][1][3]), 2)
 
         self.assertEqual(len(load_model_tiles.mock_calls), 1)
         
+        self.assertEqual(len(index_tile_districts.mock_calls), 1)
+        self.assertIs(index_tile_districts.mock_calls[0][1][1], load_model_tiles.return_value)
+        self.assertIs(index_tile_districts.mock_calls[0][1][2], put_district_geometries.return_value)
+        self.assertIs(index_tile_districts.mock_calls[0][1][3], put_district_geometries.mock_calls[0][1][3])
+        
         self.assertEqual(len(fan_out_tile_lambdas.mock_calls), 1)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][0].s3, s3)
         self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertEqual(fan_out_tile_lambdas.mock_calls[0][1][2], ['data/XX/tiles/a.geojson'])
+        self.assertIs(fan_out_tile_lambdas.mock_calls[0][1][3], index_tile_districts.return_value)
         
         self.assertEqual(len(start_tile_observer_lambda.mock_calls), 1)
         self.assertEqual(start_tile_observer_lambda.mock_calls[0][1][1].id, upload.id)
-        self.assertIs(start_tile_observer_lambda.mock_calls[0][1][2], load_model_tiles.return_value)
+        self.assertEqual(start_tile_observer_lambda.mock_calls[0][1][2], ['data/XX/tiles/a.geojson'])
+        self.assertIs(start_tile_observer_lambda.mock_calls[0][1][3], index_tile_districts.return_value)
@@ -1,4 +1,5 @@
-import unittest, os, json
+import unittest, unittest.mock, os, io, json, math, gzip, pickle, shutil, tempfile
+import botocore.exceptions
 import ModestMaps.Core
 from osgeo import ogr
 from .. import prepare_state
@@ -211,6 +212,153 @@ class TestPrepareState (unittest.TestCase):
             self.assertNotIn(prepare_state.INDEX_FIELD, obj)
             self.assertNotIn(prepare_state.FRACTION_FIELD, obj)
     
+    def test_load_geojson_properties(self):
+        ''' load_geojson() returns properties matching the original features.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data/null-island-sims-precincts.geojson')
+        ds, properties = prepare_state.load_geojson(filename)
+        
+        with open(filename) as file:
+            features = json.load(file)['features']
+        
+        self.assertIsInstance(properties, prepare_state.PropertyStore)
+        self.assertEqual(list(properties), [feature['properties'] for feature in features])
+        self.assertEqual(properties[-1], features[-1]['properties'])
+        self.assertEqual(properties[1:3], [feature['properties'] for feature in features[1:3]])
+        
+        # Worker processes get a working copy with just a path and offsets
+        properties2 = pickle.loads(pickle.dumps(properties))
+        self.assertEqual(list(properties2), list(properties))
+        
+        with self.assertRaises(IndexError):
+            properties[len(properties)]
+    
+    def test_iter_geojson_features(self):
+        ''' iter_geojson_features() reads features across small chunks.
+        '''
+        features = [
+            {'type': 'Feature', 'properties': {'GEOID': '001', 'Votes': 12345}, 'geometry': None},
+            {'type': 'Feature', 'properties': {'GEOID': '002', 'Name': '}]'},
+                'geometry': {'type': 'Point', 'coordinates': [-0.1234567, 0.1234567]}},
+            ]
+        
+        collections = [
+            {'type': 'FeatureCollection', 'features': features},
+            {'type': 'FeatureCollection', 'name': 'features', 'crs': {'type': 'name'},
+                'features': features, 'bbox': [-1, -1, 1, 1]},
+            ]
+        
+        for collection in collections:
+            for indent in (None, 2):
+                buffer = io.StringIO(json.dumps(collection, indent=indent))
+                self.assertEqual(list(prepare_state.iter_geojson_features(buffer, 7)), features)
+        
+        buffer = io.StringIO('{"type": "FeatureCollection", "features": [ ]}')
+        self.assertEqual(list(prepare_state.iter_geojson_features(buffer)), [])
+        
+        with self.assertRaises(ValueError):
+            list(prepare_state.iter_geojson_features(io.StringIO('{"features": [{"type": "Feature"')))
+    
+    def test_iter_slices(self):
+        ''' iter_slices() returns lists of property dicts sorted by GEOID.
+        '''
+        property_dicts = [{'GEOID': geoid} for geoid in ('04', '02', '05', '01', '03')]
+        slices = list(prepare_state.iter_slices(property_dicts, 2))
+        
+        self.assertEqual(slices, [[{'GEOID': '01'}, {'GEOID': '02'}],
+            [{'GEOID': '03'}, {'GEOID': '04'}], [{'GEOID': '05'}]])
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_iter_prepared_tiles_parallel(self, stdout):
+        ''' Tiles prepared in a process pool match tiles prepared serially.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data/null-island-sims-precincts.geojson')
+        ds, properties = prepare_state.load_geojson(filename)
+        column_count = len(prepare_state.scoring_field_names(properties))
+        
+        # Force some tiles to be split to exercise the quadtree
+        with unittest.mock.patch('planscore.prepare_state.MAX_TILE_COST', 1000):
+            serial = [prepared for (prepared, _) in prepare_state.iter_prepared_tiles(
+                ds, properties, 'XX', column_count, False, 1)]
+            parallel = [prepared for (prepared, _) in prepare_state.iter_prepared_tiles(
+                ds, properties, 'XX', column_count, False, 2)]
+        
+        written = lambda prepared_tiles: sorted((prepared.zxy, prepared.writes, prepared.cost)
+            for prepared in prepared_tiles if prepared.cost is not None)
+        
+        self.assertTrue(any(prepared.children for prepared in serial), 'Should see split tiles')
+        self.assertTrue(written(serial), 'Should see written tiles')
+        self.assertEqual(written(parallel), written(serial))
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_iter_prepared_tiles_incremental(self, stdout):
+        ''' Tiles with unchanged input hashes are not generated again.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data/null-island-sims-precincts.geojson')
+        ds, properties = prepare_state.load_geojson(filename)
+        column_count = len(prepare_state.scoring_field_names(properties))
+        
+        prepared1 = [prepared for (prepared, _) in prepare_state.iter_prepared_tiles(
+            ds, properties, 'XX', column_count, False, 1) if prepared.cost is not None]
+        input_hashes = {prepared.zxy: prepared.input_hash for prepared in prepared1}
+        
+        prepared2 = [prepared for (prepared, _) in prepare_state.iter_prepared_tiles(
+            ds, properties, 'XX', column_count, False, 1, input_hashes) if prepared.cost is not None]
+        
+        self.assertEqual([p.zxy for p in prepared2], [p.zxy for p in prepared1])
+        self.assertEqual({p.zxy: p.input_hash for p in prepared2}, input_hashes)
+        
+        for (old, new) in zip(prepared1, prepared2):
+            self.assertTrue(all(value is not None for (_, value, _) in old.writes))
+            self.assertEqual([(key, None, type) for (key, _, type) in old.writes], new.writes)
+        
+        # Changing one precinct should make at least one tile again
+        properties = list(properties)
+        properties[0] = dict(properties[0], **{'Population 2010': properties[0]['Population 2010'] + 1})
+        prepared3 = [prepared for (prepared, _) in prepare_state.iter_prepared_tiles(
+            ds, properties, 'XX', column_count, False, 1, input_hashes) if prepared.cost is not None]
+        
+        changed = [p.zxy for p in prepared3 if p.input_hash != input_hashes[p.zxy]]
+        self.assertTrue(changed, 'Should see changed tiles')
+        
+        for prepared in prepared3:
+            if prepared.zxy in changed:
+                self.assertTrue(all(value is not None for (_, value, _) in prepared.writes))
+            else:
+                self.assertTrue(all(value is None for (_, value, _) in prepared.writes))
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_read_delete_buffer(self, stdout):
+        ''' Local buffers can be read back and deleted, and missing ones are None.
+        '''
+        dirname = tempfile.mkdtemp(prefix='test_read_delete_buffer-')
+        key = os.path.join(dirname, 'data/XX/hashes.json')
+        
+        try:
+            self.assertIsNone(prepare_state.read_buffer(None, key))
+            prepare_state.write_buffer(None, key, io.StringIO('{"tiles": {}}'), '')
+            self.assertEqual(prepare_state.read_buffer(None, key), b'{"tiles": {}}')
+            prepare_state.delete_buffer(None, key, '')
+            self.assertIsNone(prepare_state.read_buffer(None, key))
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_read_buffer_s3(self):
+        ''' S3 buffers are decompressed, and missing ones are None.
+        '''
+        s3 = unittest.mock.Mock()
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(b'Hello')), 'ContentEncoding': 'gzip'}
+        self.assertEqual(prepare_state.read_buffer(s3, 'data/XX/hashes.json'), b'Hello')
+        
+        s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertIsNone(prepare_state.read_buffer(s3, 'data/XX/hashes.json'))
+    
+    def test_content_hash(self):
+        ''' content_hash() treats text and bytes alike.
+        '''
+        self.assertEqual(prepare_state.content_hash('Hello'), prepare_state.content_hash(b'Hello'))
+        self.assertNotEqual(prepare_state.content_hash('Hello'), prepare_state.content_hash('World'))
+    
     def test_feature_geojson(self):
         ''' feature_geojson() returns right geometry and properties in a JSON string.
         '''
@@ -236,3 +384,128 @@ class TestPrepareState (unittest.TestCase):
         self.assertEqual(feature['geometry']['type'], 'Polygon')
         self.assertEqual(len(feature['geometry']['coordinates'][0]), 5)
         self.assertEqual(feature['geometry']['coordinates'][0][0], [1, 1])
+    
+    def test_feature_weight(self):
+        ''' feature_weight() returns fraction for polygons and one for points.
+        '''
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        
+        polygon_feature = ogr.Feature(feature_defn)
+        polygon_feature.SetField(prepare_state.FRACTION_FIELD, .5)
+        polygon_feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((1 1,1 2,2 2,2 1,1 1))'))
+        self.assertEqual(prepare_state.feature_weight(polygon_feature), .5)
+        
+        point_feature = ogr.Feature(feature_defn)
+        point_feature.SetGeometry(ogr.CreateGeometryFromWkt('POINT (1 1)'))
+        self.assertEqual(prepare_state.feature_weight(point_feature), 1)
+        
+        empty_feature = ogr.Feature(feature_defn)
+        empty_feature.SetField(prepare_state.FRACTION_FIELD, .5)
+        empty_feature.SetGeometry(ogr.Geometry(ogr.wkbGeometryCollection))
+        self.assertEqual(prepare_state.feature_weight(empty_feature), 0)
+    
+    def test_geometry_vertex_count(self):
+        ''' Vertices are counted through rings and collections.
+        '''
+        self.assertEqual(prepare_state.geometry_vertex_count(None), 0)
+        self.assertEqual(prepare_state.geometry_vertex_count(ogr.CreateGeometryFromWkt('POINT (0 0)')), 1)
+        self.assertEqual(prepare_state.geometry_vertex_count(ogr.CreateGeometryFromWkt(
+            'POLYGON ((0 0, 0 1, 1 1, 1 0, 0 0), (.2 .2, .2 .4, .4 .4, .2 .2))')), 9)
+        self.assertEqual(prepare_state.geometry_vertex_count(ogr.CreateGeometryFromWkt(
+            'MULTIPOLYGON (((0 0, 0 1, 1 1, 1 0, 0 0)), ((2 2, 2 3, 3 3, 2 2)))')), 9)
+        self.assertEqual(prepare_state.geometry_vertex_count(ogr.CreateGeometryFromWkt(
+            'GEOMETRYCOLLECTION EMPTY')), 0)
+    
+    def test_tile_cost(self):
+        ''' Tile cost grows with vertices, features, and property columns.
+        '''
+        cost1 = prepare_state.tile_cost([100, 100], 10)
+        self.assertEqual(cost1, 200 + 2 * (prepare_state.FEATURE_COST + 10 * prepare_state.VALUE_COST))
+        self.assertGreater(prepare_state.tile_cost([1000, 100], 10), cost1)
+        self.assertGreater(prepare_state.tile_cost([100, 100, 1], 10), cost1)
+        self.assertGreater(prepare_state.tile_cost([100, 100], 20), cost1)
+        self.assertEqual(prepare_state.tile_cost([], 10), 0)
+
+    def test_tile_cost_many_columns(self):
+        ''' A few hundred precincts with a full set of simulation columns fit in one tile.
+        '''
+        self.assertLess(prepare_state.tile_cost([200] * 400, 12000), prepare_state.MAX_TILE_COST)
+        self.assertGreater(prepare_state.tile_cost([50] * 8000, 12000), prepare_state.MAX_TILE_COST)
+
+    def test_clipped_vertex_count(self):
+        ''' Only vertices inside the bbox are counted for features that cross it.
+        '''
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.INDEX_FIELD, ogr.OFTInteger))
+        feature = ogr.Feature(feature_defn)
+        feature.SetField(prepare_state.INDEX_FIELD, 0)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((0 0, 0 1, 0 2, 0 3, 0 4, '
+            '1 4, 2 4, 3 4, 4 4, 4 3, 4 2, 4 1, 4 0, 3 0, 2 0, 1 0, 0 0))'))
+        vertex_counts = {}
+
+        inside_bbox = ogr.CreateGeometryFromWkt('POLYGON ((-1 -1, -1 5, 5 5, 5 -1, -1 -1))')
+        self.assertEqual(prepare_state.clipped_vertex_count(feature, inside_bbox, vertex_counts), 17)
+        self.assertEqual(vertex_counts, {0: 17})
+
+        corner_bbox = ogr.CreateGeometryFromWkt('POLYGON ((-1 -1, -1 1.5, 1.5 1.5, 1.5 -1, -1 -1))')
+        self.assertLess(prepare_state.clipped_vertex_count(feature, corner_bbox, vertex_counts), 17)
+
+    @unittest.mock.patch('sys.stdout')
+    def test_prepare_tile_many_columns(self, stdout):
+        ''' prepare_tile() does not split a small tile with 12,000 scoring columns.
+        '''
+        filename = os.path.join(os.path.dirname(__file__), 'data/null-island-sims-precincts.geojson')
+        ds, properties = prepare_state.load_geojson(filename)
+        tile = ModestMaps.Core.Coordinate(2048, 2048, 12)
+
+        prepared = prepare_state.prepare_tile(ds.GetLayer(0), properties, 'XX',
+            tile, 12000, False, {}, '')
+
+        self.assertEqual(prepared.children, [])
+        self.assertTrue(prepared.writes)
+        self.assertLess(prepared.cost, prepare_state.MAX_TILE_COST)
+
+    def test_tile_totals(self):
+        ''' tile_totals() adds up weighted values for known fields.
+        '''
+        totals = prepare_state.tile_totals([
+            (.5, {'GEOID': '1', 'Voters': 4, 'Households 2016': 3, 'Household Income 2016': 100}),
+            (1., {'GEOID': '2', 'Voters': None, 'Blue Votes': 2}),
+            ])
+        
+        self.assertEqual(totals, {'Voters': 2, 'Blue Votes': 2, 'Households 2016': 1.5,
+            'Household Income 2016': 0, 'Sum Household Income 2016': 150})
+    
+    def test_binary_tile(self):
+        ''' binary_tile() output is read back by read_binary_tile().
+        '''
+        feature_defn = ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(ogr.FieldDefn(prepare_state.FRACTION_FIELD, ogr.OFTReal))
+        
+        polygon_feature = ogr.Feature(feature_defn)
+        polygon_feature.SetField(prepare_state.FRACTION_FIELD, .5)
+        polygon_feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((1 1,1 2,2 2,2 1,1 1))'))
+        
+        point_feature = ogr.Feature(feature_defn)
+        point_feature.SetGeometry(ogr.CreateGeometryFromWkt('POINT (1 1)'))
+        
+        body = prepare_state.binary_tile([polygon_feature, point_feature], [
+            {'GEOID': '1', 'Voters': 4, 'Households 2016': 3, 'Household Income 2016': 100},
+            {'GEOID': '2', 'Voters': None, 'Blue Votes': 2},
+            ])
+        
+        tile = prepare_state.read_binary_tile(body)
+        
+        self.assertEqual(tile.columns, ['Voters', 'Blue Votes', 'Households 2016',
+            'Household Income 2016', 'Sum Household Income 2016'])
+        self.assertEqual(tile.fractions[0], .5)
+        self.assertTrue(math.isnan(tile.fractions[1]))
+        self.assertEqual(tile.values.tolist(), [[4, 0, 3, 0, 300], [0, 2, 0, 0, 0]])
+        
+        geometries = [ogr.CreateGeometryFromWkb(bytes(wkb)) for wkb in tile.geometries]
+        self.assertEqual(geometries[0].ExportToWkt(), 'POLYGON ((1 1,1 2,2 2,2 1,1 1))')
+        self.assertEqual(geometries[1].ExportToWkt(), 'POINT (1 1)')
+        
+        with self.assertRaises(ValueError):
+            prepare_state.read_binary_tile(b'Not a tile')
@@ -111,6 +111,56 @@ class TestScore (unittest.TestCase):
         self.assertAlmostEqual(pb4, 0.1, places=2,
             msg='Should see +blue PB with 40% blue vote share and 60% blue seats')
 
+    def test_calculate_metric_arrays(self):
+        ''' Vectorized metrics match scalar metrics for every sim, skipping NaNs
+        '''
+        red_votes = numpy.array([[6, 6, 4], [6, 3, 4], [6, 3, 6], [3, 6, 6], [numpy.nan, 3, 2]])
+        blue_votes = numpy.array([[4, 2, 6], [4, 5, 6], [4, 5, 4], [12, 5, 5], [numpy.nan, 9, 8]])
+        
+        sims = [
+            ([6, 6, 6, 3], [4, 4, 4, 12]),
+            ([6, 3, 3, 6, 3], [2, 5, 5, 5, 9]),
+            ([4, 4, 6, 6, 2], [6, 6, 4, 5, 8]),
+            ]
+        
+        MMDs = score.calculate_MMD_array(red_votes, blue_votes)
+        PBs = score.calculate_PB_array(red_votes, blue_votes)
+
+        for (sim, (r, b)) in enumerate(sims):
+            self.assertAlmostEqual(MMDs[sim], score.calculate_MMD(r, b), places=9)
+            self.assertAlmostEqual(PBs[sim], score.calculate_PB(r, b), places=9)
+        
+        for swing in (0, 1, -1, 5, -5):
+            EGs = score.calculate_EG_array(red_votes, blue_votes, swing/100)
+            for (sim, (r, b)) in enumerate(sims):
+                self.assertAlmostEqual(EGs[sim], score.calculate_EG(r, b, swing/100), places=9)
+        
+        empty_EGs = score.calculate_EG_array(numpy.zeros((2, 1)), numpy.zeros((2, 1)))
+        self.assertTrue(numpy.isnan(empty_EGs[0]), 'Should see NaN EG with no votes')
+
+    def test_simulation_votes(self):
+        ''' Simulation vote fields are gathered into a districts × sims × party array
+        '''
+        districts = [
+            dict(totals={'D:DEM000': 6, 'D:REP000': 2, 'D:DEM001': 7, 'O:DEM000': 5}),
+            dict(totals={'R:DEM000': 3, 'R:REP000': 5, 'R:DEM001': 2, 'R:REP001': 6}),
+            dict(totals={}),
+            ]
+
+        field_names = [
+            [('D:DEM000', 'D:REP000'), ('D:DEM001', 'D:REP001')],
+            [('R:DEM000', 'R:REP000'), ('R:DEM001', 'R:REP001')],
+            [('O:DEM000', 'O:REP000'), ('O:DEM001', 'O:REP001')],
+            ]
+
+        votes = score.simulation_votes(districts, field_names)
+        self.assertEqual(votes.shape, (3, 2, 2))
+        self.assertEqual(votes.tolist(), [
+            [[6, 2], [7, 0]],
+            [[3, 5], [2, 6]],
+            [[0, 0], [0, 0]],
+            ])
+
     @unittest.mock.patch('planscore.score.calculate_MMD')
     @unittest.mock.patch('planscore.score.calculate_PB')
     @unittest.mock.patch('planscore.score.calculate_EG')
@@ -243,10 +293,10 @@ class TestScore (unittest.TestCase):
         self.assertEqual(output.summary['SLDL Efficiency Gap +1 Rep'], calculate_EG.return_value)
         self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_fewsims(self, calculate_EG, calculate_PB, calculate_MMD):
+    @unittest.mock.patch('planscore.score.calculate_MMD_array')
+    @unittest.mock.patch('planscore.score.calculate_PB_array')
+    @unittest.mock.patch('planscore.score.calculate_EG_array')
+    def test_calculate_gap_fewsims(self, calculate_EG_array, calculate_PB_array, calculate_MMD_array):
         ''' Efficiency gap can be correctly calculated using a few input sims.
         
             Use "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
@@ -259,26 +309,29 @@ class TestScore (unittest.TestCase):
                 dict(totals={"REP000": 6, "DEM000": 2, "REP001": 5, "DEM001": 3}, tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        zeros = lambda red_votes, blue_votes, *args: numpy.zeros(red_votes.shape[1])
+        calculate_MMD_array.side_effect = zeros
+        calculate_PB_array.side_effect = zeros
+        calculate_EG_array.side_effect = zeros
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6], [6, 5, 3, 2], 0))
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6], [6, 5, 3, 2], .01))
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6], [6, 5, 3, 2], -.01))
-        self.assertEqual(calculate_EG.mock_calls[11][1], ([1, 5, 5, 5], [7, 3, 3, 3], 0))
-        self.assertEqual(calculate_EG.mock_calls[12][1], ([1, 5, 5, 5], [7, 3, 3, 3], .01))
-        self.assertEqual(calculate_EG.mock_calls[13][1], ([1, 5, 5, 5], [7, 3, 3, 3], -.01))
+        self.assertEqual(len(calculate_EG_array.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual([call[1][2] for call in calculate_EG_array.mock_calls[:3]], [0, .01, -.01])
+        
+        red_votes, blue_votes = calculate_EG_array.mock_calls[0][1][:2]
+        self.assertEqual(red_votes.T.tolist(), [[2, 3, 5, 6], [1, 5, 5, 5]])
+        self.assertEqual(blue_votes.T.tolist(), [[6, 5, 3, 2], [7, 3, 3, 3]])
+        self.assertEqual(calculate_PB_array.mock_calls[0][1][0].tolist(), red_votes.tolist())
+        self.assertEqual(calculate_MMD_array.mock_calls[0][1][1].tolist(), blue_votes.tolist())
         
         for field in ('REP000', 'DEM000', 'REP001', 'DEM001'):
             for district in output.districts:
@@ -293,10 +346,10 @@ class TestScore (unittest.TestCase):
         self.assertEqual(output.districts[3]['totals']['Republican Votes'], 11/2)
         self.assertEqual(output.districts[3]['totals']['Democratic Votes'], 5/2)
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_manysims(self, calculate_EG, calculate_PB, calculate_MMD):
+    @unittest.mock.patch('planscore.score.calculate_MMD_array')
+    @unittest.mock.patch('planscore.score.calculate_PB_array')
+    @unittest.mock.patch('planscore.score.calculate_EG_array')
+    def test_calculate_gap_manysims(self, calculate_EG_array, calculate_PB_array, calculate_MMD_array):
         ''' Efficiency gap can be correctly calculated using many input sims.
         
             Use "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
@@ -326,37 +379,38 @@ class TestScore (unittest.TestCase):
                 dict(totals=dict(vote_sims[1], **vote_sims[3]), tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        zeros = lambda red_votes, blue_votes, *args: numpy.zeros(red_votes.shape[1])
+        calculate_MMD_array.side_effect = zeros
+        calculate_PB_array.side_effect = zeros
+        calculate_EG_array.side_effect = zeros
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
 
-        self.assertEqual(len(calculate_EG.mock_calls), 11 * SIMS, 'Should see EGs for all sims')
+        self.assertEqual(len(calculate_EG_array.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual([call[1][2] for call in calculate_EG_array.mock_calls[:3]], [0, .01, -.01])
+        
+        red_votes, blue_votes = calculate_EG_array.mock_calls[0][1][:2]
+        self.assertEqual(red_votes.shape, (2, SIMS), 'Should see votes for all sims')
         in_ranges = []
         
-        for offset in range(0, 11 * SIMS, 11):
-            (d1R, d2R), (d1D, d2D) = calculate_EG.mock_calls[offset+0][1][:2]
+        for sim in range(SIMS):
+            (d1R, d2R), (d1D, d2D) = red_votes[:,sim], blue_votes[:,sim]
             
             in_ranges.append(int(V1 * (1 - D1 - MoE1) < d1R < V1 * (1 - D1 + MoE1)))
             in_ranges.append(int(V1 * (    D1 - MoE1) < d1D < V1 * (    D1 + MoE1)))
             in_ranges.append(int(V2 * (1 - D2 - MoE2) < d2R < V2 * (1 - D2 + MoE2)))
             in_ranges.append(int(V2 * (    D2 - MoE2) < d2D < V2 * (    D2 + MoE2)))
         
-            self.assertEqual(calculate_EG.mock_calls[offset+0][1], ([d1R, d2R], [d1D, d2D], 0.0))
-            self.assertEqual(calculate_EG.mock_calls[offset+1][1], ([d1R, d2R], [d1D, d2D], .01))
-            self.assertEqual(calculate_EG.mock_calls[offset+2][1], ([d1R, d2R], [d1D, d2D], -.01))
-        
         self.assertTrue(sum(in_ranges)/len(in_ranges) > .9,
             'District totals should fall within margin of error most of the time')
         
@@ -368,10 +422,10 @@ class TestScore (unittest.TestCase):
                 for district in output.districts:
                     self.assertNotIn(field, district['totals'])
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_opensims(self, calculate_EG, calculate_PB, calculate_MMD):
+    @unittest.mock.patch('planscore.score.calculate_MMD_array')
+    @unittest.mock.patch('planscore.score.calculate_PB_array')
+    @unittest.mock.patch('planscore.score.calculate_EG_array')
+    def test_calculate_gap_opensims(self, calculate_EG_array, calculate_PB_array, calculate_MMD_array):
         ''' Efficiency gap can be correctly calculated using many open-seat sims.
         
             Use "O:DEM000"-style vote properties from PlanScore models starting 2020.
@@ -411,27 +465,32 @@ class TestScore (unittest.TestCase):
                 dict(totals=dict(vote_sims[2] + vote_sims[5]), tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        zeros = lambda red_votes, blue_votes, *args: numpy.zeros(red_votes.shape[1])
+        calculate_MMD_array.side_effect = zeros
+        calculate_PB_array.side_effect = zeros
+        calculate_EG_array.side_effect = zeros
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
 
-        self.assertEqual(len(calculate_EG.mock_calls), 11 * SIMS, 'Should see EGs for all sims')
+        self.assertEqual(len(calculate_EG_array.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual([call[1][2] for call in calculate_EG_array.mock_calls[:3]], [0, .01, -.01])
+        
+        red_votes, blue_votes = calculate_EG_array.mock_calls[0][1][:2]
+        self.assertEqual(red_votes.shape, (3, SIMS), 'Should see votes for all sims')
         in_ranges = []
         
-        for offset in range(0, 11 * SIMS, 11):
-            (d1R, d2R, d3R), (d1D, d2D, d3D) = calculate_EG.mock_calls[offset+0][1][:2]
+        for sim in range(SIMS):
+            (d1R, d2R, d3R), (d1D, d2D, d3D) = red_votes[:,sim], blue_votes[:,sim]
             
             in_ranges.append(int(V1 * (1 - D1 - MoE1) < d1R < V1 * (1 - D1 + MoE1)))
             in_ranges.append(int(V1 * (    D1 - MoE1) < d1D < V1 * (    D1 + MoE1)))
@@ -440,10 +499,6 @@ class TestScore (unittest.TestCase):
             in_ranges.append(int(V3 * (1 - D3 - MoE3) < d3R < V3 * (1 - D3 + MoE3)))
             in_ranges.append(int(V3 * (    D3 - MoE3) < d3D < V3 * (    D3 + MoE3)))
         
-            self.assertEqual(calculate_EG.mock_calls[offset+0][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], 0.0))
-            self.assertEqual(calculate_EG.mock_calls[offset+1][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], .01))
-            self.assertEqual(calculate_EG.mock_calls[offset+2][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], -.01))
-        
         self.assertTrue(sum(in_ranges)/len(in_ranges) > .9,
             'District totals should fall within margin of error most of the time')
         
@@ -455,10 +510,10 @@ class TestScore (unittest.TestCase):
                 for district in output.districts:
                     self.assertNotIn(field, district['totals'])
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_incumbentsims(self, calculate_EG, calculate_PB, calculate_MMD):
+    @unittest.mock.patch('planscore.score.calculate_MMD_array')
+    @unittest.mock.patch('planscore.score.calculate_PB_array')
+    @unittest.mock.patch('planscore.score.calculate_EG_array')
+    def test_calculate_gap_incumbentsims(self, calculate_EG_array, calculate_PB_array, calculate_MMD_array):
         ''' Efficiency gap can be correctly calculated using mixed incumbency sims.
         
             Use "O:DEM000"-style vote properties from PlanScore models starting 2020.
@@ -528,27 +583,32 @@ class TestScore (unittest.TestCase):
                                + vote_sims[11] + vote_sims[14] + vote_sims[17]), tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        zeros = lambda red_votes, blue_votes, *args: numpy.zeros(red_votes.shape[1])
+        calculate_MMD_array.side_effect = zeros
+        calculate_PB_array.side_effect = zeros
+        calculate_EG_array.side_effect = zeros
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
 
-        self.assertEqual(len(calculate_EG.mock_calls), 11 * SIMS, 'Should see EGs for all sims')
+        self.assertEqual(len(calculate_EG_array.mock_calls), 11, 'Should see EGs for all swings')
+        self.assertEqual([call[1][2] for call in calculate_EG_array.mock_calls[:3]], [0, .01, -.01])
+        
+        red_votes, blue_votes = calculate_EG_array.mock_calls[0][1][:2]
+        self.assertEqual(red_votes.shape, (3, SIMS), 'Should see votes for all sims')
         in_ranges = []
         
-        for offset in range(0, 11 * SIMS, 11):
-            (d1R, d2R, d3R), (d1D, d2D, d3D) = calculate_EG.mock_calls[offset+0][1][:2]
+        for sim in range(SIMS):
+            (d1R, d2R, d3R), (d1D, d2D, d3D) = red_votes[:,sim], blue_votes[:,sim]
             
             in_ranges.append(int(V1 * (1 - (D1+SWING) - MoE1) < d1R < V1 * (1 - (D1+SWING) + MoE1)))
             in_ranges.append(int(V1 * (    (D1+SWING) - MoE1) < d1D < V1 * (    (D1+SWING) + MoE1)))
@@ -557,10 +617,6 @@ class TestScore (unittest.TestCase):
             in_ranges.append(int(V3 * (1 - D3 - MoE3) < d3R < V3 * (1 - D3 + MoE3)))
             in_ranges.append(int(V3 * (    D3 - MoE3) < d3D < V3 * (    D3 + MoE3)))
         
-            self.assertEqual(calculate_EG.mock_calls[offset+0][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], 0.0))
-            self.assertEqual(calculate_EG.mock_calls[offset+1][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], .01))
-            self.assertEqual(calculate_EG.mock_calls[offset+2][1], ([d1R, d2R, d3R], [d1D, d2D, d3D], -.01))
-        
         self.assertTrue(sum(in_ranges)/len(in_ranges) > .9,
             'District totals should fall within margin of error most of the time')
         
@@ -572,10 +628,10 @@ class TestScore (unittest.TestCase):
                 for district in output.districts:
                     self.assertNotIn(field, district['totals'])
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
-    def test_calculate_gap_blanks(self, calculate_EG, calculate_PB, calculate_MMD):
+    @unittest.mock.patch('planscore.score.calculate_MMD_array')
+    @unittest.mock.patch('planscore.score.calculate_PB_array')
+    @unittest.mock.patch('planscore.score.calculate_EG_array')
+    def test_calculate_gap_blanks(self, calculate_EG_array, calculate_PB_array, calculate_MMD_array):
         ''' Efficiency gap can be correctly calculated using input sims with blank districts.
         
             Use "DEM000"-style vote properties from 2018 and 2019 PlanScore models.
@@ -589,26 +645,26 @@ class TestScore (unittest.TestCase):
                 dict(totals={}, tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
+        zeros = lambda red_votes, blue_votes, *args: numpy.zeros(red_votes.shape[1])
+        calculate_MMD_array.side_effect = zeros
+        calculate_PB_array.side_effect = zeros
+        calculate_EG_array.side_effect = zeros
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
+        self.assertEqual(output.summary['Mean-Median'], 0)
         self.assertEqual(output.summary['Mean-Median SD'], 0)
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
+        self.assertEqual(output.summary['Partisan Bias'], 0)
         self.assertEqual(output.summary['Partisan Bias SD'], 0)
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
+        self.assertEqual(output.summary['Efficiency Gap'], 0)
         self.assertEqual(output.summary['Efficiency Gap SD'], 0)
         self.assertIn('Efficiency Gap +1 Dem', output.summary)
         self.assertIn('Efficiency Gap +1 Dem SD', output.summary)
         self.assertIn('Efficiency Gap +1 Rep', output.summary)
         self.assertIn('Efficiency Gap +1 Rep SD', output.summary)
-        self.assertEqual(calculate_EG.mock_calls[0][1], ([2, 3, 5, 6, 0], [6, 5, 3, 2, 0], 0))
-        self.assertEqual(calculate_EG.mock_calls[1][1], ([2, 3, 5, 6, 0], [6, 5, 3, 2, 0], .01))
-        self.assertEqual(calculate_EG.mock_calls[2][1], ([2, 3, 5, 6, 0], [6, 5, 3, 2, 0], -.01))
-        self.assertEqual(calculate_EG.mock_calls[11][1], ([1, 5, 5, 5, 0], [7, 3, 3, 3, 0], 0))
-        self.assertEqual(calculate_EG.mock_calls[12][1], ([1, 5, 5, 5, 0], [7, 3, 3, 3, 0], .01))
-        self.assertEqual(calculate_EG.mock_calls[13][1], ([1, 5, 5, 5, 0], [7, 3, 3, 3, 0], -.01))
+        self.assertEqual([call[1][2] for call in calculate_EG_array.mock_calls[:3]], [0, .01, -.01])
+        
+        red_votes, blue_votes = calculate_EG_array.mock_calls[0][1][:2]
+        self.assertEqual(red_votes.T.tolist(), [[2, 3, 5, 6, 0], [1, 5, 5, 5, 0]])
+        self.assertEqual(blue_votes.T.tolist(), [[6, 5, 3, 2, 0], [7, 3, 3, 3, 0]])
         
         for field in ('REP000', 'DEM000', 'REP001', 'DEM001'):
             for district in output.districts:
@@ -623,12 +679,9 @@ class TestScore (unittest.TestCase):
         self.assertEqual(output.districts[3]['totals']['Republican Votes'], 11/2)
         self.assertEqual(output.districts[3]['totals']['Democratic Votes'], 5/2)
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
     @unittest.mock.patch('planscore.matrix.model_votes')
     @unittest.mock.patch('planscore.matrix.prepare_district_data')
-    def test_calculate_gap_unified(self, prepare_district_data, model_votes, calculate_EG, calculate_PB, calculate_MMD):
+    def test_calculate_gap_unified(self, prepare_district_data, model_votes):
         ''' Efficiency gap can be correctly calculated from presidential vote only
         '''
         input = data.Upload(id=None, key=None,
@@ -640,9 +693,6 @@ class TestScore (unittest.TestCase):
                 dict(totals={'US President 2016 - REP': 6, 'US President 2016 - DEM': 2}, tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
         model_votes.return_value = numpy.array([
             [[5.3, 2.7],
              [6.0, 2.0],
@@ -663,28 +713,23 @@ class TestScore (unittest.TestCase):
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
         self.assertEqual(model_votes.mock_calls[0][1], (data.State.XX, None, prepare_district_data.return_value))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(output.summary['Mean-Median Positives'], 0.0)
-        self.assertEqual(calculate_MMD.mock_calls[0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9]))
-
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(output.summary['Partisan Bias Positives'], 0.0)
-        self.assertEqual(calculate_PB.mock_calls[0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9]))
-        
+        # Vectorized metrics should match one-sim-at-a-time metrics
         SIMS = model_votes.return_value.shape[1]
+        sims = [(model_votes.return_value[:,sim,1].tolist(), model_votes.return_value[:,sim,0].tolist())
+            for sim in range(SIMS)]
+        self.assertEqual(sims[0], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9]))
+        
+        MMDs = [score.calculate_MMD(r, b) for (r, b) in sims]
+        self.assertAlmostEqual(output.summary['Mean-Median'], statistics.mean(MMDs), places=4)
+        self.assertAlmostEqual(output.summary['Mean-Median Positives'], len([n for n in MMDs if n > 0]) / SIMS, places=4)
 
-        # First round of sims
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(output.summary['Efficiency Gap Positives'], 0.0)
-        self.assertEqual(calculate_EG.mock_calls[SIMS*0][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9], 0.))
-
-        # Second round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[SIMS*1][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9], .01))
-
-        # Third round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(calculate_EG.mock_calls[SIMS*2][1], ([2.7, 4.1, 5.2, 6.1], [5.3, 3.9, 2.8, 1.9], -.01))
+        PBs = [score.calculate_PB(r, b) for (r, b) in sims]
+        self.assertAlmostEqual(output.summary['Partisan Bias'], statistics.mean(PBs), places=4)
+        self.assertAlmostEqual(output.summary['Partisan Bias Positives'], len([n for n in PBs if n > 0]) / SIMS, places=4)
+        
+        for (swing, name) in [(0, 'Efficiency Gap'), (1, 'Efficiency Gap +1 Dem'), (-1, 'Efficiency Gap +1 Rep')]:
+            EGs = [score.calculate_EG(r, b, swing/100) for (r, b) in sims]
+            self.assertAlmostEqual(output.summary[name], statistics.mean(EGs), places=4)
 
         self.assertEqual(output.districts[0]['totals']['Republican Votes'], 2.27)
         self.assertEqual(output.districts[0]['totals']['Democratic Votes'], 5.73)
@@ -700,6 +745,58 @@ class TestScore (unittest.TestCase):
         self.assertAlmostEqual(output.districts[2]['totals']['Democratic Wins'], 0.3333333)
         self.assertAlmostEqual(output.districts[3]['totals']['Democratic Wins'], 0.)
 
+    @unittest.mock.patch('planscore.matrix.model_votes')
+    @unittest.mock.patch('planscore.matrix.model_votes_batch')
+    def test_calculate_district_biases_batch(self, model_votes_batch, model_votes):
+        ''' Batches of plans are scored just like one plan at a time
+        '''
+        model1 = data.Model(data.State.XX, data.House.ushouse, 4, False, '2020', None)
+        model2 = data.Model(data.State.NC, data.House.ushouse, 2, False, '2020', None)
+        
+        input1 = data.Upload(id=None, key=None, model=model1,
+            districts = [
+                dict(totals={'US President 2016 - REP': 2, 'US President 2016 - DEM': 6}, tile=None),
+                dict(totals={'US President 2016 - REP': 3, 'US President 2016 - DEM': 5}, tile=None),
+                ])
+        
+        input2 = data.Upload(id=None, key=None, model=model1,
+            districts = [
+                dict(totals={'US President 2016 - REP': 5, 'US President 2016 - DEM': 3}, tile=None),
+                dict(totals={'US President 2016 - REP': 6, 'US President 2016 - DEM': 2}, tile=None),
+                ])
+        
+        input3 = data.Upload(id=None, key=None, model=model2,
+            districts = [dict(totals={'REP000': 2, 'DEM000': 6}, tile=None)])
+        
+        input4 = data.Upload(id=None, key=None, model=model2,
+            districts = [
+                dict(totals={'US President 2016 - REP': 4, 'US President 2016 - DEM': 4}, tile=None),
+                dict(totals={'US President 2016 - REP': 1, 'US President 2016 - DEM': 7}, tile=None),
+                ])
+        
+        votes1 = numpy.array([[[5.3, 2.7], [6.0, 2.0], [5.9, 2.1]], [[3.9, 4.1], [5.7, 2.3], [5.1, 2.9]]])
+        votes2 = numpy.array([[[2.8, 5.2], [4.1, 3.9], [2.8, 5.2]], [[1.9, 6.1], [2.7, 5.3], [2.6, 5.4]]])
+        votes4 = numpy.array([[[4.2, 3.8], [3.7, 4.3], [4.4, 3.6]], [[6.6, 1.4], [7.1, 0.9], [6.2, 1.8]]])
+        
+        model_votes_batch.side_effect = lambda state, year, plans: \
+            {data.State.XX: [votes1, votes2], data.State.NC: [votes4]}[state]
+        
+        outputs = score.calculate_district_biases_batch([input1, input2, input3, input4])
+        
+        self.assertEqual(len(model_votes_batch.mock_calls), 2, 'Should model each state once')
+        self.assertEqual(model_votes_batch.mock_calls[0][1][:2], (data.State.XX, None))
+        self.assertEqual(model_votes_batch.mock_calls[0][1][2], [[(6, 2, 'O'), (5, 3, 'O')], [(3, 5, 'O'), (2, 6, 'O')]])
+        self.assertEqual(model_votes_batch.mock_calls[1][1][:2], (data.State.NC, None))
+        self.assertEqual(model_votes_batch.mock_calls[1][1][2], [[(4, 4, 'O'), (7, 1, 'O')]])
+        
+        self.assertEqual(outputs[2].summary, input3.summary, 'Should skip plan without presidential votes')
+        
+        for (input, output, votes) in [(input1, outputs[0], votes1), (input2, outputs[1], votes2), (input4, outputs[3], votes4)]:
+            model_votes.return_value = votes
+            expected = score.calculate_district_biases(input)
+            self.assertEqual(output.summary, expected.summary)
+            self.assertEqual(output.districts, expected.districts)
+
     @unittest.mock.patch('planscore.score.calculate_MMD')
     @unittest.mock.patch('planscore.score.calculate_PB')
     @unittest.mock.patch('planscore.score.calculate_EG')
@@ -740,11 +837,8 @@ class TestScore (unittest.TestCase):
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
         self.assertEqual(model_votes.mock_calls[0][1], (data.State.XX, None, [(6, 2, 'R'), (5, 3, 'D'), (3, 5, 'R'), (2, 6, 'D')]))
 
-    @unittest.mock.patch('planscore.score.calculate_MMD')
-    @unittest.mock.patch('planscore.score.calculate_PB')
-    @unittest.mock.patch('planscore.score.calculate_EG')
     @unittest.mock.patch('planscore.matrix.model_votes')
-    def test_calculate_gap_with_zeros(self, model_votes, calculate_EG, calculate_PB, calculate_MMD):
+    def test_calculate_gap_with_zeros(self, model_votes):
         ''' Efficiency gap can be correctly calculated from presidential vote only
         '''
         input = data.Upload(id=None, key=None,
@@ -757,9 +851,6 @@ class TestScore (unittest.TestCase):
                 dict(totals={'US President 2016 - REP': 0, 'US President 2016 - DEM': 0}, tile=None),
                 ])
         
-        calculate_MMD.return_value = 0
-        calculate_PB.return_value = 0
-        calculate_EG.return_value = 0
         model_votes.return_value = numpy.array([
             [[5.3, 2.7],
              [6.0, 2.0],
@@ -784,33 +875,20 @@ class TestScore (unittest.TestCase):
         output = score.calculate_district_biases(score.calculate_biases(score.calculate_open_biases(score.calculate_bias(input))))
         self.assertEqual(model_votes.mock_calls[0][1], (data.State.XX, None, [(6, 2, 'O'), (5, 3, 'O'), (3, 5, 'O'), (2, 6, 'O'), (0, 0, 'O')]))
         
-        self.assertEqual(output.summary['Mean-Median'], calculate_MMD.return_value)
-        self.assertEqual(len(calculate_MMD.mock_calls[0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_MMD.mock_calls[0][1][1]), 4, 'Should skip empty 5th district')
-
-        self.assertEqual(output.summary['Partisan Bias'], calculate_PB.return_value)
-        self.assertEqual(len(calculate_PB.mock_calls[0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_PB.mock_calls[0][1][1]), 4, 'Should skip empty 5th district')
-        
+        # Vectorized metrics should skip the empty 5th district like one-sim-at-a-time metrics
         SIMS = model_votes.return_value.shape[1]
+        sims = [(model_votes.return_value[:4,sim,1].tolist(), model_votes.return_value[:4,sim,0].tolist())
+            for sim in range(SIMS)]
+        
+        MMDs = [score.calculate_MMD(r, b) for (r, b) in sims]
+        self.assertAlmostEqual(output.summary['Mean-Median'], statistics.mean(MMDs), places=4)
 
-        # First round of sims
-        self.assertEqual(output.summary['Efficiency Gap'], calculate_EG.return_value)
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*0][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*0][1][1]), 4, 'Should skip empty 5th district')
-        self.assertEqual(calculate_EG.mock_calls[SIMS*0][1][2], 0)
-
-        # Second round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Dem'], calculate_EG.return_value)
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*1][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*1][1][1]), 4, 'Should skip empty 5th district')
-        self.assertEqual(calculate_EG.mock_calls[SIMS*1][1][2], .01)
-
-        # Third round of sims
-        self.assertEqual(output.summary['Efficiency Gap +1 Rep'], calculate_EG.return_value)
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*2][1][0]), 4, 'Should skip empty 5th district')
-        self.assertEqual(len(calculate_EG.mock_calls[SIMS*2][1][1]), 4, 'Should skip empty 5th district')
-        self.assertEqual(calculate_EG.mock_calls[SIMS*2][1][2], -.01)
+        PBs = [score.calculate_PB(r, b) for (r, b) in sims]
+        self.assertAlmostEqual(output.summary['Partisan Bias'], statistics.mean(PBs), places=4)
+        
+        for (swing, name) in [(0, 'Efficiency Gap'), (1, 'Efficiency Gap +1 Dem'), (-1, 'Efficiency Gap +1 Rep')]:
+            EGs = [score.calculate_EG(r, b, swing/100) for (r, b) in sims]
+            self.assertAlmostEqual(output.summary[name], statistics.mean(EGs), places=4)
 
         self.assertIsNone(output.districts[-1]['totals']['Republican Votes'])
         self.assertIsNone(output.districts[-1]['totals']['Democratic Votes'])
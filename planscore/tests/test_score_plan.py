@@ -0,0 +1,48 @@
+import unittest, unittest.mock, os
+import botocore.exceptions
+from .. import score_plan
+
+class TestScorePlan (unittest.TestCase):
+
+    def test_local_s3(self):
+        ''' Local S3 stand-in reads keys as paths.
+        '''
+        s3 = score_plan.LocalS3()
+        tile_path = os.path.join(os.path.dirname(__file__), 'data', 'XX', 'tiles', '7', '64', '64.geojson')
+        
+        with open(tile_path, 'rb') as file:
+            self.assertEqual(s3.get_object(Bucket=None, Key=tile_path)['Body'].read(), file.read())
+        
+        with self.assertRaises(botocore.exceptions.ClientError) as error:
+            s3.get_object(Bucket=None, Key=tile_path + '-missing')
+        
+        self.assertEqual(error.exception.response['Error']['Code'], 'NoSuchKey')
+    
+    def test_list_local_tiles(self):
+        ''' Local tiles are listed largest first.
+        '''
+        model_dir = os.path.join(os.path.dirname(__file__), 'data', 'XX')
+        tile_paths = score_plan.list_local_tiles(model_dir)
+        sizes = [os.path.getsize(path) for path in tile_paths]
+        
+        self.assertEqual(len(tile_paths), 4)
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertTrue(all('/tiles/7/' in path for path in tile_paths))
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_score_plan(self, stdout):
+        ''' Plan is scored locally from tiles to summary.
+        '''
+        plan_path = os.path.join(os.path.dirname(__file__), 'data', 'null-plan.geojson')
+        model_dir = os.path.join(os.path.dirname(__file__), 'data', 'XX')
+        upload = score_plan.score_plan(plan_path, model_dir, processes=1)
+        
+        self.assertEqual(upload.id, 'null-plan')
+        self.assertEqual(upload.model.key_prefix, model_dir)
+        self.assertTrue(upload.status)
+        self.assertEqual(len(upload.districts), 2)
+        
+        for district in upload.districts:
+            self.assertIn('compactness', district)
+            self.assertIn('US President 2016 - DEM', district['totals'])
+            self.assertIn('US President 2016 - REP', district['totals'])
@@ -0,0 +1,67 @@
+import unittest, os, json, tempfile, shutil
+from .. import synthetic, score
+
+def ring_area(ring):
+    return sum(x1 * y2 - x2 * y1 for ((x1, y1), (x2, y2)) in zip(ring[:-1], ring[1:])) / 2
+
+class TestSynthetic (unittest.TestCase):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp(prefix='test_synthetic-')
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def test_write_state(self):
+        ''' Precincts and districts tile the whole state with no gaps or overlaps.
+        '''
+        precincts_path, plan_path = synthetic.write_state(self.dirname,
+            precincts=200, districts=7, sims=3, vertices=4, width=2., height=1.)
+        
+        with open(precincts_path) as file:
+            precincts = json.load(file)['features']
+        
+        with open(plan_path) as file:
+            districts = json.load(file)['features']
+        
+        self.assertEqual(len(precincts), 200)
+        self.assertEqual(len(districts), 7)
+        
+        for feature in precincts + districts:
+            ring = feature['geometry']['coordinates'][0]
+            self.assertEqual(ring[0], ring[-1])
+            self.assertGreater(ring_area(ring), 0, 'Should be counter-clockwise')
+        
+        # Each precinct edge has 4 extra vertices, plus corners
+        self.assertEqual(len(precincts[0]['geometry']['coordinates'][0]), 4 * 5 + 1)
+        
+        precincts_area = sum(ring_area(f['geometry']['coordinates'][0]) for f in precincts)
+        districts_area = sum(ring_area(f['geometry']['coordinates'][0]) for f in districts)
+        self.assertAlmostEqual(precincts_area, 2., 9)
+        self.assertAlmostEqual(districts_area, 2., 9)
+        
+        properties = precincts[0]['properties']
+        self.assertEqual(properties['GEOID'], '00000000')
+        self.assertEqual(len([name for name in properties if ':' in name]), 3 * 6)
+        self.assertTrue(set(properties) <= set(score.FIELD_NAMES) | {'GEOID'})
+        
+        # The same seed makes the same state
+        synthetic.write_state(os.path.join(self.dirname, 'again'),
+            precincts=200, districts=7, sims=3, vertices=4, width=2., height=1.)
+        
+        with open(os.path.join(self.dirname, 'again', 'precincts.geojson')) as file:
+            self.assertEqual(json.load(file)['features'], precincts)
+    
+    def test_district_blocks(self):
+        ''' District blocks cover every grid cell exactly once.
+        '''
+        for district_count in (1, 2, 13, 53):
+            blocks = synthetic.district_blocks(20, 15, district_count, 4., 3.)
+            self.assertEqual(len(blocks), district_count)
+            
+            cells = [(i, j) for (i0, j0, i1, j1) in blocks
+                for i in range(i0, i1) for j in range(j0, j1)]
+            self.assertEqual(sorted(cells), [(i, j) for i in range(20) for j in range(15)])
+        
+        with self.assertRaises(ValueError):
+            synthetic.district_blocks(2, 2, 9, 1., 1.)
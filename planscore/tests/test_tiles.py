@@ -1,6 +1,6 @@
 import unittest, unittest.mock, os, json, io, gzip, itertools, collections
-import osgeo.ogr, botocore.exceptions
-from .. import tiles, data, constants
+import osgeo.ogr, botocore.exceptions, shapely.wkt, shapely.errors
+from .. import tiles, data, constants, prepare_state, util
 
 should_gzip = itertools.cycle([True, False])
 
@@ -66,6 +66,128 @@ class TestTiles (unittest.TestCase):
         s3.list_objects.assert_called_once_with(Bucket='bucket-name',
             Prefix="uploads/sample-plan/geometries/")
 
+    def test_load_upload_geometries_subset(self):
+        ''' Only requested geometries are retrieved from S3.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'sample-plan'
+
+        s3.get_object.side_effect = mock_s3_get_object
+        geometries = tiles.load_upload_geometries(storage, upload,
+            ["uploads/sample-plan/geometries/1.wkt"])
+
+        self.assertEqual(list(geometries.keys()), ["uploads/sample-plan/geometries/1.wkt"])
+        self.assertEqual(len(s3.list_objects.mock_calls), 0)
+    
+    def test_geometry_bundle(self):
+        ''' District geometries survive a round trip through a bundle.
+        '''
+        keys = ['uploads/ID/geometries/0.wkt', 'uploads/ID/geometries/1.wkt', 'uploads/ID/geometries/2.wkt']
+        geometries = [
+            osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1, -1 1, 1 1, 1 -1, -1 -1))'),
+            osgeo.ogr.CreateGeometryFromWkt('MULTIPOLYGON (((0 0, 0 2, 2 2, 2 0, 0 0)))'),
+            osgeo.ogr.CreateGeometryFromWkt('GEOMETRYCOLLECTION EMPTY'),
+            ]
+        
+        bundle = tiles.geometry_bundle(keys, geometries)
+        self.assertTrue(bundle.startswith(tiles.GEOMETRY_BUNDLE_MAGIC))
+        
+        geometries1 = tiles.read_geometry_bundle(bundle)
+        self.assertEqual(list(geometries1.keys()), keys)
+        
+        for (key, geometry) in zip(keys, geometries):
+            self.assertTrue(geometries1[key].Equals(geometry) or geometry.IsEmpty())
+        
+        self.assertTrue(geometries1[keys[2]].IsEmpty())
+        
+        geometries2 = tiles.read_geometry_bundle(bundle, keys[1:2])
+        self.assertEqual(list(geometries2.keys()), keys[1:2])
+        
+        with self.assertRaises(ValueError):
+            tiles.read_geometry_bundle(b'Not a bundle')
+
+    def test_load_upload_geometries_bundle(self):
+        ''' Geometry bundle is retrieved from S3 once and reused.
+        '''
+        s3, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+        upload.id = 'bundled-plan'
+        
+        keys = ['uploads/bundled-plan/geometries/0.wkt', 'uploads/bundled-plan/geometries/1.wkt']
+        bundle = tiles.geometry_bundle(keys, [
+            osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1, -1 1, 1 1, 1 -1, -1 -1))'),
+            osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0 0, 0 2, 2 2, 2 0, 0 0))'),
+            ])
+        
+        tiles._geometry_cache.clear()
+        s3.get_object.return_value = {'Body': io.BytesIO(gzip.compress(bundle)),
+            'ContentEncoding': 'gzip'}
+
+        geometries1 = tiles.load_upload_geometries(storage, upload)
+        geometries2 = tiles.load_upload_geometries(storage, upload, keys[1:])
+        tiles._geometry_cache.clear()
+
+        self.assertEqual(list(geometries1.keys()), keys)
+        self.assertEqual(list(geometries2.keys()), keys[1:])
+        self.assertEqual(len(s3.list_objects.mock_calls), 0)
+        s3.get_object.assert_called_once_with(Bucket='bucket-name',
+            Key='uploads/bundled-plan/geometries.bin')
+    
+    def test_load_tile_totals(self):
+        ''' Expected precomputed tile totals are loaded from S3.
+        '''
+        s3 = unittest.mock.Mock()
+        s3.get_object.side_effect = mock_s3_get_object
+        storage = data.Storage(s3, 'bucket-name', 'XX')
+
+        totals1 = tiles.load_tile_totals(storage, '7/64/64')
+        s3.get_object.assert_called_once_with(Bucket='bucket-name', Key='XX/totals/7/64/64.json')
+        self.assertEqual(totals1['features'], 3)
+        self.assertEqual(totals1['totals']['Population 2010'], 16)
+
+        totals2 = tiles.load_tile_totals(storage, '7/63/63')
+        self.assertIsNone(totals2)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_tile_loader_phases(self, stdout):
+        ''' Every tile loader counts S3 requests as fetch time, not as other phases.
+        '''
+        clock = [0]
+        
+        def slow_get_object(Bucket, Key):
+            clock[0] += 1
+            body = prepare_state.binary_tile([], []) if Key.endswith('.bin') else b'{"features": []}'
+            return {'Body': io.BytesIO(gzip.compress(body)), 'ContentEncoding': 'gzip'}
+        
+        storage = data.Storage(unittest.mock.Mock(), 'bucket-name', 'XX')
+        storage.s3.get_object.side_effect = slow_get_object
+        
+        with unittest.mock.patch('time.perf_counter', lambda: clock[0]):
+            for load in (tiles.load_tile_precincts, tiles.load_binary_tile, tiles.load_tile_totals):
+                profile = util.Profile()
+                load(storage, '7/64/64', profile)
+                self.assertEqual(profile.seconds['fetch'], 1, load.__name__)
+                self.assertEqual(set(profile.seconds), {'fetch', 'decompress', 'parse'}, load.__name__)
+    
+    def test_get_interior_district(self):
+        ''' Single district containing a tile is found.
+        '''
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        west = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.05 1,0.05 -1,-1 -1))')
+        east = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0.05 -1,0.05 1,1 1,1 -1,0.05 -1))')
+        middle = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0.1 -1,0.1 1,1 1,1 -1,0.1 -1))')
+        
+        # Neighbors sharing an edge exactly along the tile's west side
+        touching = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.087890625 1,0.087890625 -1,-1 -1))')
+        covering = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0.087890625 -1,0.087890625 1,1 1,1 -1,0.087890625 -1))')
+        
+        self.assertEqual(tiles.get_interior_district({'W': west, 'E': east}, tile_geom), 'E')
+        self.assertEqual(tiles.get_interior_district({'T': touching, 'C': covering}, tile_geom), 'C')
+        self.assertIsNone(tiles.get_interior_district({'W': west, 'M': middle}, tile_geom))
+        self.assertIsNone(tiles.get_interior_district({'E': east, 'M': middle}, tile_geom))
+        self.assertIsNone(tiles.get_interior_district({'W': west}, tile_geom))
+    
     def test_load_tile_precincts_oldstyle(self):
         ''' Expected tiles are loaded from old-style model in S3 without "tiles" infix
         '''
@@ -257,6 +379,183 @@ class TestTiles (unittest.TestCase):
         totals = tiles.score_precinct(district_geom.Intersection(tile_geom), precinct, tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
     
+    def test_parse_tile_precincts(self):
+        ''' Precinct features are parsed once with areas, envelopes, and field names.
+        '''
+        precincts = tiles.parse_tile_precincts([
+            {"type": "Feature", "properties": {"Voters": 1, "NAME": "P1", "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}},
+            {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.13, .14]}},
+            {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "GeometryCollection", "geometries": [ ]}},
+            ])
+        
+        self.assertEqual(len(precincts), 3)
+        self.assertEqual(precincts[0].field_names, ['Voters'])
+        self.assertAlmostEqual(precincts[0].area, .0016, 9)
+        self.assertEqual(precincts[0].envelope, (.12, .16, .12, .16))
+        self.assertFalse(precincts[0].is_point)
+        self.assertTrue(precincts[1].is_point)
+        self.assertEqual(precincts[1].area, 0)
+        self.assertIsNone(precincts[2].geometry)
+        
+        # Parsed precincts score the same as plain features
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.14 1,0.14 -1,-1 -1))')
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        totals = tiles.score_district(district_geom, precincts, tile_geom)
+        self.assertAlmostEqual(totals['Voters'], 1.25, 2)
+    
+    def test_score_tile(self):
+        ''' Matrix tile scoring matches per-district scoring.
+        '''
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        precincts = tiles.parse_tile_precincts([
+            {"type": "Feature", "properties": {"Voters": 4, "Red Votes": 3, "Blue Votes": None, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}},
+            {"type": "Feature", "properties": {"Voters": 2, "Red Votes": 1, "Blue Votes": 1, "PlanScore:Fraction": 1.0}, "geometry": {"type": "Polygon", "coordinates": [[[.1, .1], [.1, .11], [.11, .11], [.11, .1], [.1, .1]]]}},
+            {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.15, .14]}},
+            ])
+        
+        geometries = {
+            'west': osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.14 1,0.14 -1,-1 -1))'),
+            'east': osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0.14 -1,0.14 1,1 1,1 -1,0.14 -1))'),
+            'far': osgeo.ogr.CreateGeometryFromWkt('POLYGON ((10 10,10 11,11 11,11 10,10 10))'),
+            }
+        
+        totals = tiles.score_tile(geometries, precincts, tile_geom)
+
+        self.assertEqual(totals['far'], {})
+        self.assertAlmostEqual(totals['west']['Voters'], 3., 2)
+        self.assertAlmostEqual(totals['west']['Red Votes'], 1.75, 2)
+        self.assertAlmostEqual(totals['west']['Blue Votes'], 1., 2)
+        self.assertAlmostEqual(totals['east']['Voters'], 2., 2)
+        self.assertAlmostEqual(totals['east']['Red Votes'], .75, 2)
+        self.assertAlmostEqual(totals['east']['Blue Votes'], 0., 2)
+        
+        for key in ('west', 'east'):
+            district_totals = tiles.score_district(geometries[key], precincts, tile_geom)
+            for (name, value) in district_totals.items():
+                self.assertAlmostEqual(totals[key][name], value, 2)
+    
+    def test_score_tile_binary(self):
+        ''' Binary tile scoring matches GeoJSON tile scoring.
+        '''
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        features = [
+            {"type": "Feature", "properties": {"Voters": 4, "Red Votes": 3, "Blue Votes": None, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}},
+            {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "Point", "coordinates": [.15, .14]}},
+            ]
+        
+        feature_defn = osgeo.ogr.FeatureDefn()
+        feature_defn.AddFieldDefn(osgeo.ogr.FieldDefn(prepare_state.FRACTION_FIELD, osgeo.ogr.OFTReal))
+        ogr_features = []
+        
+        for feature in features:
+            ogr_feature = osgeo.ogr.Feature(feature_defn)
+            ogr_feature.SetGeometry(osgeo.ogr.CreateGeometryFromJson(json.dumps(feature['geometry'])))
+            if prepare_state.FRACTION_FIELD in feature['properties']:
+                ogr_feature.SetField(prepare_state.FRACTION_FIELD, feature['properties'][prepare_state.FRACTION_FIELD])
+            ogr_features.append(ogr_feature)
+        
+        binary_tile = prepare_state.read_binary_tile(prepare_state.binary_tile(
+            ogr_features, [feature['properties'] for feature in features]))
+        precincts = tiles.parse_binary_precincts(binary_tile)
+        
+        self.assertEqual(precincts[0].properties, {prepare_state.FRACTION_FIELD: .5})
+        self.assertEqual(precincts[1].properties, {prepare_state.FRACTION_FIELD: None})
+        self.assertTrue(precincts[1].is_point)
+        
+        geometries = {
+            'west': osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.14 1,0.14 -1,-1 -1))'),
+            'east': osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0.14 -1,0.14 1,1 1,1 -1,0.14 -1))'),
+            }
+        
+        totals1 = tiles.score_tile(geometries, precincts, tile_geom,
+            binary_tile.columns, binary_tile.values)
+        totals2 = tiles.score_tile(geometries, tiles.parse_tile_precincts(features), tile_geom)
+        
+        self.assertEqual(totals1, totals2)
+    
+    def test_precinct_values(self):
+        ''' Precinct values array weights household income by household count.
+        '''
+        precincts = [
+            tiles.Precinct({'Voters': 2, 'Households 2016': 3, 'Household Income 2016': 100},
+                ['Voters', 'Households 2016', 'Household Income 2016'], None, None, None, 0, False),
+            tiles.Precinct({'Voters': None}, ['Voters'], None, None, None, 0, False),
+            ]
+        
+        field_names = tiles.tile_field_names(precincts)
+        self.assertEqual(field_names, ['Voters', 'Households 2016',
+            'Household Income 2016', 'Sum Household Income 2016'])
+        
+        column_index = {name: column for (column, name) in enumerate(field_names)}
+        values = tiles.precinct_values(precincts, column_index)
+        self.assertEqual(values.tolist(), [[2, 3, 0, 300], [0, 0, 0, 0]])
+    
+    def test_score_precinct_2_prepared(self):
+        ''' Prepared district geometry gives same voter counts as plain intersection.
+        '''
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        precinct = {"type": "Feature", "properties": {"Voters": 1, "PlanScore:Fraction": 0.5}, "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.12, .16], [.16, .16], [.16, .12], [.12, .12]]]}}
+        
+        for (east, expected) in [(0.17, .5), (0.14, .25), (0.12, 0.), (0.11, 0.)]:
+            district_geom = osgeo.ogr.CreateGeometryFromWkt(f'POLYGON ((-1 -1,-1 1,{east} 1,{east} -1,-1 -1))')
+            partial_geom = district_geom.Intersection(tile_geom)
+            prepared_geom = tiles.prepare_district_geom(partial_geom)
+            totals = tiles.score_precinct(partial_geom, precinct, tile_geom, prepared_district_geom=prepared_geom)
+            self.assertAlmostEqual(totals['Voters'], expected, 9)
+    
+    def test_precinct_relation(self):
+        ''' Precincts are correctly classified against a prepared district geometry.
+        '''
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((0 0,0 1,1 1,1 0,0 0))')
+        prepared_geom = tiles.prepare_district_geom(district_geom)
+        
+        inside = tiles.parse_precinct({"properties": {}, "geometry": {"type": "Polygon", "coordinates": [[[.2, .2], [.2, .4], [.4, .4], [.4, .2], [.2, .2]]]}})
+        outside = tiles.parse_precinct({"properties": {}, "geometry": {"type": "Polygon", "coordinates": [[[2, 2], [2, 4], [4, 4], [4, 2], [2, 2]]]}})
+        crossing = tiles.parse_precinct({"properties": {}, "geometry": {"type": "Polygon", "coordinates": [[[.5, .5], [.5, 2], [2, 2], [2, .5], [.5, .5]]]}})
+        
+        self.assertEqual(tiles.precinct_relation(prepared_geom, inside), tiles.PRECINCT_INSIDE)
+        self.assertEqual(tiles.precinct_relation(prepared_geom, outside), tiles.PRECINCT_OUTSIDE)
+        self.assertEqual(tiles.precinct_relation(prepared_geom, crossing), tiles.PRECINCT_BOUNDARY)
+        self.assertEqual(tiles.precinct_relation(None, inside), tiles.PRECINCT_BOUNDARY)
+        
+        empty_geom = osgeo.ogr.Geometry(osgeo.ogr.wkbGeometryCollection)
+        self.assertIsNone(tiles.prepare_district_geom(empty_geom))
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_precinct_relation_invalid(self, stdout):
+        ''' Self-intersecting precincts that fail GEOS predicates cross the boundary.
+        '''
+        bowtie = shapely.wkt.loads('POLYGON ((.2 .2, .4 .4, .4 .2, .2 .4, .2 .2))')
+        precinct = tiles.Precinct({}, [], None, bowtie, (.2, .4, .2, .4), 0, False)
+        
+        prepared_geom = unittest.mock.Mock()
+        prepared_geom.context.bounds = (0, 0, 1, 1)
+        prepared_geom.covers.side_effect = shapely.errors.ShapelyError('TopologyException: side location conflict')
+        
+        self.assertEqual(tiles.precinct_relation(prepared_geom, precinct), tiles.PRECINCT_BOUNDARY)
+        
+        prepared_geom.covers.side_effect = None
+        prepared_geom.covers.return_value = False
+        prepared_geom.intersects.side_effect = shapely.errors.ShapelyError('TopologyException: side location conflict')
+        
+        self.assertEqual(tiles.precinct_relation(prepared_geom, precinct), tiles.PRECINCT_BOUNDARY)
+    
+    @unittest.mock.patch('sys.stdout')
+    def test_precinct_weight_invalid(self, stdout):
+        ''' Self-intersecting precincts are weighted through the intersection fallback.
+        '''
+        tile_geom = tiles.tile_geometry('12/2049/2046')
+        district_geom = osgeo.ogr.CreateGeometryFromWkt('POLYGON ((-1 -1,-1 1,0.14 1,0.14 -1,-1 -1))')
+        partial_geom = district_geom.Intersection(tile_geom)
+        prepared_geom = tiles.prepare_district_geom(partial_geom)
+        
+        precinct = tiles.parse_precinct({"properties": {"Voters": 1, "PlanScore:Fraction": 1},
+            "geometry": {"type": "Polygon", "coordinates": [[[.12, .12], [.16, .16], [.16, .12], [.12, .16], [.12, .12]]]}})
+        
+        weight = tiles.precinct_weight(partial_geom, precinct, tile_geom, prepared_district_geom=prepared_geom)
+        self.assertGreaterEqual(weight, 0)
+        self.assertLessEqual(weight, 1)
+    
     def test_score_precinct_2e_tile_overlaps_blockpoint_within(self):
         ''' Correct voter count for a block-point within district from tile overlapping district.
         '''
@@ -333,3 +632,125 @@ class TestTiles (unittest.TestCase):
         empty = {"type": "Feature", "properties": {"Voters": 1}, "geometry": {"type": "GeometryCollection", "geometries": [ ]}}
         totals = tiles.score_precinct(district_geom.Intersection(tile_geom), empty, tile_geom)
         self.assertAlmostEqual(totals['Voters'], 0., 9)
+    
+    @unittest.mock.patch('planscore.tiles.score_tile')
+    @unittest.mock.patch('planscore.tiles.parse_tile_precincts')
+    @unittest.mock.patch('planscore.tiles.load_tile_precincts')
+    @unittest.mock.patch('planscore.tiles.load_tile_totals')
+    def test_score_tile_key_cached(self, load_tile_totals, load_tile_precincts, parse_tile_precincts, score_tile):
+        ''' Warm invocations reuse parsed tile precincts and missing totals.
+        '''
+        storage = data.Storage(unittest.mock.Mock(), 'bucket-name', 'data/XX')
+        upload = data.Upload('ID', 'uploads/ID/upload/file.geojson',
+            model=data.Model(data.State.XX, data.House.ushouse, 2, False, None, 'data/XX'))
+        
+        # District covers the whole tile, but there are no precomputed totals
+        geometries = {'uploads/ID/geometries/0.wkt': osgeo.ogr.CreateGeometryFromWkt(
+            'POLYGON ((-123 37, -123 38, -122 38, -122 37, -123 37))')}
+
+        load_tile_totals.return_value = None
+        parse_tile_precincts.return_value = []
+        tiles._tile_cache.clear()
+        
+        profile = util.Profile()
+        
+        for _ in range(3):
+            tiles.score_tile_key(storage, upload, 'data/XX/tiles/12/656/1582.geojson', geometries, profile)
+
+        tiles._tile_cache.clear()
+        
+        self.assertEqual(profile.counts['cache_hits'], 2)
+        self.assertIn('parse', profile.seconds)
+        self.assertIn('setup', profile.seconds)
+        
+        self.assertEqual(len(load_tile_totals.mock_calls), 1)
+        self.assertEqual(len(load_tile_precincts.mock_calls), 1)
+        self.assertEqual(len(parse_tile_precincts.mock_calls), 1)
+        self.assertEqual(len(score_tile.mock_calls), 3)
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.tiles.upload_finished')
+    @unittest.mock.patch('planscore.tiles.score_tile_key')
+    @unittest.mock.patch('planscore.tiles.load_upload_geometries')
+    def test_lambda_handler_batch(self, load_upload_geometries, score_tile_key, upload_finished, boto3_client, stdout):
+        ''' A batch of tiles loads geometries once and writes one result.
+        '''
+        upload_finished.return_value = False
+        score_tile_key.side_effect = [({'k': {'Voters': 1}}, 1), RuntimeError('Oops')]
+        
+        event = {
+            'upload': {'id': 'ID', 'key': 'uploads/ID/upload/file.geojson',
+                'model': {'state': 'XX', 'house': 'ushouse', 'seats': 2, 'key_prefix': 'data/XX'}},
+            'storage': {'bucket': 'bucket-name', 'prefix': 'data/XX'},
+            'tile_keys': ['data/XX/tiles/12/656/1582.geojson', 'data/XX/tiles/12/656/1583.geojson'],
+            'geometry_keys': ['uploads/ID/geometries/0.wkt'],
+            }
+        
+        tiles.lambda_handler(event, None)
+        
+        self.assertEqual(len(load_upload_geometries.mock_calls), 1)
+        self.assertEqual(load_upload_geometries.mock_calls[0][1][2], ['uploads/ID/geometries/0.wkt'])
+        self.assertEqual(len(score_tile_key.mock_calls), 2)
+        
+        (put_call, ) = boto3_client.return_value.put_object.mock_calls
+        self.assertEqual(put_call[2]['Key'], 'uploads/ID/tiles/12/656/1582.json')
+        
+        body = json.loads(put_call[2]['Body'])
+        self.assertEqual(body['tiles'][0]['tile_key'], 'data/XX/tiles/12/656/1582.geojson')
+        self.assertEqual(body['tiles'][0]['totals'], {'k': {'Voters': 1}})
+        self.assertEqual(body['tiles'][0]['timing']['features'], 1)
+        self.assertEqual(body['tiles'][1]['totals'], 'Oops')
+        self.assertIsNone(body['tiles'][1]['timing']['features'])
+    
+    @unittest.mock.patch('sys.stdout')
+    @unittest.mock.patch('boto3.client')
+    @unittest.mock.patch('planscore.tiles.upload_finished')
+    @unittest.mock.patch('planscore.tiles.score_tile_key')
+    @unittest.mock.patch('planscore.tiles.load_upload_geometries')
+    def test_lambda_handler_upload_finished(self, load_upload_geometries, score_tile_key, upload_finished, boto3_client, stdout):
+        ''' A late tile leaves no result once the upload is finished.
+        '''
+        score_tile_key.return_value = ({'k': {'Voters': 1}}, 1)
+        s3 = boto3_client.return_value
+        
+        event = {
+            'upload': {'id': 'ID', 'key': 'uploads/ID/upload/file.geojson',
+                'model': {'state': 'XX', 'house': 'ushouse', 'seats': 2, 'key_prefix': 'data/XX'}},
+            'storage': {'bucket': 'bucket-name', 'prefix': 'data/XX'},
+            'tile_key': 'data/XX/tiles/12/656/1582.geojson',
+            }
+        
+        # Finished before scoring was done, so nothing is written
+        upload_finished.side_effect = [True]
+        tiles.lambda_handler(event, None)
+        self.assertEqual(len(s3.put_object.mock_calls), 0)
+        
+        # Finished while the result was being written, so it's deleted
+        upload_finished.side_effect = [False, True]
+        tiles.lambda_handler(event, None)
+        self.assertEqual(len(s3.put_object.mock_calls), 1)
+        (delete_call, ) = s3.delete_object.mock_calls
+        self.assertEqual(delete_call[2]['Key'], 'uploads/ID/tiles/12/656/1582.json')
+        
+        # Still going, so the result is kept
+        upload_finished.side_effect = [False, False]
+        tiles.lambda_handler(event, None)
+        self.assertEqual(len(s3.put_object.mock_calls), 2)
+        self.assertEqual(len(s3.delete_object.mock_calls), 1)
+    
+    def test_upload_finished(self):
+        ''' Upload is finished once its index has a status.
+        '''
+        storage, upload = unittest.mock.Mock(), unittest.mock.Mock()
+        upload.id = 'ID'
+        
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'{"id": "ID"}')}
+        self.assertFalse(tiles.upload_finished(storage, upload))
+        self.assertEqual(storage.s3.get_object.mock_calls[0][2]['Key'], 'uploads/ID/index.json')
+        
+        storage.s3.get_object.return_value = {'Body': io.BytesIO(b'{"id": "ID", "status": true}')}
+        self.assertTrue(tiles.upload_finished(storage, upload))
+        
+        storage.s3.get_object.side_effect = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        self.assertFalse(tiles.upload_finished(storage, upload))
@@ -184,3 +184,48 @@ class TestUtil (unittest.TestCase):
 
         args4 = util.event_query_args({'queryStringParameters': {'foo': 'bar'}})
         self.assertEqual(args4, {'foo': 'bar'})
+
+    def test_sized_cache(self):
+        cache = util.SizedCache(10)
+        cache.put('a', 'A', 4)
+        cache.put('b', 'B', 4)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.size, 8)
+        
+        # "b" was used least recently, so it goes first
+        cache.put('c', 'C', 4)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.get('b', 'default'), 'default')
+        self.assertEqual((cache.get('a'), cache.get('c')), ('A', 'C'))
+        self.assertEqual(cache.size, 8)
+        
+        # Replacing a value updates its size
+        cache.put('a', 'AA', 2)
+        self.assertEqual(cache.get('a'), 'AA')
+        self.assertEqual(cache.size, 6)
+        
+        # Values larger than the whole cache are never kept
+        cache.put('d', 'D', 11)
+        self.assertNotIn('d', cache)
+        self.assertEqual(len(cache), 2)
+        
+        cache.clear()
+        self.assertEqual((len(cache), cache.size), (0, 0))
+    
+    @unittest.mock.patch('time.perf_counter')
+    def test_profile(self, perf_counter):
+        perf_counter.side_effect = [1., 1.5, 2., 4.]
+        profile = util.Profile()
+        
+        with profile.phase('fetch'):
+            pass
+        
+        # Time is counted even when the phase raises
+        with self.assertRaises(ValueError):
+            with profile.phase('fetch'):
+                raise ValueError()
+        
+        profile.count('precincts', 3)
+        profile.count('cache_hits')
+        
+        self.assertEqual(profile.to_dict(), {'fetch_time': 2.5, 'precincts': 3, 'cache_hits': 1})
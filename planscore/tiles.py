@@ -1,5 +1,6 @@
-import os, json, io, gzip, posixpath, functools, collections, time
+import os, json, io, gzip, math, posixpath, functools, collections, time, struct, zlib, itertools
 import osgeo.ogr, boto3, botocore.exceptions, ModestMaps.OpenStreetMap, ModestMaps.Core
+import shapely.geometry, shapely.prepared, shapely.wkb, shapely.errors, numpy
 from . import constants, data, util, prepare_state, score
 
 FUNCTION_NAME = os.environ.get('FUNC_NAME_RUN_TILE') or 'PlanScore-RunTile'
@@ -7,15 +8,131 @@ FUNCTION_NAME = os.environ.get('FUNC_NAME_RUN_TILE') or 'PlanScore-RunTile'
 # Borrow some Modest Maps tile math
 _mercator = ModestMaps.OpenStreetMap.Provider().projection
 
-def load_upload_geometries(storage, upload):
-    ''' Get dictionary of OGR geometries for an upload.
+# Possible relationships between a precinct and a prepared district geometry
+PRECINCT_INSIDE, PRECINCT_OUTSIDE, PRECINCT_BOUNDARY = 'inside', 'outside', 'boundary'
+
+# First bytes of a district geometry bundle from geometry_bundle()
+GEOMETRY_BUNDLE_MAGIC = b'PSGEOM01'
+
+# Rough ratio of memory used by parsed OGR and Python objects to their WKB size
+PARSED_SIZE_FACTOR = 4
+
+# Warm-container caches of parsed district geometries and model tiles,
+# each bounded to half of the Lambda memory set aside for caching
+_CACHE_SIZE = int(constants.LAMBDA_MEMORY_SIZE * 2**20 * constants.CACHE_MEMORY_FRACTION / 2)
+_geometry_cache = util.SizedCache(_CACHE_SIZE)
+_tile_cache = util.SizedCache(_CACHE_SIZE)
+
+# Stand-in for cached tile totals when a tile has none
+_NO_TOTALS = object()
+
+# Number of precincts per chunk of precinct × field values in score_tile()
+TILE_PRECINCT_CHUNK = 500
+
+# Precinct feature with geometry parsed once per tile and reused for each district
+Precinct = collections.namedtuple('Precinct', ('properties', 'field_names',
+    'geometry', 'shape', 'envelope', 'area', 'is_point'))
+
+def geometry_bundle(geometry_keys, geometries):
+    ''' Return bytes for a single bundle of district OGR geometries.
+    
+        Layout is magic bytes, little-endian uint32 header length, JSON header
+        with geometry keys and byte offsets, then one zlib-compressed WKB per
+        district. Offsets are relative to the end of the header so any single
+        geometry can be read by itself.
     '''
+    blobs = [zlib.compress(bytes(geometry.ExportToWkb())) for geometry in geometries]
+    offsets = [0]
+    
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    
+    header = json.dumps(dict(keys=list(geometry_keys), offsets=offsets)).encode('utf8')
+    
+    return b''.join([GEOMETRY_BUNDLE_MAGIC, struct.pack('<I', len(header)), header] + blobs)
+
+def read_geometry_bundle(body, geometry_keys=None):
+    ''' Return dictionary of OGR geometries for bytes from geometry_bundle().
+    
+        Optional geometry_keys limits results to a subset of district geometries.
+    '''
+    body = memoryview(body)
+    start = len(GEOMETRY_BUNDLE_MAGIC)
+    
+    if bytes(body[:start]) != GEOMETRY_BUNDLE_MAGIC:
+        raise ValueError('Not a geometry bundle')
+    
+    (header_length, ) = struct.unpack('<I', body[start:start + 4])
+    header = json.loads(bytes(body[start + 4:start + 4 + header_length]))
+    offset = start + 4 + header_length
+    
+    wanted_keys = set(header['keys'] if geometry_keys is None else geometry_keys)
     geometries = {}
     
-    geoms_prefix = posixpath.dirname(data.UPLOAD_GEOMETRIES_KEY).format(id=upload.id)
-    response = storage.s3.list_objects(Bucket=storage.bucket, Prefix=f'{geoms_prefix}/')
+    for (key, begin, end) in zip(header['keys'], header['offsets'][:-1], header['offsets'][1:]):
+        if key in wanted_keys:
+            wkb = zlib.decompress(body[offset + begin:offset + end])
+            geometries[key] = osgeo.ogr.CreateGeometryFromWkb(wkb)
+    
+    return geometries
 
-    geometry_keys = [object['Key'] for object in response['Contents']]
+def load_geometry_bundle(storage, upload):
+    ''' Get geometry bundle bytes for an upload, or None if there is no bundle.
+    '''
+    key = data.UPLOAD_GEOMETRY_BUNDLE_KEY.format(id=upload.id)
+
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            # Older uploads have one WKT object per district
+            return None
+        raise
+
+    body = object['Body'].read()
+
+    if object.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    
+    return body
+
+def load_bundle_geometries(storage, upload):
+    ''' Get dictionary of all bundled OGR geometries for an upload, or None.
+    
+        Parsed geometries are kept between invocations of a warm container.
+    '''
+    cache_key = (storage.bucket, upload.id)
+    geometries = _geometry_cache.get(cache_key)
+    
+    if geometries is None:
+        bundle = load_geometry_bundle(storage, upload)
+        
+        if bundle is None:
+            return None
+        
+        geometries = read_geometry_bundle(bundle)
+        _geometry_cache.put(cache_key, geometries, len(bundle) * PARSED_SIZE_FACTOR)
+    
+    return geometries
+
+def load_upload_geometries(storage, upload, geometry_keys=None):
+    ''' Get dictionary of OGR geometries for an upload.
+    
+        Optional geometry_keys limits results to a subset of district geometries.
+    '''
+    bundle_geometries = load_bundle_geometries(storage, upload)
+    
+    if bundle_geometries is not None:
+        if geometry_keys is None:
+            return dict(bundle_geometries)
+        return {key: bundle_geometries[key] for key in geometry_keys}
+    
+    geometries = {}
+    
+    if geometry_keys is None:
+        geoms_prefix = posixpath.dirname(data.UPLOAD_GEOMETRIES_KEY).format(id=upload.id)
+        response = storage.s3.list_objects(Bucket=storage.bucket, Prefix=f'{geoms_prefix}/')
+        geometry_keys = [object['Key'] for object in response['Contents']]
     
     for geometry_key in geometry_keys:
         object = storage.s3.get_object(Bucket=storage.bucket, Key=geometry_key)
@@ -28,33 +145,133 @@ def load_upload_geometries(storage, upload):
     
     return geometries
 
-def load_tile_precincts(storage, tile_zxy):
+def load_tile_precincts(storage, tile_zxy, profile=None):
     ''' Get GeoJSON features for a specific tile.
+    
+        Optional profile is a util.Profile for fetch, decompress, and parse times.
+        Like other tile loaders, fetch covers S3 requests and reading bodies,
+        decompress covers gzip, and parse covers decoding the bytes.
     '''
+    profile = profile or util.Profile()
+    
     try:
-        # Search for tile GeoJSON inside the storage prefix
-        print('storage.s3.get_object():', dict(Bucket=storage.bucket,
-            Key='{}/tiles/{}.geojson'.format(storage.prefix, tile_zxy)))
-        object = storage.s3.get_object(Bucket=storage.bucket,
-            Key='{}/tiles/{}.geojson'.format(storage.prefix, tile_zxy))
+        with profile.phase('fetch'):
+            # Search for tile GeoJSON inside the storage prefix
+            print('storage.s3.get_object():', dict(Bucket=storage.bucket,
+                Key='{}/tiles/{}.geojson'.format(storage.prefix, tile_zxy)))
+            object = storage.s3.get_object(Bucket=storage.bucket,
+                Key='{}/tiles/{}.geojson'.format(storage.prefix, tile_zxy))
     except botocore.exceptions.ClientError as error:
         # Back up and search for old-style path without "tiles" infix
         try:
-            print('storage.s3.get_object():', dict(Bucket=storage.bucket,
-                Key='{}/{}.geojson'.format(storage.prefix, tile_zxy)))
-            object = storage.s3.get_object(Bucket=storage.bucket,
-                Key='{}/{}.geojson'.format(storage.prefix, tile_zxy))
+            with profile.phase('fetch'):
+                print('storage.s3.get_object():', dict(Bucket=storage.bucket,
+                    Key='{}/{}.geojson'.format(storage.prefix, tile_zxy)))
+                object = storage.s3.get_object(Bucket=storage.bucket,
+                    Key='{}/{}.geojson'.format(storage.prefix, tile_zxy))
         except botocore.exceptions.ClientError as error:
             if error.response['Error']['Code'] == 'NoSuchKey':
                 return []
             raise
+    
+    with profile.phase('fetch'):
+        body = object['Body'].read()
 
     if object.get('ContentEncoding') == 'gzip':
-        object['Body'] = io.BytesIO(gzip.decompress(object['Body'].read()))
+        with profile.phase('decompress'):
+            body = gzip.decompress(body)
+    
+    with profile.phase('parse'):
+        geojson = json.loads(body)
     
-    geojson = json.load(object['Body'])
     return geojson['features']
 
+def load_binary_tile(storage, tile_zxy, profile=None):
+    ''' Get a prepare_state.BinaryTile for a specific tile, or None if there is none.
+    
+        Optional profile is a util.Profile for fetch, decompress, and parse times.
+    '''
+    key = '{}/tiles/{}.bin'.format(storage.prefix, tile_zxy)
+    profile = profile or util.Profile()
+
+    try:
+        with profile.phase('fetch'):
+            object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+            body = object['Body'].read()
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return None
+        raise
+
+    if object.get('ContentEncoding') == 'gzip':
+        with profile.phase('decompress'):
+            body = gzip.decompress(body)
+    
+    with profile.phase('parse'):
+        return prepare_state.read_binary_tile(body)
+
+def load_tile_totals(storage, tile_zxy, profile=None):
+    ''' Get precomputed totals for a specific tile, or None if there are none.
+    
+        Totals are written by prepare_state next to the tile GeoJSON.
+        Optional profile is a util.Profile for fetch, decompress, and parse times.
+    '''
+    key = '{}/totals/{}.json'.format(storage.prefix, tile_zxy)
+    profile = profile or util.Profile()
+
+    try:
+        with profile.phase('fetch'):
+            object = storage.s3.get_object(Bucket=storage.bucket, Key=key)
+            body = object['Body'].read()
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            # Older models do not have precomputed totals
+            return None
+        raise
+
+    if object.get('ContentEncoding') == 'gzip':
+        with profile.phase('decompress'):
+            body = gzip.decompress(body)
+    
+    with profile.phase('parse'):
+        return json.loads(body)
+
+def tile_payload(storage, upload, tile_key, tile_districts=None, redispatched=False):
+    ''' Return RunTile event payload bytes for a tile key or list of tile keys.
+    
+        Optional redispatched marks a second dispatch of a late tile.
+    '''
+    payload = dict(upload=upload.to_dict(), storage=storage.to_event())
+    
+    if redispatched:
+        payload.update(redispatched=True)
+    
+    if type(tile_key) is list:
+        # A batch of tiles shares one load of district geometries
+        payload.update(tile_keys=tile_key)
+        if tile_districts is not None:
+            payload.update(geometry_keys=sorted(set(itertools.chain(
+                *[tile_districts[key] for key in tile_key]))))
+    else:
+        payload.update(tile_key=tile_key)
+        if tile_districts is not None:
+            payload.update(geometry_keys=tile_districts[tile_key])
+    
+    return json.dumps(payload).encode('utf8')
+
+def upload_finished(storage, upload):
+    ''' Return True if ObserveTiles has already saved a final upload status.
+    '''
+    try:
+        object = storage.s3.get_object(Bucket=storage.bucket,
+            Key=data.UPLOAD_INDEX_KEY.format(id=upload.id))
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchKey':
+            return False
+        raise
+    
+    return json.load(object['Body']).get('status') is not None
+
 def get_tile_zxy(model_key_prefix, tile_key):
     '''
     '''
@@ -79,8 +296,30 @@ def tile_geometry(tile_zxy):
 
     return osgeo.ogr.CreateGeometryFromWkt(wkt)
 
+def get_interior_district(geometries, tile_geom):
+    ''' Return key of the single district geometry containing a tile, or None.
+    
+        Other districts may touch the tile edges but must not overlap it.
+    '''
+    interior_keys = []
+    
+    for (key, district_geom) in geometries.items():
+        if district_geom.Disjoint(tile_geom) or district_geom.Touches(tile_geom):
+            continue
+        elif tile_geom.Within(district_geom):
+            interior_keys.append(key)
+        else:
+            # Some district partially overlaps the tile
+            return None
+    
+    if len(interior_keys) == 1:
+        return interior_keys[0]
+
 def score_district(district_geom, precincts, tile_geom):
     ''' Return weighted precinct totals for a district over a tile.
+    
+        RunTile uses score_tile() for all districts at once. This simpler
+        version is kept as a reference to check score_tile() in tests.
     '''
     totals = collections.defaultdict(int)
     
@@ -88,77 +327,200 @@ def score_district(district_geom, precincts, tile_geom):
         return totals
     
     partial_district_geom = district_geom.Intersection(tile_geom)
+    prepared_district_geom = prepare_district_geom(partial_district_geom)
 
-    for precinct_feat in precincts:
-        subtotals = score_precinct(partial_district_geom, precinct_feat, tile_geom)
+    for precinct in precincts:
+        subtotals = score_precinct(partial_district_geom, precinct, tile_geom,
+            prepared_district_geom=prepared_district_geom)
         for (name, value) in subtotals.items():
             totals[name] = round(value + totals[name], constants.ROUND_COUNT)
 
     return totals
 
-def score_precinct(partial_district_geom, precinct_feat, tile_geom):
-    ''' Return weighted single-district totals for a precinct feature within a tile.
+def make_precinct(properties, field_names, geometry, load_shape):
+    ''' Return a Precinct for an OGR geometry, calling load_shape() for Shapely.
+    '''
+    if geometry is None or geometry.IsEmpty():
+        return Precinct(properties, field_names, None, None, None, 0, False)
+    
+    is_point = geometry.GetGeometryType() in (osgeo.ogr.wkbPoint,
+        osgeo.ogr.wkbPoint25D, osgeo.ogr.wkbMultiPoint, osgeo.ogr.wkbMultiPoint25D)
+    
+    try:
+        shape = load_shape()
+    except (ValueError, TypeError, AttributeError, shapely.errors.ShapelyError):
+        # Leave anything unusual to OGR
+        shape = None
+    
+    area = 0 if is_point else geometry.Area()
+    
+    return Precinct(properties, field_names, geometry, shape,
+        geometry.GetEnvelope(), area, is_point)
+
+def parse_precinct(precinct_feat):
+    ''' Return a Precinct with geometry and field names parsed from a GeoJSON feature.
+    
+        Parsing happens once per tile so each district can reuse the result.
+    '''
+    properties = precinct_feat['properties']
+    field_names = [name for name in score.FIELD_NAMES if name in properties]
+    geometry = osgeo.ogr.CreateGeometryFromJson(json.dumps(precinct_feat['geometry']))
+    
+    return make_precinct(properties, field_names, geometry,
+        lambda: shapely.geometry.shape(precinct_feat['geometry']))
+
+def parse_tile_precincts(precinct_feats):
+    ''' Return list of parsed Precincts for a list of tile GeoJSON features.
+    '''
+    return [parse_precinct(precinct_feat) for precinct_feat in precinct_feats]
+
+def parse_binary_precincts(binary_tile):
+    ''' Return list of parsed Precincts for a prepare_state.BinaryTile.
+    
+        Values stay in binary_tile.values, so Precincts carry only fractions.
+    '''
+    precincts = []
+    
+    for (fraction, wkb) in zip(binary_tile.fractions.tolist(), binary_tile.geometries):
+        wkb = bytes(wkb)
+        properties = {prepare_state.FRACTION_FIELD: None if math.isnan(fraction) else fraction}
+        geometry = osgeo.ogr.CreateGeometryFromWkb(wkb)
+        precincts.append(make_precinct(properties, [], geometry,
+            lambda: shapely.wkb.loads(wkb)))
+    
+    return precincts
+
+def prepare_district_geom(partial_district_geom):
+    ''' Return a prepared Shapely geometry for fast precinct classification.
+    
+        partial_district_geom is the intersection of district and tile geometries.
+    '''
+    if partial_district_geom is None or partial_district_geom.IsEmpty():
+        return None
+    
+    shape = shapely.wkb.loads(bytes(partial_district_geom.ExportToWkb()))
+    return shapely.prepared.prep(shape)
+
+def precinct_relation(prepared_district_geom, precinct):
+    ''' Classify a parsed Precinct as inside, outside, or crossing a district.
+    
+        Only boundary-crossing precincts need an expensive intersection.
+    '''
+    if prepared_district_geom is None or precinct.shape is None:
+        return PRECINCT_BOUNDARY
+    
+    # Cheap bounding box test first, using precinct envelope from parse_precinct()
+    minx, miny, maxx, maxy = prepared_district_geom.context.bounds
+    xmin, xmax, ymin, ymax = precinct.envelope
+
+    if xmin > maxx or xmax < minx or ymin > maxy or ymax < miny:
+        return PRECINCT_OUTSIDE
+    
+    try:
+        if prepared_district_geom.covers(precinct.shape):
+            return PRECINCT_INSIDE
+        elif not prepared_district_geom.intersects(precinct.shape):
+            return PRECINCT_OUTSIDE
+    except (ValueError, shapely.errors.ShapelyError) as e:
+        # Invalid precinct geometries can fail GEOS predicates, so leave
+        # them to the intersection and its fallback in precinct_weight()
+        print('precinct_relation:', e)
+    
+    return PRECINCT_BOUNDARY
+
+def precinct_weight(partial_district_geom, precinct, tile_geom, prepared_district_geom=None):
+    ''' Return fraction of a parsed Precinct's values that belong to a district.
         
         partial_district_geom is the intersection of district and tile geometries.
+        prepared_district_geom is an optional result of prepare_district_geom()
+        used to skip intersections for precincts wholly inside or outside.
     '''
-    # Initialize totals to zero
-    totals = {name: 0 for name in score.FIELD_NAMES if name in precinct_feat['properties']}
-    precinct_geom = osgeo.ogr.CreateGeometryFromJson(json.dumps(precinct_feat['geometry']))
+    precinct_geom = precinct.geometry
     
-    if precinct_geom is None or precinct_geom.IsEmpty():
+    if precinct_geom is None:
         # If there's no precinct geometry here, don't bother.
-        return totals
+        return 0
     elif partial_district_geom is None or partial_district_geom.IsEmpty():
         # If there's no district geometry here, don't bother.
-        return totals
-    elif precinct_geom.GetGeometryType() in (osgeo.ogr.wkbPoint,
-        osgeo.ogr.wkbPoint25D, osgeo.ogr.wkbMultiPoint, osgeo.ogr.wkbMultiPoint25D):
+        return 0
+    elif precinct.is_point:
         # Points have no area
-        precinct_is_point = True
         precinct_frac = 1
     else:
-        precinct_is_point = False
-        precinct_frac = precinct_feat['properties'][prepare_state.FRACTION_FIELD]
+        precinct_frac = precinct.properties[prepare_state.FRACTION_FIELD]
 
     if precinct_frac == 0:
         # If there's no overlap here, don't bother.
-        return totals
+        return 0
 
     if tile_geom.Within(partial_district_geom):
         # Don't laboriously calculate precinct fraction if we know it's all there.
         # This is safe because precincts are clipped on tile boundaries, so a
         # fully-contained tile necessarily means the precinct is also contained.
-        precinct_fraction = precinct_frac
-    elif precinct_is_point:
+        return precinct_frac
+    elif precinct.is_point:
         # Do simple inside/outside check for points
-        precinct_fraction = precinct_frac if precinct_geom.Within(partial_district_geom) else 0
-    else:
-        try:
+        return precinct_frac if precinct_geom.Within(partial_district_geom) else 0
+
+    relation = precinct_relation(prepared_district_geom, precinct)
+
+    if relation == PRECINCT_OUTSIDE:
+        # If the precinct doesn't touch the district, don't bother.
+        return 0
+    elif relation == PRECINCT_INSIDE:
+        # Whole precinct is inside the district, so skip the intersection.
+        return precinct_frac
+
+    precinct_area = precinct.area
+
+    try:
+        overlap_geom = precinct_geom.Intersection(partial_district_geom)
+    except RuntimeError as e:
+        if 'TopologyException' in str(e) and not precinct_geom.IsValid():
+            # Sometimes, a precinct geometry can be invalid
+            # so inflate it by a tiny amount to smooth out problems
+            precinct_geom = precinct_geom.Buffer(0.0000001)
+            precinct_area = precinct_geom.Area()
             overlap_geom = precinct_geom.Intersection(partial_district_geom)
-        except RuntimeError as e:
-            if 'TopologyException' in str(e) and not precinct_geom.IsValid():
-                # Sometimes, a precinct geometry can be invalid
-                # so inflate it by a tiny amount to smooth out problems
-                precinct_geom = precinct_geom.Buffer(0.0000001)
-                overlap_geom = precinct_geom.Intersection(partial_district_geom)
-            else:
-                raise
-        if precinct_geom.Area() == 0:
-            # If we're about to divide by zero, don't bother.
-            return totals
-
-        overlap_area = overlap_geom.Area() / precinct_geom.Area()
-        precinct_fraction = overlap_area * precinct_frac
-    
-    for name in list(totals.keys()):
-        precinct_value = precinct_fraction * (precinct_feat['properties'][name] or 0)
+        else:
+            raise
+    if precinct_area == 0:
+        # If we're about to divide by zero, don't bother.
+        return 0
+
+    overlap_area = overlap_geom.Area() / precinct_area
+    return overlap_area * precinct_frac
+
+def score_precinct(partial_district_geom, precinct, tile_geom, prepared_district_geom=None):
+    ''' Return weighted single-district totals for a precinct within a tile.
+        
+        precinct is a Precinct from parse_precinct() or a plain GeoJSON feature.
+        partial_district_geom is the intersection of district and tile geometries.
+        prepared_district_geom is an optional result of prepare_district_geom()
+        used to skip intersections for precincts wholly inside or outside.
+    '''
+    if type(precinct) is not Precinct:
+        precinct = parse_precinct(precinct)
+
+    # Initialize totals to zero
+    totals = {name: 0 for name in precinct.field_names}
+    precinct_fraction = precinct_weight(partial_district_geom, precinct,
+        tile_geom, prepared_district_geom=prepared_district_geom)
+    
+    if precinct_fraction == 0:
+        # If there's no overlap here, don't bother.
+        return totals
+    
+    for name in precinct.field_names:
+        precinct_value = precinct_fraction * (precinct.properties[name] or 0)
         
-        if name == 'Household Income 2016' and 'Households 2016' in precinct_feat['properties']:
+        if name == prepare_state.HOUSEHOLD_INCOME_FIELD \
+        and prepare_state.HOUSEHOLDS_FIELD in precinct.properties:
             # Household income can't be summed up like populations,
             # and needs to be weighted by number of households.
-            precinct_value *= (precinct_feat['properties']['Households 2016'] or 0)
-            totals['Sum Household Income 2016'] = \
-                round(totals.get('Sum Household Income 2016', 0)
+            precinct_value *= (precinct.properties[prepare_state.HOUSEHOLDS_FIELD] or 0)
+            totals[prepare_state.HOUSEHOLD_SUM_FIELD] = \
+                round(totals.get(prepare_state.HOUSEHOLD_SUM_FIELD, 0)
                     + precinct_value, constants.ROUND_COUNT)
 
             continue
@@ -167,44 +529,233 @@ def score_precinct(partial_district_geom, precinct_feat, tile_geom):
     
     return totals
 
-def lambda_handler(event, context):
+def tile_field_names(precincts):
+    ''' Return ordered list of all field names found in a list of parsed Precincts.
+    '''
+    return prepare_state.scoring_field_names([p.properties for p in precincts])
+
+def precinct_values(precincts, column_index):
+    ''' Return a precinct × field array of values for a list of parsed Precincts.
+    
+        column_index maps field names to array columns.
+    '''
+    return prepare_state.scoring_values([p.properties for p in precincts], column_index)
+
+def score_tile(geometries, precincts, tile_geom, field_names=None, values=None, profile=None):
+    ''' Return weighted precinct totals for each district geometry over a tile.
+    
+        geometries is a dictionary of OGR geometries, precincts is a list of
+        parsed Precincts. A district × precinct weight matrix is built once and
+        multiplied by precinct × field values to get all district totals at once.
+        
+        Optional field_names and values give a ready-made precinct × field
+        array, such as one from a binary tile, in place of precinct properties.
+        Optional profile is a util.Profile for setup, intersect, and aggregate times.
+    '''
+    keys = list(geometries.keys())
+    weights = numpy.zeros((len(keys), len(precincts)))
+    overlapping_rows = set()
+    profile = profile or util.Profile()
+    
+    for (row, key) in enumerate(keys):
+        district_geom = geometries[key]
+
+        with profile.phase('setup'):
+            if district_geom.Disjoint(tile_geom):
+                continue
+            
+            overlapping_rows.add(row)
+            partial_district_geom = district_geom.Intersection(tile_geom)
+            prepared_district_geom = prepare_district_geom(partial_district_geom)
+
+        with profile.phase('intersect'):
+            for (column, precinct) in enumerate(precincts):
+                weights[row, column] = precinct_weight(partial_district_geom, precinct,
+                    tile_geom, prepared_district_geom=prepared_district_geom)
+    
+    with profile.phase('aggregate'):
+        return aggregate_weights(keys, weights, overlapping_rows, precincts, field_names, values)
+
+def aggregate_weights(keys, weights, overlapping_rows, precincts, field_names, values):
+    ''' Return district totals from a district × precinct weight matrix for score_tile().
+    '''
+    if values is None:
+        field_names = tile_field_names(precincts)
+    
+    column_index = {name: column for (column, name) in enumerate(field_names)}
+    sums = numpy.zeros((len(keys), len(field_names)))
+    
+    # Work through precincts in chunks to bound the size of the value array
+    for start in range(0, len(precincts), TILE_PRECINCT_CHUNK):
+        chunk_weights = weights[:, start:start + TILE_PRECINCT_CHUNK]
+
+        if not chunk_weights.any():
+            continue
+
+        if values is None:
+            chunk = precincts[start:start + TILE_PRECINCT_CHUNK]
+            sums += chunk_weights.dot(precinct_values(chunk, column_index))
+        else:
+            sums += chunk_weights.dot(values[start:start + TILE_PRECINCT_CHUNK])
+    
+    totals = {}
+    
+    for (row, key) in enumerate(keys):
+        if row not in overlapping_rows:
+            totals[key] = {}
+            continue
+        
+        totals[key] = {name: round(value, constants.ROUND_COUNT)
+            for (name, value) in zip(field_names, sums[row].tolist())}
+    
+    return totals
+
+def precincts_size(precincts):
+    ''' Return rough memory size of parsed precincts for cache accounting.
+    '''
+    wkb_size = sum(precinct.geometry.WkbSize() for precinct in precincts
+        if precinct.geometry is not None)
+    properties_size = sum(64 * len(precinct.properties) for precinct in precincts)
+    
+    return (wkb_size + properties_size) * PARSED_SIZE_FACTOR
+
+def load_cached_totals(storage, tile_zxy, profile=None):
+    ''' Get precomputed totals for a tile, kept between warm invocations.
+    
+        Optional profile is a util.Profile for load times.
+    '''
+    cache_key = (storage.bucket, storage.prefix, 'totals', tile_zxy)
+    tile_totals = _tile_cache.get(cache_key)
+    
+    if tile_totals is None:
+        tile_totals = load_tile_totals(storage, tile_zxy, profile)
+        _tile_cache.put(cache_key, _NO_TOTALS if tile_totals is None else tile_totals,
+            len(json.dumps(tile_totals)))
+    
+    return None if tile_totals is _NO_TOTALS else tile_totals
+
+def load_cached_precincts(storage, tile_key, tile_zxy, profile=None):
+    ''' Get binary tile or None and parsed precincts, kept between warm invocations.
+    
+        Optional profile is a util.Profile for load times and precinct counts.
+    '''
+    cache_key = (storage.bucket, storage.prefix, 'precincts', tile_zxy, tile_key)
+    cached = _tile_cache.get(cache_key)
+    profile = profile or util.Profile()
+    
+    if cached is not None:
+        profile.count('cache_hits')
+    else:
+        if tile_key.endswith('.bin'):
+            binary_tile = load_binary_tile(storage, tile_zxy, profile)
+            with profile.phase('parse'):
+                precincts = parse_binary_precincts(binary_tile)
+        else:
+            binary_tile = None
+            precinct_feats = load_tile_precincts(storage, tile_zxy, profile)
+            with profile.phase('parse'):
+                precincts = parse_tile_precincts(precinct_feats)
+        
+        vertex_count = sum(prepare_state.geometry_vertex_count(precinct.geometry)
+            for precinct in precincts)
+        cached = (binary_tile, precincts, vertex_count)
+        _tile_cache.put(cache_key, cached, precincts_size(precincts))
+    
+    binary_tile, precincts, vertex_count = cached
+    profile.count('precincts', len(precincts))
+    profile.count('vertices', vertex_count)
+    
+    return binary_tile, precincts
+
+def score_tile_key(storage, upload, tile_key, geometries, profile=None):
+    ''' Return totals and feature count for one model tile key.
+    
+        Optional profile is a util.Profile to break down where time goes.
     '''
+    tile_zxy = get_tile_zxy(upload.model.key_prefix, tile_key)
+    tile_geom = tile_geometry(tile_zxy)
+    profile = profile or util.Profile()
+
+    with profile.phase('setup'):
+        interior_key = get_interior_district(geometries, tile_geom)
+    
+    tile_totals = load_cached_totals(storage, tile_zxy, profile) if interior_key else None
+    
+    if tile_totals is not None:
+        # Tile is wholly inside one district, so skip precincts entirely
+        totals = {key: (tile_totals['totals'] if key == interior_key else {})
+            for key in geometries}
+        return totals, tile_totals['features']
+    
+    binary_tile, precincts = load_cached_precincts(storage, tile_key, tile_zxy, profile)
+    
+    if binary_tile is not None:
+        totals = score_tile(geometries, precincts, tile_geom,
+            binary_tile.columns, binary_tile.values, profile)
+    else:
+        totals = score_tile(geometries, precincts, tile_geom, profile=profile)
+
+    return totals, len(precincts)
+
+def lambda_handler(event, context):
+    ''' Score one tile_key, or a batch of tile_keys with one combined result.
+    
+        District geometries are loaded once for all tiles in a batch, and the
+        result is written to the output key of the first tile. Late results
+        are not left behind once ObserveTiles has finished with the upload.
     '''
-    start_time = time.time()
     s3 = boto3.client('s3')
     storage = data.Storage.from_event(event['storage'], s3)
     upload = data.Upload.from_dict(event['upload'])
     
     print('tiles.lambda_handler():', json.dumps(event))
 
-    try:
-        tile_zxy = get_tile_zxy(upload.model.key_prefix, event['tile_key'])
-        output_key = data.UPLOAD_TILES_KEY.format(id=upload.id, zxy=tile_zxy)
-        tile_geom = tile_geometry(tile_zxy)
-
-        totals = {}
-        precincts = load_tile_precincts(storage, tile_zxy)
-        geometries = load_upload_geometries(storage, upload)
-    
-        for (geometry_key, district_geom) in geometries.items():
-            totals[geometry_key] = score_district(district_geom, precincts, tile_geom)
-    except Exception as err:
-        print('Exception:', err)
-        totals = str(err)
-        feature_count = None
-    else:
-        feature_count = len(precincts)
+    tile_keys = event.get('tile_keys') or [event['tile_key']]
+    output_key = data.UPLOAD_TILES_KEY.format(id=upload.id,
+        zxy=get_tile_zxy(upload.model.key_prefix, tile_keys[0]))
+    geometries, results = None, []
+    
+    for tile_key in tile_keys:
+        start_time, profile = time.time(), util.Profile()
 
-    timing = dict(
-        start_time=round(start_time, 3),
-        elapsed_time=round(time.time() - start_time, 3),
-        features=feature_count,
-    )
+        try:
+            if geometries is None:
+                with profile.phase('geometries'):
+                    geometries = load_upload_geometries(storage, upload, event.get('geometry_keys'))
+            totals, feature_count = score_tile_key(storage, upload, tile_key, geometries, profile)
+        except Exception as err:
+            print('Exception:', err)
+            totals = str(err)
+            feature_count = None
+
+        timing = dict(
+            start_time=round(start_time, 3),
+            elapsed_time=round(time.time() - start_time, 3),
+            features=feature_count,
+            tile_key=tile_key,
+            **profile.to_dict()
+        )
+        
+        results.append(dict(tile_key=tile_key, totals=totals, timing=timing))
+    
+    if 'tile_keys' in event:
+        body = dict(event, tiles=results)
+    else:
+        body = dict(event, totals=results[0]['totals'], timing=results[0]['timing'])
+    
+    if upload_finished(storage, upload):
+        # ObserveTiles finished without this result, so don't leave it behind
+        print('tiles.lambda_handler(): upload finished, skipping', output_key)
+        return
     
     print('s3.put_object():', dict(Bucket=storage.bucket, Key=output_key,
-        Body=dict(event, totals=totals, timing=timing),
-        ContentType='text/plain', ACL='public-read'))
+        Body=body, ContentType='text/plain', ACL='public-read'))
 
     s3.put_object(Bucket=storage.bucket, Key=output_key,
-        Body=json.dumps(dict(event, totals=totals, timing=timing)).encode('utf8'),
+        Body=json.dumps(body).encode('utf8'),
         ContentType='text/plain', ACL='public-read')
+    
+    if upload_finished(storage, upload):
+        # ObserveTiles may have cleaned up tiles while this one was written
+        print('tiles.lambda_handler(): upload finished, deleting', output_key)
+        s3.delete_object(Bucket=storage.bucket, Key=output_key)
@@ -1,4 +1,4 @@
-import urllib.parse, tempfile, shutil, os, contextlib, logging, zipfile, itertools, shutil, enum
+import urllib.parse, tempfile, shutil, os, contextlib, logging, zipfile, itertools, shutil, enum, collections, time
 from . import constants
 
 class UploadType (enum.Enum):
@@ -7,6 +7,77 @@ class UploadType (enum.Enum):
     ZIPPED_OGR_DATASOURCE = 3
     ZIPPED_BLOCK_ASSIGNMENT = 4
 
+class SizedCache:
+    ''' Least-recently-used cache bounded by the total estimated size of its values.
+    '''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._items = collections.OrderedDict()
+    
+    def __contains__(self, key):
+        return key in self._items
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key, default=None):
+        ''' Return a cached value and mark it as recently used.
+        '''
+        if key not in self._items:
+            return default
+        
+        self._items.move_to_end(key)
+        return self._items[key][0]
+    
+    def put(self, key, value, size):
+        ''' Add a value with its estimated size, evicting least-recently-used values.
+        '''
+        if key in self._items:
+            self.size -= self._items.pop(key)[1]
+        
+        if size > self.max_size:
+            # Never keep a value that would push out everything else
+            return
+        
+        self._items[key] = (value, size)
+        self.size += size
+        
+        while self.size > self.max_size:
+            _, (_, old_size) = self._items.popitem(last=False)
+            self.size -= old_size
+    
+    def clear(self):
+        self._items.clear()
+        self.size = 0
+
+class Profile:
+    ''' Seconds spent in named phases of some work, plus named counts.
+    '''
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
+    
+    @contextlib.contextmanager
+    def phase(self, name):
+        ''' Add time spent inside this context to a named phase.
+        '''
+        start_time = time.perf_counter()
+        
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start_time
+    
+    def count(self, name, value=1):
+        self.counts[name] += value
+    
+    def to_dict(self):
+        ''' Return a flat dictionary with "{phase}_time" seconds and counts.
+        '''
+        times = {f'{name}_time': round(seconds, 4) for (name, seconds) in self.seconds.items()}
+        return dict(times, **self.counts)
+
 @contextlib.contextmanager
 def temporary_buffer_file(filename, buffer):
     try:
@@ -10,12 +10,13 @@ setup(
         ],
     test_suite = 'planscore.tests',
     package_data = {
-        'planscore': ['geodata/*.*', 'model/*.csv.gz'],
+        'planscore': ['geodata/*.*', 'model/*.csv.gz', 'model/*.npy', 'model/*.source.json'],
         'planscore.website': ['templates/*.html', 'static/*.*'],
         'planscore.tests': [
             'data/*.*',
             'data/*/*/*/*.geojson',
             'data/*/tiles/*/*/*.geojson',
+            'data/*/totals/*/*/*.json',
             'data/*-graphs/*/*.pickle',
             'data/uploads/sample-plan/districts/?.json',
             'data/uploads/sample-plan/tiles/*/*/*.json',
@@ -53,10 +54,14 @@ setup(
         },
     entry_points = dict(
         console_scripts = [
+            'planscore-benchmark = planscore.benchmark:main',
+            'planscore-matrix-compile = planscore.matrix:compile_main',
             'planscore-matrix-debug = planscore.matrix:main',
             'planscore-polygonize = planscore.polygonize:main',
             'planscore-prepare-state = planscore.prepare_state:main',
             'planscore-score-locally = planscore.score:main',
+            'planscore-score-plan = planscore.score_plan:main',
+            'planscore-synthetic-state = planscore.synthetic:main',
             ]
         ),
 )